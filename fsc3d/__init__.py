@@ -25,14 +25,19 @@
 # **************************************************************************
 
 import os
+import sys
+import time
+import tempfile
+import subprocess
 
 import pwem
 from pyworkflow import Config
 from pyworkflow.utils import Environ
 
 from .constants import *
+from . import worker
 
-__version__ = '3.2.2'
+__version__ = '3.3'
 _logo = "salk_logo.jpg"
 _references = ['tan2017']
 
@@ -47,6 +52,9 @@ class Plugin(pwem.Plugin):
     def _defineVariables(cls):
         cls._defineEmVar(FSC3D_HOME, 'fsc3D-3.0')
         cls._defineVar(FSC3D_ENV_ACTIVATION, DEFAULT_ACTIVATION_CMD)
+        cls._defineVar(FSC3D_CACHE, '')
+        cls._defineVar(FSC3D_CACHE_SIZE, DEFAULT_CACHE_SIZE)
+        cls._defineVar(FSC3D_WORKER_IDLE, DEFAULT_WORKER_IDLE)
 
     @classmethod
     def getEnviron(cls):
@@ -67,6 +75,22 @@ class Plugin(pwem.Plugin):
 
         return activation.replace(scipionHome, "", 1)
 
+    @classmethod
+    def getCachePath(cls, *paths):
+        """ Return the cache folder (FSC3D_CACHE, by default in the
+        Scipion user data folder, that is writable and kept when the 3DFSC
+        program is reinstalled).
+        """
+        cachePath = (cls.getVar(FSC3D_CACHE) or
+                     os.path.join(Config.SCIPION_USER_DATA, 'cache', 'fsc3d'))
+
+        return os.path.join(cachePath, *paths)
+
+    @classmethod
+    def getCacheSize(cls):
+        """ Return the cache size limit in bytes. """
+        return float(cls.getVar(FSC3D_CACHE_SIZE)) * 1024 ** 3
+
     @classmethod
     def getActivationCmd(cls):
         """ Return the activation command. """
@@ -85,12 +109,81 @@ class Plugin(pwem.Plugin):
         return neededProgs
 
     @classmethod
-    def runProgram(cls, protocol, args, cwd=None):
-        """ Return the program binary that will be used. """
+    def runProgram(cls, protocol, args, cwd=None, useWorker=False,
+                   log=None):
+        """ Run ThreeDFSC_Start.py. If useWorker is set, the job is sent
+        to the persistent worker (started if needed), falling back to a
+        new process if the worker is not available. The program output
+        goes to the log file object if given, or to the protocol log.
+        """
+        if useWorker and cls.startWorker():
+            logFn = os.path.join(cwd or os.getcwd(), 'ThreeDFSC_worker.log')
+            protocol.info("Running on 3DFSC worker: %s" % args)
+            code = worker.submitJob(cls.getWorkerSocket(), args,
+                                    os.path.abspath(cwd or os.getcwd()),
+                                    logFn, output=log)
+            if code == 0:
+                return
+            if code is not None:
+                raise RuntimeError("3DFSC worker job failed with exit "
+                                   "code %d" % code)
+            protocol.info("3DFSC worker failed, running a new process.")
+
+        if log is not None:
+            log.flush()
+            args += ' >> %s 2>&1' % os.path.abspath(log.name)
         cmd = f'{cls.getActivationCmd()} && '
         cmd += cls.getHome('ThreeDFSC', 'ThreeDFSC_Start.py')
         protocol.runJob(cmd, args, env=cls.getEnviron(), cwd=cwd)
 
+    @classmethod
+    def getWorkerSocket(cls):
+        """ Return the socket of the persistent 3DFSC worker. """
+        return os.path.join(tempfile.gettempdir(),
+                            'fsc3d-worker-%d.sock' % os.getuid())
+
+    @classmethod
+    def isWorkerRunning(cls):
+        """ Return True if the persistent 3DFSC worker answers. """
+        return worker.isRunning(cls.getWorkerSocket())
+
+    @classmethod
+    def startWorker(cls, timeout=WORKER_START_TIMEOUT):
+        """ Start the persistent 3DFSC worker if it is not running and
+        wait until it is ready. It keeps the 3DFSC environment imported
+        and compiled, and exits after FSC3D_WORKER_IDLE seconds without
+        jobs. Return True if the worker is available.
+        """
+        if cls.isWorkerRunning():
+            return True
+
+        socketFn = cls.getWorkerSocket()
+        cmd = (f'{cls.getActivationCmd()} && python {worker.__file__} '
+               f'--socket {socketFn} '
+               f'--script {cls.getHome("ThreeDFSC", "ThreeDFSC_Start.py")} '
+               f'--idle {cls.getVar(FSC3D_WORKER_IDLE)}')
+        with open(os.path.splitext(socketFn)[0] + '.log', 'a') as log:
+            process = subprocess.Popen(cmd, shell=True, env=cls.getEnviron(),
+                                       stdout=log, stderr=subprocess.STDOUT,
+                                       stdin=subprocess.DEVNULL,
+                                       start_new_session=True)
+
+        start = time.time()
+        while time.time() - start < timeout:
+            if cls.isWorkerRunning():
+                return True
+            if process.poll() is not None:
+                # exited, maybe another worker took the socket meanwhile
+                return cls.isWorkerRunning()
+            time.sleep(1)
+
+        return False
+
+    @classmethod
+    def runEngine(cls, protocol, args, cwd=None):
+        """ Run the built-in 3D FSC engine in a separate process. """
+        protocol.runJob(sys.executable, '-m fsc3d.engine %s' % args, cwd=cwd)
+
     @classmethod
     def defineBinaries(cls, env):
         for ver in cls._supportedVersions:
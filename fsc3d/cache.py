@@ -0,0 +1,236 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+from .engine import getDirections, writeGeometry
+
+
+def getTreeSize(path):
+    """ Return the total size in bytes of the files under path. """
+    size = 0
+    for root, _, files in os.walk(path):
+        for fn in files:
+            size += os.path.getsize(os.path.join(root, fn))
+
+    return size
+
+
+class ResultCache:
+    """ Content-addressed cache of 3DFSC results. Each entry is a folder
+    named after the hash of the input files and the program arguments.
+    Files are always copied, never linked, since programs overwrite their
+    outputs in place.
+
+    All caches in the same root folder share its size limit: entries of
+    any of them are evicted in least-recently-used order when the root
+    grows above the limit. Entries in use (see pin) are never evicted.
+    """
+    NAME = 'results'
+    BLOCK_SIZE = 2 ** 24
+    RESULTS = 'results'
+    LOG = 'run.log'
+    LOCK = 'lock'
+
+    def __init__(self, rootPath, maxSize):
+        """ Create the cache in the NAME folder of rootPath, with maxSize
+        given in bytes for all the caches of rootPath.
+        """
+        self.rootPath = rootPath
+        self.path = os.path.join(rootPath, self.NAME)
+        self.maxSize = maxSize
+        os.makedirs(self.path, exist_ok=True)
+        if not os.access(self.path, os.W_OK | os.X_OK):
+            raise PermissionError("Cache folder %s is not writable"
+                                  % self.path)
+
+    @classmethod
+    def hashFile(cls, fn):
+        h = hashlib.blake2b(digest_size=20)
+        with open(fn, 'rb') as f:
+            for block in iter(lambda: f.read(cls.BLOCK_SIZE), b''):
+                h.update(block)
+
+        return h.hexdigest()
+
+    @classmethod
+    def computeKey(cls, files, args):
+        """ Return the key for a list of input files and a dictionary
+        of arguments. Only the content of the files is used, not their path.
+        """
+        h = hashlib.blake2b(digest_size=20)
+        for fn in files:
+            h.update(cls.hashFile(fn).encode())
+        h.update(json.dumps(args, sort_keys=True, default=str).encode())
+
+        return h.hexdigest()
+
+    def _getEntry(self, key):
+        return os.path.join(self.path, key)
+
+    @contextmanager
+    def pin(self, key):
+        """ Keep the entry of key from being evicted, by other runs too,
+        while in use, and mark it as recently used. Yield the entry folder,
+        or None if the key is not in the cache.
+        """
+        entry = self._getEntry(key)
+        lockFn = os.path.join(entry, self.LOCK)
+        try:
+            f = open(lockFn, 'a')
+        except FileNotFoundError:
+            f = None
+
+        pinned = False
+        try:
+            if f is not None:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                try:  # evicted, and maybe stored again, before the lock
+                    pinned = (os.stat(lockFn).st_ino ==
+                              os.fstat(f.fileno()).st_ino)
+                except FileNotFoundError:
+                    pass
+            if pinned:
+                now = time.time()
+                os.utime(entry, (now, now))  # mark as recently used
+            yield entry if pinned else None
+        finally:
+            if f is not None:
+                f.close()
+
+    def get(self, key, outputDir):
+        """ Materialize the cached results into outputDir and return the
+        log stored with them. Return None if the key is not in the cache.
+        """
+        with self.pin(key) as entry:
+            if entry is None:
+                return None
+
+            shutil.copytree(os.path.join(entry, self.RESULTS), outputDir,
+                            dirs_exist_ok=True)
+            with open(os.path.join(entry, self.LOG)) as f:
+                return f.read()
+
+    def put(self, key, resultsDir, log=''):
+        """ Store a copy of resultsDir and the program log under key and
+        evict old entries. Results larger than the cache are not stored.
+        """
+        entry = self._getEntry(key)
+        if os.path.isdir(entry) or getTreeSize(resultsDir) > self.maxSize:
+            return
+
+        tmpEntry = '%s.%d.tmp' % (entry, os.getpid())
+        shutil.copytree(resultsDir, os.path.join(tmpEntry, self.RESULTS))
+        with open(os.path.join(tmpEntry, self.LOG), 'w') as f:
+            f.write(log)
+        try:
+            os.rename(tmpEntry, entry)
+        except OSError:  # stored meanwhile by another run
+            shutil.rmtree(tmpEntry, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        """ Remove least recently used entries of all the caches in the
+        root folder until they fit, skipping the pinned ones.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.rootPath):
+            path = os.path.join(self.rootPath, name)
+            if not os.path.isdir(path):
+                continue
+            for key in os.listdir(path):
+                entry = os.path.join(path, key)
+                if not os.path.isdir(entry):
+                    continue
+                size = getTreeSize(entry)
+                total += size  # temporary entries count but are not evicted
+                if not key.endswith('.tmp'):
+                    entries.append((os.path.getmtime(entry), size, entry))
+
+        for _, size, entry in sorted(entries):
+            if total <= self.maxSize:
+                break
+            try:
+                f = open(os.path.join(entry, self.LOCK), 'a')
+            except FileNotFoundError:  # evicted by another run
+                continue
+            with f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:  # in use
+                    continue
+                shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+class GeometryCache(ResultCache):
+    """ Cache of the geometry of a box used by the built-in engine (see
+    engine.getGeometry). Entries only depend on the box size and the
+    cone angle and share the size limit and eviction of ResultCache.
+    """
+    NAME = 'geometry'
+    VERSION = 1  # change if the stored geometry changes
+
+    def getKey(self, boxSize, dTheta):
+        return 'v%d_box%d_dtheta%s' % (self.VERSION, boxSize,
+                                       float(dTheta))
+
+    @contextmanager
+    def use(self, boxSize, dTheta, slabSize):
+        """ Yield the folder with the geometry of the box, writing it
+        slab by slab if it is not in the cache yet. The entry is pinned
+        until the context exits. Yield None if the geometry is larger
+        than the cache.
+        """
+        key = self.getKey(boxSize, dTheta)
+        entry = self._getEntry(key)
+        if not os.path.isdir(entry):
+            # protocol steps may run in threads of the same process
+            tmpEntry = tempfile.mkdtemp(prefix=key + '.', suffix='.tmp',
+                                        dir=self.path)
+            writeGeometry(tmpEntry, boxSize, getDirections(dTheta), dTheta,
+                          slabSize)
+            if getTreeSize(tmpEntry) > self.maxSize:
+                shutil.rmtree(tmpEntry, ignore_errors=True)
+                yield None
+                return
+            try:
+                os.rename(tmpEntry, entry)
+            except OSError:  # stored meanwhile by another run
+                shutil.rmtree(tmpEntry, ignore_errors=True)
+
+        with self.pin(key) as entry:
+            self.evict()
+            yield entry
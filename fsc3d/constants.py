@@ -30,6 +30,16 @@ V3_0 = '3.0'
 FSC3D_HOME = "FSC3D_HOME"
 FSC3D_ENV_ACTIVATION = "FSC3D_ENV_ACTIVATION"
 DEFAULT_ACTIVATION_CMD = f'conda activate fsc3D-{V3_0}'
+FSC3D_CACHE = "FSC3D_CACHE"
+FSC3D_CACHE_SIZE = "FSC3D_CACHE_SIZE"
+DEFAULT_CACHE_SIZE = 20  # GB
+FSC3D_WORKER_IDLE = "FSC3D_WORKER_IDLE"
+DEFAULT_WORKER_IDLE = 3600  # seconds
+WORKER_START_TIMEOUT = 600  # seconds
+
+# 3D FSC engines
+ENGINE_3DFSC = 0
+ENGINE_BUILTIN = 1
 
 # Viewer constants
 VOL_ORIG = 0
@@ -39,3 +49,9 @@ VOL_ALL = 3
 
 VOLUME_SLICES = 0
 VOLUME_CHIMERA = 1
+
+# Preview levels, from coarsest to full size
+PREVIEW_BIN4 = 0
+PREVIEW_BIN2 = 1
+PREVIEW_FULL = 2
+PREVIEW_FACTORS = [4, 2, 1]
@@ -0,0 +1,646 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import re
+import glob
+import gzip
+import time
+import shutil
+
+import numpy as np
+import mrcfile
+from pwem.emlib.image import ImageHandler
+
+from .metrics import sampleDirections
+
+# Staging methods
+STAGE_HARDLINK = 'hardlink'
+STAGE_SYMLINK = 'symlink'
+STAGE_CONVERT = 'convert'
+
+MRC_EXTENSIONS = ['.mrc', '.map']
+MRC_MODE_FLOAT32 = 2
+MRC_MODE_FLOAT16 = 12
+
+# Compressed volumes: binary ones bit-packed, the rest as gzipped float16 MRC
+BITS_SUFFIX = '.bits.npz'
+GZIP_SUFFIX = '.mrc.gz'
+FFT_PRIMES = (2, 3, 5)
+
+# Lines of the 3D FSC log with the results
+NUMBER = r'([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)'
+LOG_PATTERNS = {
+    'sphericity': re.compile(r'Sphericity is %s' % NUMBER),
+    'minDirResolution': re.compile(
+        r'Minimum directional resolution is %s' % NUMBER),
+    'maxDirResolution': re.compile(
+        r'Maximum directional resolution is %s' % NUMBER),
+}
+THR_PATTERN = re.compile(r'Sphericity at threshold %s is %s'
+                         % (NUMBER, NUMBER))
+
+
+def splitLocation(location):
+    """ Return (index, filename) from an image location, that can be
+    a filename or a (index, filename) tuple. Remove the format suffix
+    such as :mrc from the filename.
+    """
+    if isinstance(location, tuple):
+        index, fn = location
+    else:
+        index, fn = None, location
+
+    return index, fn.split(':')[0]
+
+
+def readMrcHeader(fn):
+    """ Return mode, dimensions (z, y, x) and voxel size of an MRC file,
+    or None if the file cannot be read as MRC.
+    """
+    try:
+        with mrcfile.open(fn, header_only=True, permissive=True) as mrc:
+            header = mrc.header
+            return (int(header.mode),
+                    (int(header.nz), int(header.ny), int(header.nx)),
+                    float(mrc.voxel_size.x))
+    except Exception:
+        return None
+
+
+def isReadyForFSC(location, samplingRate, tolerance=0.01):
+    """ Check if a volume is already a float32 cubic MRC file with the
+    expected voxel size, so it can be used by 3DFSC as is.
+    """
+    index, fn = splitLocation(location)
+    if index not in (None, 0, 1):
+        return False
+    if os.path.splitext(fn)[1].lower() not in MRC_EXTENSIONS:
+        return False
+
+    header = readMrcHeader(fn)
+    if header is None:
+        return False
+
+    mode, dims, voxelSize = header
+
+    return (mode == MRC_MODE_FLOAT32 and len(set(dims)) == 1 and
+            abs(voxelSize - samplingRate) <= tolerance * samplingRate)
+
+
+def stageInput(location, outputFn, samplingRate):
+    """ Make the volume available at outputFn for 3DFSC. Inputs that are
+    already valid MRC files are hard-linked (or symlinked if they are on
+    a different file system), the rest are converted. Return the method used.
+    """
+    if os.path.lexists(outputFn):
+        os.remove(outputFn)
+
+    if isReadyForFSC(location, samplingRate):
+        fn = os.path.abspath(splitLocation(location)[1])
+        try:
+            os.link(fn, outputFn)
+            return STAGE_HARDLINK
+        except OSError:
+            os.symlink(fn, outputFn)
+            return STAGE_SYMLINK
+
+    ImageHandler().convert(location, outputFn)
+
+    return STAGE_CONVERT
+
+
+def getFFTSize(size):
+    """ Return the smallest even size >= size with no prime factors
+    other than 2, 3 and 5.
+    """
+    size = max(int(np.ceil(size)), 2)
+    while True:
+        if size % 2 == 0:
+            n = size
+            for p in FFT_PRIMES:
+                while n % p == 0:
+                    n //= p
+            if n == 1:
+                return size
+        size += 1
+
+
+def getCropBoxSize(boxSize, samplingRate, resolution=0, cropBoxSize=0):
+    """ Return the box size to crop a map to in Fourier space, so that
+    the Nyquist frequency reaches the target resolution (A), or the
+    requested box size. The result is never larger than the input box.
+    """
+    if cropBoxSize:
+        size = cropBoxSize + cropBoxSize % 2
+    else:
+        size = getFFTSize(2 * boxSize * samplingRate / resolution)
+
+    return min(size, boxSize)
+
+
+def fourierCrop(fn, cropBoxSize, clip=None):
+    """ Crop the MRC map in Fourier space to a smaller box, in place.
+    The map keeps its physical size (box * voxel size), so the voxel size
+    grows accordingly. Values can be clipped to a (min, max) range, e.g.
+    for masks. Return the new voxel size.
+    """
+    with mrcfile.open(fn, permissive=True) as mrc:
+        data = np.asarray(mrc.data, dtype=np.float32)
+        voxelSize = float(mrc.voxel_size.x)
+
+    boxSize = data.shape[0]
+    half = cropBoxSize // 2
+    index = np.r_[0:half, boxSize - half:boxSize]
+    ft = np.fft.rfftn(data)[np.ix_(index, index, np.arange(half + 1))]
+    cropped = np.fft.irfftn(ft, s=(cropBoxSize,) * 3)
+    cropped *= (cropBoxSize / boxSize) ** 3
+    if clip is not None:
+        cropped = np.clip(cropped, *clip)
+
+    # the staged file may be a link to the input, never write through it
+    os.remove(fn)
+    newVoxelSize = voxelSize * boxSize / cropBoxSize
+    with mrcfile.new(fn) as mrc:
+        mrc.set_data(cropped.astype(np.float32))
+        mrc.voxel_size = newVoxelSize
+
+    return newVoxelSize
+
+
+def padVolume(fn, boxSize, samplingRate):
+    """ Zero-pad a centered Fourier-space volume, such as the 3D FSC
+    map of a Fourier-cropped run, back to the original box, in place.
+    Both boxes have the same physical size, so every voxel keeps its
+    spatial frequency and only the voxel size changes.
+    """
+    with mrcfile.open(fn, permissive=True) as mrc:
+        data = np.asarray(mrc.data, dtype=np.float32)
+
+    size = data.shape[0]
+    if size == boxSize:
+        return
+
+    padded = np.zeros((boxSize,) * 3, dtype=np.float32)
+    start = boxSize // 2 - size // 2
+    end = start + size
+    padded[start:end, start:end, start:end] = data
+
+    with mrcfile.new(fn, overwrite=True) as mrc:
+        mrc.set_data(padded)
+        mrc.voxel_size = samplingRate
+
+
+def getMaskBox(fn, margin=8):
+    """ Return the origin (z, y, x) and the size of the cubic box that
+    contains the non-zero voxels of the MRC mask plus a margin, rounded
+    up to an FFT-friendly size and kept inside the map. Return None if
+    that box is not smaller than the map.
+    """
+    with mrcfile.mmap(fn, permissive=True) as mrc:
+        inside = np.asarray(mrc.data) > 0
+
+    boxSize = inside.shape[0]
+    if not inside.any():
+        return None
+
+    lo, hi = [], []
+    for axis in range(3):
+        other = tuple(a for a in range(3) if a != axis)
+        index = np.flatnonzero(inside.any(axis=other))
+        lo.append(index[0])
+        hi.append(index[-1] + 1)
+    lo, hi = np.array(lo), np.array(hi)
+
+    size = getFFTSize(np.max(hi - lo) + 2 * margin)
+    if size >= boxSize:
+        return None
+    origin = np.clip((lo + hi) // 2 - size // 2, 0, boxSize - size)
+
+    return tuple(int(v) for v in origin), size
+
+
+def cropVolume(fn, origin, size):
+    """ Crop the MRC map in real space to the cubic box of the given
+    origin (z, y, x) and size, in place. The voxel size is kept.
+    """
+    z, y, x = origin
+    with mrcfile.mmap(fn, permissive=True) as mrc:
+        cropped = np.array(mrc.data[z:z + size, y:y + size, x:x + size],
+                           dtype=np.float32)
+        voxelSize = float(mrc.voxel_size.x)
+
+    # the staged file may be a link to the input, never write through it
+    os.remove(fn)
+    with mrcfile.new(fn) as mrc:
+        mrc.set_data(cropped)
+        mrc.voxel_size = voxelSize
+
+
+def uncropVolume(fn, boxSize, origin):
+    """ Zero-pad a real-space map cropped with cropVolume back to the
+    original box, in place.
+    """
+    with mrcfile.open(fn, permissive=True) as mrc:
+        data = np.asarray(mrc.data, dtype=np.float32)
+        voxelSize = float(mrc.voxel_size.x)
+
+    z, y, x = origin
+    size = data.shape[0]
+    padded = np.zeros((boxSize,) * 3, dtype=np.float32)
+    padded[z:z + size, y:y + size, x:x + size] = data
+
+    with mrcfile.new(fn, overwrite=True) as mrc:
+        mrc.set_data(padded)
+        mrc.voxel_size = voxelSize
+
+
+def _getResampleMatrix(size, boxSize, nearest=False, centered=True):
+    """ Matrix (boxSize x size) that interpolates a centered Fourier
+    axis of size voxels at the frequencies of a box of boxSize voxels
+    with the same voxel size. If not centered, the axis is a real-space
+    one with the origin at voxel 0, as after a Fourier crop.
+    """
+    source = np.arange(boxSize) * size / boxSize
+    if centered:
+        source += size // 2 - boxSize // 2 * size / boxSize
+    matrix = np.zeros((boxSize, size), dtype=np.float32)
+    rows = np.arange(boxSize)
+    if nearest:
+        index = np.clip(np.rint(source).astype(int), 0, size - 1)
+        matrix[rows, index] = 1
+    else:
+        lower = np.floor(source).astype(int)
+        weight = source - lower
+        np.add.at(matrix, (rows, np.clip(lower, 0, size - 1)), 1 - weight)
+        np.add.at(matrix, (rows, np.clip(lower + 1, 0, size - 1)), weight)
+
+    return matrix
+
+
+def resampleVolume(fn, boxSize, samplingRate, nearest=False):
+    """ Resample a centered Fourier-space volume, such as the 3D FSC map
+    of a run on maps cropped in real space, to the frequencies of a
+    larger box with the same voxel size, in place. Values are
+    interpolated linearly, or taken from the nearest voxel, e.g. for
+    binary volumes.
+    """
+    with mrcfile.open(fn, permissive=True) as mrc:
+        data = np.asarray(mrc.data, dtype=np.float32)
+
+    size = data.shape[0]
+    if size == boxSize:
+        return
+
+    matrix = _getResampleMatrix(size, boxSize, nearest)
+    for axis in range(3):
+        data = np.moveaxis(np.tensordot(matrix, data, axes=(1, axis)),
+                           0, axis)
+
+    with mrcfile.new(fn, overwrite=True) as mrc:
+        mrc.set_data(np.ascontiguousarray(data, dtype=np.float32))
+        mrc.voxel_size = samplingRate
+
+
+def upsampleMap(fn, boxSize, samplingRate):
+    """ Interpolate a real-space map computed from Fourier-cropped maps,
+    such as the local sphericity map, on the grid of the original box,
+    in place. Both boxes have the same physical size, so voxel i of the
+    original box lies at voxel i * size / boxSize of the cropped one.
+    """
+    with mrcfile.open(fn, permissive=True) as mrc:
+        data = np.asarray(mrc.data, dtype=np.float32)
+
+    size = data.shape[0]
+    if size == boxSize:
+        return
+
+    matrix = _getResampleMatrix(size, boxSize, centered=False)
+    for axis in range(3):
+        data = np.moveaxis(np.tensordot(matrix, data, axes=(1, axis)),
+                           0, axis)
+
+    with mrcfile.new(fn, overwrite=True) as mrc:
+        mrc.set_data(np.ascontiguousarray(data, dtype=np.float32))
+        mrc.voxel_size = samplingRate
+
+
+def getPreviewFn(fn, previewDir, factor=None):
+    """ Return the preview file of a volume: binned by factor, or the
+    image of its central slices if factor is None.
+    """
+    base = os.path.splitext(os.path.basename(fn))[0]
+    suffix = '_slices.png' if factor is None else '_bin%d.mrc' % factor
+
+    return os.path.join(previewDir, base + suffix)
+
+
+def binVolume(fn, outputFn, factor):
+    """ Write a copy of the MRC volume binned by averaging factor^3
+    blocks. The volume is read in slabs of factor sections.
+    """
+    with mrcfile.mmap(fn, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        voxelSize = float(mrc.voxel_size.x)
+        size = [n // factor for n in data.shape]
+        with mrcfile.new_mmap(outputFn, tuple(size), mrc_mode=2,
+                              overwrite=True) as out:
+            for z in range(size[0]):
+                slab = np.asarray(data[z * factor:(z + 1) * factor,
+                                       :size[1] * factor, :size[2] * factor],
+                                  dtype=np.float32)
+                out.data[z] = slab.reshape(factor, size[1], factor,
+                                           size[2], factor).mean(axis=(0, 2, 4))
+            out.voxel_size = voxelSize * factor
+            out.update_header_stats()
+
+
+def writeSlices(fn, outputFn):
+    """ Save an image with the central orthogonal slices of a volume. """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    with mrcfile.mmap(fn, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        cz, cy, cx = [n // 2 for n in data.shape]
+        slices = [('XY', np.array(data[cz])),
+                  ('XZ', np.array(data[:, cy])),
+                  ('YZ', np.array(data[:, :, cx]))]
+
+    fig = Figure(figsize=(12, 4))
+    for i, (label, image) in enumerate(slices):
+        ax = fig.add_subplot(1, 3, i + 1)
+        ax.imshow(image, cmap='gray', origin='lower')
+        ax.set_title('%s: %s' % (os.path.basename(fn), label))
+        ax.axis('off')
+    FigureCanvasAgg(fig)
+    fig.savefig(outputFn, dpi=100, bbox_inches='tight')
+
+
+def createPreviews(fn, previewDir, factors=(2, 4)):
+    """ Write the binned copies and the central slices of a volume,
+    skipping those newer than the volume. Return the list of files.
+    """
+    os.makedirs(previewDir, exist_ok=True)
+    files = []
+    for factor in list(factors) + [None]:
+        outputFn = getPreviewFn(fn, previewDir, factor)
+        if not isNewer(outputFn, fn):
+            if factor is None:
+                writeSlices(fn, outputFn)
+            else:
+                binVolume(fn, outputFn, factor)
+        files.append(outputFn)
+
+    return files
+
+
+def _getCompressedFns(fn):
+    root = os.path.splitext(fn)[0]
+
+    return root + BITS_SUFFIX, root + GZIP_SUFFIX
+
+
+def getCompressedFn(fn):
+    """ Return the compressed file of a volume (see compressVolume), or
+    None if there is none.
+    """
+    for compressedFn in _getCompressedFns(fn):
+        if os.path.exists(compressedFn):
+            return compressedFn
+
+    return None
+
+
+def volumeExists(fn):
+    """ Check if a volume exists, as is or compressed. """
+    return os.path.exists(fn) or getCompressedFn(fn) is not None
+
+
+def compressVolume(fn, slabSize=16):
+    """ Replace an MRC volume by a compressed file. Volumes with only 0
+    and 1 values are bit-packed (8 voxels per byte) into a deflated .npz,
+    which also compresses the runs of equal bits. Other volumes are
+    written as float16 (MRC mode 12) and gzipped. The volume is read in
+    slabs. Return the compressed file.
+    """
+    bitsFn, gzipFn = _getCompressedFns(fn)
+    # whole bytes for every slab but the last one
+    slabSize = max(slabSize - slabSize % 8, 8)
+    with mrcfile.mmap(fn, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        voxelSize = float(mrc.voxel_size.x)
+        slabs = [(z, min(z + slabSize, data.shape[0]))
+                 for z in range(0, data.shape[0], slabSize)]
+        binary = all(np.isin(data[z0:z1], (0, 1)).all() for z0, z1 in slabs)
+
+        if binary:
+            bits = np.concatenate([np.packbits(data[z0:z1] > 0.5, axis=None)
+                                   for z0, z1 in slabs])
+            tmpFn = bitsFn[:-len('.npz')] + '.tmp.npz'
+            np.savez_compressed(tmpFn, bits=bits, shape=data.shape,
+                                voxelSize=voxelSize)
+            os.replace(tmpFn, bitsFn)
+            compressedFn = bitsFn
+        else:
+            tmpFn = os.path.splitext(fn)[0] + '.float16.mrc'
+            with mrcfile.new_mmap(tmpFn, data.shape,
+                                  mrc_mode=MRC_MODE_FLOAT16,
+                                  overwrite=True) as out:
+                for z0, z1 in slabs:
+                    out.data[z0:z1] = data[z0:z1]
+                out.voxel_size = voxelSize
+                out.update_header_stats()
+            with open(tmpFn, 'rb') as fIn, gzip.open(gzipFn + '.tmp',
+                                                     'wb') as fOut:
+                shutil.copyfileobj(fIn, fOut)
+            os.remove(tmpFn)
+            os.replace(gzipFn + '.tmp', gzipFn)
+            compressedFn = gzipFn
+
+    os.remove(fn)
+
+    return compressedFn
+
+
+def readVolume(fn):
+    """ Return the data (float32) and voxel size of a volume stored as
+    is or compressed.
+    """
+    compressedFn = None if os.path.exists(fn) else getCompressedFn(fn)
+    if compressedFn is None:
+        with mrcfile.open(fn, permissive=True) as mrc:
+            return (np.asarray(mrc.data, dtype=np.float32),
+                    float(mrc.voxel_size.x))
+
+    if compressedFn.endswith(BITS_SUFFIX):
+        with np.load(compressedFn) as saved:
+            shape = tuple(saved['shape'])
+            data = np.unpackbits(saved['bits'], count=int(np.prod(shape)))
+            return (data.reshape(shape).astype(np.float32),
+                    float(saved['voxelSize']))
+
+    with mrcfile.open(compressedFn, permissive=True) as mrc:
+        return (np.asarray(mrc.data, dtype=np.float32),
+                float(mrc.voxel_size.x))
+
+
+def restoreVolume(fn, outputFn=None):
+    """ Write a compressed volume as an ordinary float32 MRC file, by
+    default the original one. Return the written file.
+    """
+    outputFn = outputFn or fn
+    data, voxelSize = readVolume(fn)
+    with mrcfile.new(outputFn, overwrite=True) as mrc:
+        mrc.set_data(data)
+        mrc.voxel_size = voxelSize
+
+    return outputFn
+
+
+def isNewer(fn, *sources):
+    """ Check if fn exists and is newer than all the existing sources. """
+    if not os.path.exists(fn):
+        return False
+    mtime = os.path.getmtime(fn)
+
+    return all(os.path.getmtime(s) <= mtime for s in sources
+               if os.path.exists(s))
+
+
+def findHalfMapPairs(pattern, delay=0):
+    """ Return the sorted (label, half1, half2) tuples of the half maps
+    whose first half matches the glob pattern. The second half has the
+    same name with 'half2' instead of 'half1', and the label is the name
+    without 'half1'. Pairs with a file modified less than delay seconds
+    ago are skipped, since they may be still being written.
+    """
+    pairs = []
+    now = time.time()
+    for half1 in sorted(glob.glob(pattern)):
+        folder, name = os.path.split(half1)
+        if 'half1' not in name:
+            continue
+        half2 = os.path.join(folder, name.replace('half1', 'half2'))
+        if not os.path.exists(half2):
+            continue
+        if now - max(os.path.getmtime(half1),
+                     os.path.getmtime(half2)) < delay:
+            continue
+        label = re.sub(r'_?half1', '', os.path.splitext(name)[0])
+        pairs.append((label, half1, half2))
+
+    return pairs
+
+
+def readGlobalFSC(fn, apix):
+    """ Read the global FSC curve from the 3DFSC csv file. Return the
+    spatial frequencies (1/A) and the FSC values. If the file has a single
+    column, frequencies are computed from the number of shells.
+    """
+    rows = []
+    with open(fn) as f:
+        for line in f:
+            try:
+                rows.append([float(v) for v in line.replace(',', ' ').split()])
+            except ValueError:
+                continue  # header
+
+    data = np.array([r for r in rows if r])
+    if data.ndim == 2 and data.shape[1] > 1:
+        return data[:, 0], data[:, 1]
+
+    fsc = data.ravel()
+    boxSize = 2 * (len(fsc) - 1)
+
+    return np.arange(len(fsc)) / (boxSize * apix), fsc
+
+
+def readDirectionalFSC(fn):
+    """ Read the table saved by the built-in engine or by
+    sampleDirectionalFSC. Return directions, frequencies (1/A) and the
+    FSC of every direction (nDirections x nShells).
+    """
+    with np.load(fn) as data:
+        return data['directions'], data['freqs'], data['fsc']
+
+
+def sampleDirectionalFSC(volFn, directions, apix):
+    """ Return the frequencies (1/A) and the FSC of every direction by
+    sampling the centered 3D FSC volume along the direction axes
+    (nearest voxel at every shell).
+    """
+    with mrcfile.mmap(volFn, mode='r', permissive=True) as mrc:
+        boxSize = mrc.data.shape[0]
+        fsc = sampleDirections(mrc.data, directions)[0]
+
+    return np.arange(boxSize // 2 + 1) / (boxSize * apix), fsc
+
+
+def getResolution(freqs, fsc, cutoff):
+    """ Return the resolution (A) where the FSC first drops below cutoff. """
+    below = np.flatnonzero(np.asarray(fsc[1:]) < cutoff)
+    index = below[0] + 1 if len(below) else len(fsc) - 1
+
+    return 1. / freqs[index]
+
+
+def parseLog(fn):
+    """ Parse the results printed by 3D FSC. Return a dictionary with
+    sphericity and min/max directional resolution (None if not found) and
+    the list of (threshold, sphericity) pairs. If the log has several runs,
+    the values of the last one are returned.
+    """
+    results = {key: None for key in LOG_PATTERNS}
+    results['thresholdSphericity'] = []
+
+    with open(fn) as f:
+        for line in f:
+            match = THR_PATTERN.search(line)
+            if match:
+                results['thresholdSphericity'].append(
+                    tuple(float(v) for v in match.groups()))
+                continue
+            for key, pattern in LOG_PATTERNS.items():
+                match = pattern.search(line)
+                if match:
+                    if key == 'sphericity':
+                        # a new run starts a new list
+                        results['thresholdSphericity'] = []
+                    results[key] = float(match.group(1))
+
+    return results
+
+
+def readResults(logFn, globalFscFn, samplingRate, fscCutoff):
+    """ Read all 3D FSC results: the values parsed from the log and the
+    global resolution at the FSC cutoff.
+    """
+    results = parseLog(logFn)
+    freqs, fsc = readGlobalFSC(globalFscFn, samplingRate)
+    results['globalResolution'] = float(getResolution(freqs, fsc, fscCutoff))
+
+    return results
@@ -0,0 +1,1250 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Built-in NumPy implementation of the 3D FSC calculation.
+
+The half maps are transformed only once, then the conical FSC of every
+sampled direction is accumulated in batches over the Fourier voxels.
+The results are written with the same names used by ThreeDFSC_Start.py,
+so the protocol and the viewer can use either of them. The module can
+also be executed as a script with the same arguments as ThreeDFSC_Start.py:
+
+    python -m fsc3d.engine --halfmap1=h1.mrc --halfmap2=h2.mrc ...
+
+All volumes are processed in slabs along z. Inputs are memory-mapped and
+outputs are written in place, so with a memory budget the work arrays
+(Fourier transforms, path minimum) are also kept on disk and the memory
+use only depends on the slab size.
+
+Long runs can write a checkpoint folder: the Fourier transforms, the
+partial FSC sums of every group of directions (saved at regular
+intervals while the slabs are accumulated) and the final FSC. A run with
+the same inputs and options continues from it, adding the remaining
+slabs in the same order, so the result is identical to an uninterrupted
+run.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import mrcfile
+
+from .timing import PhaseLogger
+
+
+ENGINE_VERSION = 1  # change if the results change, it is part of cache keys
+CHUNK_SIZE = 2 ** 16  # number of Fourier voxels processed at once
+SLAB_SIZE = 16  # number of z sections processed at once without a budget
+BYTES_PER_VOXEL = 16  # in-core work volumes: 3D FSC, thresholded, path minimum
+SLAB_BYTES_PER_VOXEL = 128  # temporary arrays used while processing a slab
+ADAPTIVE_MARGIN = 4  # shells computed beyond the last crossing of the cutoff
+ADAPTIVE_TOLERANCE = 0.1  # relative difference of neighbouring crossings
+PRECISIONS = {'double': np.complex128, 'single': np.complex64}
+PRECISION_CHECK_SIZE = 64  # box of the copy used to check single precision
+PRECISION_TOLERANCE = 0.01
+PRECISION_WARNING = 'Warning: single precision changes the results'
+CHECKPOINT_INTERVAL = 600  # seconds between saves of the partial FSC sums
+GEOMETRY_DTYPES = {'index': np.int32, 'shells': np.uint16,
+                   'voxels': np.int32, 'cones': np.uint16,
+                   'nearest': np.uint16}
+MAX_DIRECTIONS = 2 ** 16  # cone ids are stored as uint16
+
+
+def readMap(fn, dtype=np.float32):
+    """ Read an MRC file into a numpy array. """
+    with mrcfile.open(fn, permissive=True) as mrc:
+        return np.asarray(mrc.data, dtype=dtype)
+
+
+def openMap(fn):
+    """ Return a read-only memory map of the data of an MRC file. """
+    with mrcfile.open(fn, header_only=True, permissive=True) as mrc:
+        header = mrc.header
+        dtype = mrcfile.utils.data_dtype_from_header(header)
+        shape = (int(header.nz), int(header.ny), int(header.nx))
+        offset = header.nbytes + int(header.nsymbt)
+
+    return np.memmap(fn, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+
+def writeMap(fn, data, apix):
+    """ Write a numpy array as a float32 MRC file. """
+    with mrcfile.new(fn, overwrite=True) as mrc:
+        mrc.set_data(np.asarray(data, dtype=np.float32))
+        mrc.voxel_size = apix
+
+
+def newMap(fn, shape, apix):
+    """ Create a float32 MRC file to be filled in place. Return the
+    mrcfile object; its data attribute is a writable memory map.
+    """
+    mrc = mrcfile.new_mmap(fn, shape, mrc_mode=2, overwrite=True)
+    mrc.voxel_size = apix
+
+    return mrc
+
+
+def closeMap(mrc):
+    """ Update the header statistics of a map created with newMap. """
+    mrc.update_header_stats()
+    mrc.close()
+
+
+def newArray(shape, dtype, workDir=None, name=None):
+    """ Allocate a work array in memory, or as a .npy memory map in
+    workDir when running out of core.
+    """
+    if workDir is None:
+        return np.zeros(shape, dtype=dtype)
+
+    return np.lib.format.open_memmap(os.path.join(workDir, name + '.npy'),
+                                     mode='w+', dtype=dtype, shape=shape)
+
+
+def getProcessPool(workers, **kwargs):
+    """ Return a pool of worker processes forked from a server process,
+    not from the caller. Protocol steps run in threads, and a process
+    forked from a multi-threaded one can inherit locks held by the other
+    threads and hang.
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context(
+            'forkserver'), **kwargs)
+
+
+def saveArrays(fn, **arrays):
+    """ Save arrays to a .npz file, replacing it only once written so
+    an interrupted save keeps the previous file.
+    """
+    tmpFn = fn[:-len('.npz')] + '.tmp.npz'
+    np.savez(tmpFn, **arrays)
+    os.replace(tmpFn, fn)
+
+
+def openCheckpoint(path, key):
+    """ Return the state saved in a checkpoint folder. The folder is
+    emptied if it was written for a different key (inputs and options).
+    """
+    try:
+        with open(os.path.join(path, 'state.json')) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = None
+
+    if state is None or state.get('key') != key:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        state = {'key': key, 'transforms': []}
+        saveCheckpointState(path, state)
+
+    return state
+
+
+def saveCheckpointState(path, state):
+    fn = os.path.join(path, 'state.json')
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(fn + '.tmp', fn)
+
+
+def _getFileKey(fn):
+    if not fn:
+        return None
+    stat = os.stat(fn)
+
+    return [os.path.abspath(fn), stat.st_size, stat.st_mtime]
+
+
+def getSlabSize(boxSize, memory=0):
+    """ Return the number of z sections to process at once so that
+    the slab temporaries fit in a fraction of the memory budget (GB).
+    """
+    if not memory:
+        return SLAB_SIZE
+
+    slabs = memory * 1024 ** 3 / (4 * SLAB_BYTES_PER_VOXEL * boxSize ** 2)
+
+    return int(min(max(slabs, 1), boxSize))
+
+
+def isOutOfCore(boxSize, memory=0, ftType=np.complex128):
+    """ Check if the work arrays (two Fourier transforms of the given type
+    and the work volumes) do not fit in the memory budget (GB).
+    """
+    bytesPerVoxel = BYTES_PER_VOXEL + np.dtype(ftType).itemsize
+
+    return bool(memory) and boxSize ** 3 * bytesPerVoxel > memory * 1024 ** 3
+
+
+def _slabs(n, slabSize):
+    for z0 in range(0, n, slabSize):
+        yield z0, min(z0 + slabSize, n)
+
+
+def getDirections(dTheta):
+    """ Return unit vectors (in z, y, x order) sampling a half sphere
+    with a spacing of half the cone angle, so neighbouring cones overlap.
+    """
+    step = np.deg2rad(dTheta) / 2.
+    n = max(int(np.ceil(2 * np.pi / step ** 2)), 1)
+    golden = np.pi * (3. - np.sqrt(5.))
+    i = np.arange(n)
+    z = (i + 0.5) / n
+    rho = np.sqrt(1. - z ** 2)
+    phi = i * golden
+
+    return np.stack([z, rho * np.sin(phi), rho * np.cos(phi)], axis=1)
+
+
+def checkDirections(directions):
+    """ Raise ValueError if there are more directions than the cone ids
+    can hold (cone angles below about 1.1 degrees).
+    """
+    if len(directions) > MAX_DIRECTIONS:
+        raise ValueError("Cone angle is too small: %d directions, at most "
+                         "%d are supported." % (len(directions),
+                                                MAX_DIRECTIONS))
+
+
+def getSlabGrid(boxSize, z0, z1):
+    """ Return the voxels of the z0:z1 slab of a rfftn of a cubic box that
+    are inside the Nyquist sphere (as flat indexes into the slab), and
+    their shell index, unit vector and Friedel weight.
+    """
+    k = np.fft.fftfreq(boxSize) * boxSize
+    kx = np.fft.rfftfreq(boxSize) * boxSize
+    kz, ky, kx = np.meshgrid(k[z0:z1], k, kx, indexing='ij')
+    radius = np.sqrt(kz ** 2 + ky ** 2 + kx ** 2).ravel()
+    shells = np.rint(radius).astype(np.int32)
+
+    index = np.flatnonzero(shells <= boxSize // 2)
+    r = np.maximum(radius[index], 1.)
+    units = np.stack([kz.ravel()[index] / r,
+                      ky.ravel()[index] / r,
+                      kx.ravel()[index] / r], axis=1).astype(np.float32)
+
+    # voxels with 0 < kx < Nyquist stand also for their Friedel mates
+    ax = kx.ravel()[index]
+    weights = np.where((ax > 0) & (ax < boxSize / 2.), 2., 1.)
+
+    return index, shells[index], units, weights
+
+
+def rfftnSlabs(data, out, slabSize, mask=None):
+    """ Compute the rfftn of a (masked) cubic volume into out, which has
+    shape (n, n, n // 2 + 1). The transform is done in two passes (x, y
+    over z slabs and then z over y slabs), so data and out can be memory
+    maps larger than the available memory. The precision follows the
+    type of out.
+    """
+    n = data.shape[0]
+    realType = np.float32 if out.dtype == np.complex64 else np.float64
+    for z0, z1 in _slabs(n, slabSize):
+        slab = np.asarray(data[z0:z1], dtype=realType)
+        if mask is not None:
+            slab = slab * mask[z0:z1]
+        out[z0:z1] = np.fft.fft(np.fft.rfft(slab, axis=2), axis=1)
+
+    for y0, y1 in _slabs(n, slabSize):
+        out[:, y0:y1] = np.fft.fft(out[:, y0:y1], axis=0)
+
+    return out
+
+
+def _fscFromSums(num, den1, den2, empty=0.):
+    den = np.sqrt(den1 * den2)
+    fsc = np.full_like(num, empty)
+    np.divide(num, den, out=fsc, where=den > 0)
+
+    return fsc
+
+
+def getConeMembership(boxSize, directions, dTheta, z0=0, z1=None,
+                      chunkSize=CHUNK_SIZE, maxShell=None):
+    """ Return the Fourier grid of the z0:z1 slab (see getSlabGrid) and
+    every (voxel, direction) pair where the voxel is inside the cone of
+    the direction, as the position of the voxel in the grid and the
+    (direction, shell) bin. Only voxels up to maxShell are assigned to
+    cones if given.
+    """
+    z1 = boxSize if z1 is None else z1
+    nShells = boxSize // 2 + 1
+    cosHalf = np.cos(np.deg2rad(dTheta) / 2.)
+    dirs = np.asarray(directions, dtype=np.float32)
+    index, shells, units, weights = getSlabGrid(boxSize, z0, z1)
+    candidates = (np.arange(len(shells)) if maxShell is None
+                  else np.flatnonzero(shells <= maxShell))
+
+    voxels, bins = [np.empty(0, dtype=np.int32)], [np.empty(0, np.int32)]
+    for start in range(0, len(candidates), chunkSize):
+        chunk = candidates[start:start + chunkSize]
+        u = units[chunk]
+        # element-wise dot products give the same cone membership for a
+        # direction whatever the other directions computed along with it
+        cosines = (u[:, 0:1] * dirs[:, 0] + u[:, 1:2] * dirs[:, 1] +
+                   u[:, 2:3] * dirs[:, 2])
+        voxel, direction = np.nonzero(np.abs(cosines) >= cosHalf)
+        voxel = chunk[voxel].astype(np.int32)
+        voxels.append(voxel)
+        bins.append((direction * nShells + shells[voxel]).astype(np.int32))
+
+    return (index, shells, weights,
+            np.concatenate(voxels), np.concatenate(bins))
+
+
+def calcFSC(ft1, ft2, directions, dTheta, slabSize=SLAB_SIZE,
+            chunkSize=CHUNK_SIZE, geometry=None, directionIds=None,
+            maxShell=None, checkpoint=None, interval=CHECKPOINT_INTERVAL):
+    """ Return the global FSC and the conical FSC (nDirections x nShells)
+    of two rfftn volumes, accumulated with a bincount over the
+    (direction, shell) bins of every slab. The geometry of the box (see
+    getGeometry) can be given to reuse it, in which case directions are
+    the ones of the geometry with the given ids (all by default). If
+    maxShell is given, the conical FSC is only computed up to it. Shells
+    with no voxels inside a cone are set to NaN. If a checkpoint file is
+    given, the sums are saved there every interval seconds and the
+    accumulation continues from it if it exists.
+    """
+    boxSize = ft1.shape[0]
+    nShells = boxSize // 2 + 1
+    nBins = len(directions) * nShells
+    sums = np.zeros((3, nBins))
+    globalSums = np.zeros((3, nShells))
+    start = 0
+    if checkpoint and os.path.exists(checkpoint):
+        with np.load(checkpoint) as saved:
+            sums, globalSums = saved['sums'], saved['globalSums']
+            start = int(saved['next'])
+    lastSave = time.time()
+
+    for z0, z1 in _slabs(boxSize, slabSize):
+        if z0 < start:
+            continue
+        if geometry is None:
+            slabMembership = getConeMembership(boxSize, directions, dTheta,
+                                               z0, z1, chunkSize, maxShell)
+        else:
+            slabMembership = getSlabMembership(geometry, boxSize, z0, z1,
+                                               directionIds, maxShell)
+        index, shells, weights, voxels, bins = slabMembership
+        f1 = np.asarray(ft1[z0:z1]).ravel()[index]
+        f2 = np.asarray(ft2[z0:z1]).ravel()[index]
+        weights = weights.astype(f1.real.dtype)
+        products = (np.real(f1 * np.conj(f2)) * weights,
+                    np.abs(f1) ** 2 * weights,
+                    np.abs(f2) ** 2 * weights)
+        for i, w in enumerate(products):
+            globalSums[i] += np.bincount(shells, weights=w,
+                                         minlength=nShells)
+            sums[i] += np.bincount(bins, weights=w[voxels], minlength=nBins)
+        if checkpoint and z1 < boxSize and time.time() - lastSave > interval:
+            saveArrays(checkpoint, sums=sums, globalSums=globalSums, next=z1)
+            lastSave = time.time()
+
+    conicalFSC = _fscFromSums(*sums, empty=np.nan).reshape(len(directions),
+                                                           nShells)
+
+    return _fscFromSums(*globalSums), conicalFSC
+
+
+def _fscWorker(fn1, fn2, directions, dTheta, slabSize, geometryPath,
+               directionIds, maxShell, checkpoint, interval):
+    ft1 = np.load(fn1, mmap_mode='r')
+    ft2 = np.load(fn2, mmap_mode='r')
+    geometry = readGeometry(geometryPath) if geometryPath else None
+
+    return calcFSC(ft1, ft2, directions, dTheta, slabSize,
+                   geometry=geometry, directionIds=directionIds,
+                   maxShell=maxShell, checkpoint=checkpoint,
+                   interval=interval)
+
+
+def _getSumsFn(checkpoint, directionIds, nDirections, maxShell):
+    """ Return the checkpoint file of the FSC sums of a group of
+    directions, or None if there is no checkpoint folder.
+    """
+    if not checkpoint:
+        return None
+    ids = (np.arange(nDirections) if directionIds is None
+           else np.asarray(directionIds))
+    digest = hashlib.md5(ids.astype(np.int64).tobytes() +
+                         str(maxShell).encode()).hexdigest()
+
+    return os.path.join(checkpoint, 'sums_%s.npz' % digest[:16])
+
+
+def calcFSCParallel(ft1, ft2, directions, dTheta, workers, workDir,
+                    slabSize=SLAB_SIZE, geometryPath=None, directionIds=None,
+                    maxShell=None, checkpoint=None,
+                    interval=CHECKPOINT_INTERVAL):
+    """ Split the directions across worker processes and merge their
+    conical FSC. Every direction is computed exactly as in a single
+    process, so the merged result is identical. The workers read the
+    transforms from .npy files, which are written if needed, and the
+    geometry of the box from geometryPath if given (see writeGeometry
+    and calcFSC). With a checkpoint folder, the sums of each group of
+    directions are saved in their own file.
+    """
+    if workers < 2:
+        geometry = readGeometry(geometryPath) if geometryPath else None
+        return calcFSC(ft1, ft2, directions, dTheta, slabSize,
+                       geometry=geometry, directionIds=directionIds,
+                       maxShell=maxShell,
+                       checkpoint=_getSumsFn(checkpoint, directionIds,
+                                             len(directions), maxShell),
+                       interval=interval)
+
+    with tempfile.TemporaryDirectory(dir=workDir) as tmpDir:
+        files = []
+        for i, ft in enumerate([ft1, ft2]):
+            fn = getattr(ft, 'filename', None)
+            if fn is None:
+                fn = os.path.join(tmpDir, 'ft%d.npy' % (i + 1))
+                np.save(fn, ft)
+            else:
+                ft.flush()
+            files.append(fn)
+
+        if directionIds is None:
+            directionIds = np.arange(len(directions))
+        parts = np.array_split(np.arange(len(directions)),
+                               min(workers, len(directions)))
+        n = len(parts)
+        checkpoints = [_getSumsFn(checkpoint, directionIds[p], len(p),
+                                  maxShell) for p in parts]
+        with getProcessPool(n) as pool:
+            results = list(pool.map(_fscWorker, [files[0]] * n,
+                                    [files[1]] * n,
+                                    [directions[p] for p in parts],
+                                    [dTheta] * n, [slabSize] * n,
+                                    [geometryPath] * n,
+                                    [directionIds[p] for p in parts],
+                                    [maxShell] * n, checkpoints,
+                                    [interval] * n))
+
+    return results[0][0], np.concatenate([r[1] for r in results])
+
+
+def getCoarseDirectionIds(directions, dTheta):
+    """ Return the ids of the directions nearest to a sampling with twice
+    the spacing.
+    """
+    cosines = np.abs(getDirections(2 * dTheta) @ np.asarray(directions).T)
+
+    return np.unique(np.argmax(cosines, axis=1))
+
+
+def calcFSCAdaptive(ft1, ft2, directions, dTheta, cutoff, workers, workDir,
+                    slabSize=SLAB_SIZE, geometryPath=None,
+                    margin=ADAPTIVE_MARGIN, tolerance=ADAPTIVE_TOLERANCE,
+                    hpShell=0, checkpoint=None, interval=CHECKPOINT_INTERVAL):
+    """ Compute the conical FSC of a subset of the directions. A coarse
+    subset with twice the spacing is computed up to Nyquist. Then only
+    the directions close to coarse ones whose cutoff crossing differs
+    from a neighbour by more than a fraction tolerance are computed, and
+    only up to margin shells beyond the last coarse crossing. The other
+    directions and shells take the FSC of the nearest coarse direction.
+    Directions that do not cross the cutoff before the last computed
+    shells are computed again up to Nyquist. Return the global and
+    conical FSC and the number of directions computed. The checkpoint
+    folder is passed to calcFSCParallel.
+    """
+    directions = np.asarray(directions)
+    nShells = ft1.shape[0] // 2 + 1
+    coarseIds = getCoarseDirectionIds(directions, dTheta)
+    coarse = directions[coarseIds]
+    globalFSC, coarseFSC = calcFSCParallel(ft1, ft2, coarse, dTheta, workers,
+                                           workDir, slabSize, geometryPath,
+                                           coarseIds, None, checkpoint,
+                                           interval)
+    coarseFSC = np.where(np.isnan(coarseFSC), globalFSC, coarseFSC)
+    crossing = getCrossingShells(coarseFSC, cutoff, hpShell)
+
+    # coarse directions whose crossing disagrees with a neighbour
+    neighbours = np.abs(coarse @ coarse.T) >= np.cos(np.deg2rad(1.5 * dTheta))
+    disagree = (np.abs(crossing[:, None] - crossing[None, :]) >
+                tolerance * np.maximum(crossing[:, None], crossing[None, :]))
+    flagged = (neighbours & disagree).any(axis=1)
+
+    cosines = np.abs(directions @ coarse.T)
+    conicalFSC = coarseFSC[np.argmax(cosines, axis=1)]
+    conicalFSC[coarseIds] = coarseFSC
+    refine = (cosines[:, flagged] >= np.cos(np.deg2rad(dTheta))).any(axis=1)
+    refine[coarseIds] = False
+    refineIds = np.flatnonzero(refine)
+
+    shells = min(int(crossing.max()) + margin, nShells - 1)
+    while len(refineIds):
+        _, fineFSC = calcFSCParallel(ft1, ft2, directions[refineIds], dTheta,
+                                     workers, workDir, slabSize, geometryPath,
+                                     refineIds, shells, checkpoint, interval)
+        fill = np.where(np.arange(nShells) > shells,
+                        conicalFSC[refineIds], globalFSC)
+        conicalFSC[refineIds] = np.where(np.isnan(fineFSC), fill, fineFSC)
+        if shells == nShells - 1:
+            break
+        # the 3D FSC volume interpolates the shells next to the crossing
+        late = getCrossingShells(fineFSC[:, :shells + 1], cutoff,
+                                 hpShell) > shells - 2
+        refineIds, shells = refineIds[late], nShells - 1
+
+    return globalFSC, conicalFSC, len(coarseIds) + np.count_nonzero(refine)
+
+
+def _iterGeometry(boxSize, directions, dTheta, slabSize, chunkSize):
+    """ Yield the geometry of every slab, with indexes into the whole box
+    (see getGeometry).
+    """
+    checkDirections(directions)
+    nShells = boxSize // 2 + 1
+    sliceSize = boxSize * nShells  # rfftn voxels of a z section
+    offset = 0
+    for z0, z1 in _slabs(boxSize, slabSize):
+        index, shells, _, voxels, bins = getConeMembership(
+            boxSize, directions, dTheta, z0, z1, chunkSize)
+        yield {'index': (index + z0 * sliceSize).astype(np.int32),
+               'shells': shells.astype(np.uint16),
+               'voxels': (voxels + offset).astype(np.int32),
+               'cones': (bins // nShells).astype(np.uint16),
+               'nearest': getNearestDirections(boxSize, directions, z0, z1,
+                                               chunkSize)}
+        offset += len(index)
+
+
+def getGeometry(boxSize, directions, dTheta, slabSize=SLAB_SIZE,
+                chunkSize=CHUNK_SIZE):
+    """ Return the geometry of a box, which only depends on the box size
+    and the cone directions, as a dictionary of arrays:
+        index: Fourier voxels inside the Nyquist sphere, as flat indexes
+            into the rfftn of the box.
+        shells: shell of every Fourier voxel.
+        voxels, cones: every (voxel, direction) pair where the voxel is
+            inside the cone of the direction, sorted by voxel. Voxels are
+            positions in index.
+        nearest: nearest direction of every voxel of the 3D FSC volume.
+    """
+    slabs = list(_iterGeometry(boxSize, directions, dTheta, slabSize,
+                               chunkSize))
+
+    return {key: np.concatenate([s[key] for s in slabs])
+            for key in GEOMETRY_DTYPES}
+
+
+def writeGeometry(path, boxSize, directions, dTheta, slabSize=SLAB_SIZE,
+                  chunkSize=CHUNK_SIZE):
+    """ Write the geometry of a box (see getGeometry) into the folder path,
+    one raw file per array, slab by slab.
+    """
+    os.makedirs(path, exist_ok=True)
+    files = {key: open(os.path.join(path, key + '.raw'), 'wb')
+             for key in GEOMETRY_DTYPES}
+    try:
+        for slab in _iterGeometry(boxSize, directions, dTheta, slabSize,
+                                  chunkSize):
+            for key, f in files.items():
+                f.write(slab[key].tobytes())
+    finally:
+        for f in files.values():
+            f.close()
+
+
+def readGeometry(path):
+    """ Return the geometry written by writeGeometry as memory maps. """
+    geometry = {}
+    for key, dtype in GEOMETRY_DTYPES.items():
+        fn = os.path.join(path, key + '.raw')
+        if os.path.getsize(fn):
+            geometry[key] = np.memmap(fn, dtype=dtype, mode='r')
+        else:
+            geometry[key] = np.empty(0, dtype=dtype)
+
+    return geometry
+
+
+def getSlabMembership(geometry, boxSize, z0, z1, directionIds=None,
+                      maxShell=None):
+    """ Return the cone membership of the z0:z1 slab from the geometry of
+    the box, as getConeMembership does, for the directions with the given
+    ids (all by default) and up to maxShell if given.
+    """
+    nShells = boxSize // 2 + 1
+    sliceSize = boxSize * nShells
+    index = geometry['index']
+    start, end = np.searchsorted(index, [z0 * sliceSize, z1 * sliceSize])
+    slabIndex = np.asarray(index[start:end]) - z0 * sliceSize
+    shells = np.asarray(geometry['shells'][start:end], dtype=np.int32)
+    ax = slabIndex % nShells
+    weights = np.where((ax > 0) & (ax < boxSize / 2.), 2., 1.)
+
+    pStart, pEnd = np.searchsorted(geometry['voxels'], [start, end])
+    voxels = np.asarray(geometry['voxels'][pStart:pEnd]) - start
+    cones = np.asarray(geometry['cones'][pStart:pEnd], dtype=np.int32)
+    if maxShell is not None:
+        keep = shells[voxels] <= maxShell
+        voxels, cones = voxels[keep], cones[keep]
+    if directionIds is not None:
+        # position of every geometry direction in directionIds, or -1
+        positions = np.full(max(cones.max(initial=0),
+                                np.max(directionIds, initial=0)) + 1, -1)
+        positions[directionIds] = np.arange(len(directionIds))
+        cones = positions[cones]
+        keep = cones >= 0
+        voxels, cones = voxels[keep], cones[keep]
+
+    return slabIndex, shells, weights, voxels, cones * nShells + shells[voxels]
+
+
+def _getCenteredGrid(boxSize, z0, z1):
+    """ Return the coordinates of the z0:z1 slab of a centered box. """
+    coords = np.arange(boxSize, dtype=np.float32) - boxSize // 2
+
+    return np.stack(np.meshgrid(coords[z0:z1], coords, coords,
+                                indexing='ij'), axis=-1).reshape(-1, 3)
+
+
+def getNearestDirections(boxSize, directions, z0=0, z1=None,
+                         chunkSize=CHUNK_SIZE):
+    """ Return the nearest direction of every voxel of the z0:z1 slab of
+    the centered 3D FSC volume.
+    """
+    checkDirections(directions)
+    z1 = boxSize if z1 is None else z1
+    dirs = np.asarray(directions, dtype=np.float32).T
+    k = _getCenteredGrid(boxSize, z0, z1)
+
+    nearest = np.empty(len(k), dtype=np.uint16)
+    for start in range(0, len(k), chunkSize):
+        kc = k[start:start + chunkSize]
+        nearest[start:start + len(kc)] = np.argmax(np.abs(kc @ dirs), axis=1)
+
+    return nearest
+
+
+def getVolumeGeometry(boxSize, directions, z0=0, z1=None,
+                      chunkSize=CHUNK_SIZE, nearest=None):
+    """ Return, for every voxel of the z0:z1 slab of the centered 3D FSC
+    volume, the index of its nearest direction and lower shell in the
+    flattened conical FSC, the interpolation weight of the next shell and
+    whether it is inside the last shell. The nearest directions of the
+    slab are computed if not given.
+    """
+    z1 = boxSize if z1 is None else z1
+    nShells = boxSize // 2 + 1
+    if nearest is None:
+        nearest = getNearestDirections(boxSize, directions, z0, z1, chunkSize)
+    radius = np.sqrt((_getCenteredGrid(boxSize, z0, z1) ** 2).sum(axis=1))
+    s0 = np.minimum(np.floor(radius), nShells - 2).astype(np.int32)
+
+    return (nearest.astype(np.int32) * nShells + s0, radius - s0,
+            radius < nShells - 1)
+
+
+def buildVolume(conicalFSC, directions, out, slabSize=SLAB_SIZE,
+                chunkSize=CHUNK_SIZE, geometry=None):
+    """ Fill out with the centered 3D FSC volume. Each voxel takes the
+    conical FSC of its nearest direction, linearly interpolated between
+    shells. The nearest directions are read from the geometry of the box
+    if given (see getGeometry).
+    """
+    boxSize = out.shape[0]
+    center = boxSize // 2
+    flat = np.asarray(conicalFSC, dtype=np.float32).ravel()
+    sliceSize = boxSize ** 2
+
+    for z0, z1 in _slabs(boxSize, slabSize):
+        nearest = None
+        if geometry is not None:
+            nearest = geometry['nearest'][z0 * sliceSize:z1 * sliceSize]
+        lower, t, inside = getVolumeGeometry(boxSize, directions, z0, z1,
+                                             chunkSize, nearest)
+        values = (1 - t) * flat[lower] + t * flat[lower + 1]
+        values[~inside] = 0.
+        out[z0:z1] = values.reshape(z1 - z0, boxSize, boxSize)
+
+    out[center, center, center] = 1.
+
+    return out
+
+
+def _getSquaredRadius(shape):
+    """ Return the squared distance to the center of a grid. """
+    coords = [np.arange(n, dtype=np.float32) - n // 2 for n in shape]
+
+    return sum(c ** 2 for c in np.meshgrid(*coords, indexing='ij'))
+
+
+def getPathMinimum(vol, out=None, hpRadius=0.):
+    """ Return the minimum of the volume along the path from every voxel
+    to the center, where each step moves one voxel towards the center
+    along every axis. Voxels closer to the center than hpRadius always
+    pass (count as +inf). The path of a voxel in section z goes through
+    section z -/+ 1, so sections are processed outwards from the center
+    and vol/out can be memory maps.
+    """
+    n = vol.shape[0]
+    center = n // 2
+    out = np.empty(vol.shape, dtype=np.float32) if out is None else out
+    r2 = _getSquaredRadius(vol.shape[1:])
+    steps = [np.arange(m) - np.sign(np.arange(m) - m // 2)
+             for m in vol.shape[1:]]
+    parents = np.ix_(*steps)
+
+    def _values(z):
+        values = np.asarray(vol[z], dtype=np.float32)
+        if hpRadius > 0:
+            values = np.where(r2 + (z - center) ** 2 < hpRadius ** 2,
+                              np.inf, values)
+        return values
+
+    if vol.ndim == 1:
+        out[center] = _values(center)
+    else:
+        getPathMinimum(_values(center), out[center])
+    for z in range(center + 1, n):
+        out[z] = np.minimum(_values(z), out[z - 1][parents])
+    for z in range(center - 1, -1, -1):
+        out[z] = np.minimum(_values(z), out[z + 1][parents])
+
+    return out
+
+
+def getRadius(boxSize):
+    """ Return the distance of every voxel to the center of the box. """
+    return np.sqrt(_getSquaredRadius((boxSize,) * 3))
+
+
+def getFilteredPathMinimum(vol, apix, hpFilter, out=None):
+    """ Return the path minimum of the 3D FSC volume, with the shells
+    below the high-pass filter always passing.
+    """
+    return getPathMinimum(vol, out, hpRadius=vol.shape[0] * apix / hpFilter)
+
+
+def thresholdVolume(vol, apix, fscCutoff, thrSph, hpFilter,
+                    thresholded=None, binarized=None, mins=None,
+                    slabSize=SLAB_SIZE):
+    """ Threshold the 3D FSC volume. A voxel is kept only if the 3D FSC
+    stays above the cutoff on its way to the center; the shells below the
+    high-pass filter always pass. Return thresholded and binarized volumes.
+    Output and work arrays are allocated in memory if not given.
+    """
+    mins = getFilteredPathMinimum(vol, apix, hpFilter, mins)
+    if thresholded is None:
+        thresholded = np.empty(vol.shape, dtype=np.float32)
+    if binarized is None:
+        binarized = np.empty(vol.shape, dtype=np.float32)
+
+    for z0, z1 in _slabs(vol.shape[0], slabSize):
+        slabMins = mins[z0:z1]
+        thresholded[z0:z1] = np.where(slabMins >= fscCutoff, vol[z0:z1], 0.)
+        binarized[z0:z1] = slabMins >= thrSph
+
+    return thresholded, binarized
+
+
+def calcSphericity(vol, threshold=0.5, slabSize=SLAB_SIZE):
+    """ Return the sphericity of the region vol >= threshold, using the
+    gradient magnitude of the binary volume (central differences, zero
+    outside) as the estimate of its surface area.
+    """
+    n = vol.shape[0]
+    volume, area = 0., 0.
+    for z0, z1 in _slabs(n + 2, slabSize):
+        # padded sections z0-1:z1-1 plus one section of halo on each side
+        block = np.zeros((z1 - z0 + 2, vol.shape[1] + 4, vol.shape[2] + 4),
+                         dtype=np.float32)
+        lo, hi = max(z0 - 2, 0), min(z1, n)
+        if lo < hi:
+            block[lo - z0 + 2:hi - z0 + 2, 2:-2, 2:-2] = vol[lo:hi] >= threshold
+        core = block[1:-1, 1:-1, 1:-1]
+        gz = (block[2:, 1:-1, 1:-1] - block[:-2, 1:-1, 1:-1]) / 2.
+        gy = (block[1:-1, 2:, 1:-1] - block[1:-1, :-2, 1:-1]) / 2.
+        gx = (block[1:-1, 1:-1, 2:] - block[1:-1, 1:-1, :-2]) / 2.
+        volume += core.sum()
+        area += np.sqrt(gz ** 2 + gy ** 2 + gx ** 2).sum()
+
+    if area == 0:
+        return 0.
+
+    return float(np.pi ** (1 / 3.) * (6 * volume) ** (2 / 3.) / area)
+
+
+def getResolutionRange(mins, cutoff, apix, slabSize=SLAB_SIZE):
+    """ Return the worst and best directional resolution (A) of the region
+    where the path minimum is above the cutoff: the closest excluded voxel
+    and the farthest kept voxel inside the Nyquist sphere.
+    """
+    boxSize = mins.shape[0]
+    nyquist = boxSize // 2
+    r2 = _getSquaredRadius(mins.shape[1:])
+    rMin, rMax = float(nyquist), 1.
+    for z0, z1 in _slabs(boxSize, slabSize):
+        dz = np.arange(z0, z1)[:, None, None] - nyquist
+        radius = np.sqrt(r2[None] + dz ** 2)
+        inside = radius <= nyquist
+        kept = np.asarray(mins[z0:z1]) >= cutoff
+        excluded = radius[inside & ~kept]
+        included = radius[inside & kept]
+        if excluded.size:
+            rMin = min(rMin, excluded.min())
+        if included.size:
+            rMax = max(rMax, included.max())
+
+    return boxSize * apix / max(rMin, 1.), boxSize * apix / max(rMax, 1.)
+
+
+def sweepThresholds(vol, apix, fscCutoffs, thresholds, hpFilters,
+                    mins=None, slabSize=SLAB_SIZE):
+    """ Evaluate several thresholds on a single 3D FSC volume. The path
+    minimum is computed once per high-pass filter, then each threshold is
+    only a comparison against it. Return the sphericity for every
+    (hpFilter, threshold) pair and the worst/best directional resolution
+    for every (hpFilter, fscCutoff) pair.
+    """
+    sphericity = np.zeros((len(hpFilters), len(thresholds)))
+    resolution = np.zeros((len(hpFilters), len(fscCutoffs), 2))
+
+    for i, hpFilter in enumerate(hpFilters):
+        mins = getFilteredPathMinimum(vol, apix, hpFilter, mins)
+        for j, thr in enumerate(thresholds):
+            sphericity[i, j] = calcSphericity(mins, thr, slabSize)
+        for j, cutoff in enumerate(fscCutoffs):
+            resolution[i, j] = getResolutionRange(mins, cutoff, apix,
+                                                  slabSize)
+
+    return sphericity, resolution
+
+
+def writeDirectionalFSC(fn, directions, freqs, fsc):
+    """ Save the FSC of every direction (nDirections x nShells). """
+    np.savez_compressed(fn, directions=directions.astype(np.float32),
+                        freqs=freqs, fsc=fsc.astype(np.float32))
+
+
+def getCrossingShells(fsc, cutoff, hpShell=0):
+    """ Return the first shell (beyond the high-pass filter) where each
+    FSC curve drops below the cutoff. Curves that never cross return the
+    last shell.
+    """
+    fsc = np.atleast_2d(fsc)
+    below = fsc < cutoff
+    below[:, :max(int(hpShell), 1)] = False
+    crossing = np.where(below.any(axis=1), np.argmax(below, axis=1),
+                        fsc.shape[1] - 1)
+
+    return np.maximum(crossing, 1)
+
+
+def calcRadialPower(ft, slabSize=SLAB_SIZE):
+    """ Return the rotationally averaged power of a rfftn volume. """
+    boxSize = ft.shape[0]
+    nShells = boxSize // 2 + 1
+    power = np.zeros(nShells)
+    counts = np.zeros(nShells)
+    for z0, z1 in _slabs(boxSize, slabSize):
+        index, shells, _, weights = getSlabGrid(boxSize, z0, z1)
+        f = np.asarray(ft[z0:z1]).ravel()[index]
+        power += np.bincount(shells, weights=np.abs(f) ** 2 * weights,
+                             minlength=nShells)
+        counts += np.bincount(shells, weights=weights, minlength=nShells)
+
+    return power / np.maximum(counts, 1)
+
+
+def calcMapPower(fn, slabSize=SLAB_SIZE, workDir=None, ftType=np.complex128):
+    """ Return the rotationally averaged power of a cubic MRC map. """
+    data = openMap(fn)
+    boxSize = data.shape[0]
+    ft = rfftnSlabs(data, newArray((boxSize, boxSize, boxSize // 2 + 1),
+                                   ftType, workDir, 'ftmap'),
+                    slabSize)
+
+    return calcRadialPower(ft, slabSize)
+
+
+def binMap(data, factor, slabSize=SLAB_SIZE):
+    """ Return a copy of a cubic map binned by an integer factor, read in
+    slabs. The box is trimmed to a multiple of the factor.
+    """
+    n = data.shape[0] // factor
+    binned = np.empty((n,) * 3, dtype=np.float64)
+    step = max(slabSize // factor, 1)
+    for z0, z1 in _slabs(n, step):
+        slab = np.asarray(data[z0 * factor:z1 * factor, :n * factor,
+                               :n * factor], dtype=np.float64)
+        binned[z0:z1] = slab.reshape(z1 - z0, factor, n, factor,
+                                     n, factor).mean(axis=(1, 3, 5))
+
+    return binned
+
+
+def checkPrecision(half1, half2, mask, apix, dTheta, fscCutoff, thrSph,
+                   hpFilter, size=PRECISION_CHECK_SIZE):
+    """ Compute the 3D FSC of a binned copy of the half maps in single
+    and double precision. Return the largest difference of the global
+    FSC, and the global resolution and sphericity of both, as a
+    dictionary of (single, double) pairs.
+    """
+    factor = max(half1.shape[0] // size, 1)
+    maps = [binMap(m, factor) for m in (half1, half2)]
+    if mask is not None:
+        binnedMask = binMap(mask, factor)
+        maps = [m * binnedMask for m in maps]
+    n = maps[0].shape[0]
+    apix = apix * factor
+    directions = getDirections(dTheta)
+    hpShell = n * apix / hpFilter
+
+    results = {'fsc': [], 'resolution': [], 'sphericity': []}
+    for ftType in (np.complex64, np.complex128):
+        realType = np.float32 if ftType == np.complex64 else np.float64
+        ft1, ft2 = [np.fft.rfftn(m.astype(realType)).astype(ftType)
+                    for m in maps]
+        globalFSC, conicalFSC = calcFSC(ft1, ft2, directions, dTheta,
+                                        slabSize=n)
+        conicalFSC = np.where(np.isnan(conicalFSC), globalFSC, conicalFSC)
+        vol = buildVolume(conicalFSC, directions,
+                          np.empty((n,) * 3, dtype=np.float32), slabSize=n)
+        _, binarized = thresholdVolume(vol, apix, fscCutoff, thrSph,
+                                       hpFilter, slabSize=n)
+        crossing = getCrossingShells(globalFSC, fscCutoff, hpShell)[0]
+        results['fsc'].append(globalFSC)
+        results['resolution'].append(n * apix / crossing)
+        results['sphericity'].append(calcSphericity(binarized, slabSize=n))
+
+    results['fsc'] = np.abs(results['fsc'][0] - results['fsc'][1]).max()
+
+    return results
+
+
+def _plotResults(resultsDir, name, freqs, globalFSC, conicalFSC,
+                 resolutions, radialPower):
+    """ Create the histogram and plots produced by 3DFSC. """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    def _save(fig, fn):
+        FigureCanvasAgg(fig)
+        fig.savefig(os.path.join(resultsDir, fn), dpi=100)
+
+    fig = Figure(figsize=(8, 6))
+    ax = fig.add_subplot(111)
+    ax.hist(resolutions, bins=30, color='#1f77b4')
+    ax.set_xlabel('Directional resolution (A)')
+    ax.set_ylabel('Number of directions')
+    _save(fig, 'histogram.png')
+
+    fig = Figure(figsize=(10, 6))
+    ax = fig.add_subplot(111)
+    mean, std = conicalFSC.mean(axis=0), conicalFSC.std(axis=0)
+    ax.plot(freqs, globalFSC, 'k', label='Global FSC')
+    ax.fill_between(freqs, mean - std, mean + std, color='#9ecae1',
+                    label='Directional FSC (mean +/- sd)')
+    ax.set_xlabel('Spatial frequency (1/A)')
+    ax.set_ylabel('FSC')
+    ax.set_ylim(-0.1, 1.05)
+    ax.legend()
+    _save(fig, 'Plots%s.jpg' % name)
+
+    if radialPower is not None:
+        writeMapPowerPlot(os.path.join(resultsDir, 'FTPlot%s.jpg' % name),
+                          freqs, radialPower)
+
+
+def writeMapPowerPlot(fn, freqs, radialPower):
+    """ Plot the rotationally averaged power of a map as 3DFSC does. """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(10, 6))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.semilogy(freqs[1:], np.maximum(radialPower[1:], 1e-12))
+    ax.set_xlabel('Spatial frequency (1/A)')
+    ax.set_ylabel('Power')
+    fig.savefig(fn, dpi=100)
+
+
+def run3DFSC(halfmap1, halfmap2, fullmap, apix, ThreeDFSC='vol',
+             dthetaInDegrees=20., FSCCutoff=0.143,
+             ThresholdForSphericity=0.5, HighPassFilter=200.,
+             numThresholdsForSphericityCalcs=0, mask=None, histogram=None,
+             workers=1, memory=0, geometry=None, adaptive=False,
+             adaptiveMargin=ADAPTIVE_MARGIN,
+             adaptiveTolerance=ADAPTIVE_TOLERANCE, precision='double',
+             precisionTolerance=PRECISION_TOLERANCE, checkpoint=None,
+             checkpointInterval=CHECKPOINT_INTERVAL, cwd=None, log=None):
+    """ Compute the 3D FSC and write the results into Results_<ThreeDFSC>.
+    Argument names follow ThreeDFSC_Start.py. The cone directions are
+    split across the given number of worker processes. If the work arrays
+    do not fit in the memory budget (GB, 0 for no limit), they are kept
+    on disk. The geometry of the box can be read from a folder written by
+    writeGeometry for the same box size and cone angle. With adaptive,
+    only part of the directions and shells are computed (see
+    calcFSCAdaptive). With single precision, the Fourier transforms and
+    correlations use complex64, and a binned copy of the maps is computed
+    in both precisions first to warn if the global resolution (relative)
+    or the sphericity change by more than precisionTolerance. With a
+    checkpoint folder, the transforms, the FSC sums (every
+    checkpointInterval seconds) and the FSC are saved there, and a run
+    with the same inputs and options continues from them. The folder is
+    removed when the run finishes. Messages are written to the log file
+    object, the standard output by default. Return the sphericity.
+    """
+    cwd = cwd or os.getcwd()
+    log = log or sys.stdout
+    _print = lambda *args, **kwargs: print(*args, file=log, **kwargs)
+    _path = lambda fn: os.path.join(cwd, fn)
+    apix = float(apix)
+    dTheta = float(dthetaInDegrees)
+    fscCutoff = float(FSCCutoff)
+    thrSph = float(ThresholdForSphericity)
+    hpFilter = float(HighPassFilter)
+    numThr = int(numThresholdsForSphericityCalcs)
+    memory = float(memory or 0)
+    resultsDir = _path('Results_%s' % ThreeDFSC)
+    _result = lambda suffix: os.path.join(resultsDir, ThreeDFSC + suffix)
+    os.makedirs(resultsDir, exist_ok=True)
+
+    half1 = openMap(_path(halfmap1))
+    half2 = openMap(_path(halfmap2))
+    if half1.shape != half2.shape or len(set(half1.shape)) != 1:
+        raise ValueError("Half maps must be cubic and of the same size.")
+    maskData = openMap(_path(mask)) if mask else None
+
+    boxSize = half1.shape[0]
+    nShells = boxSize // 2 + 1
+    freqs = np.arange(nShells) / (boxSize * apix)
+    ftShape = (boxSize, boxSize, boxSize // 2 + 1)
+    slabSize = getSlabSize(boxSize, memory)
+    geometryPath = _path(geometry) if geometry else None
+    ftType = PRECISIONS[precision]
+    checkpointPath = _path(checkpoint) if checkpoint else None
+    state = None
+    if checkpointPath:
+        key = {'inputs': [_getFileKey(_path(fn)) if fn else None
+                          for fn in (halfmap1, halfmap2, mask)],
+               'options': [dTheta, slabSize, precision, bool(adaptive),
+                           int(adaptiveMargin), float(adaptiveTolerance),
+                           fscCutoff, thrSph, hpFilter, numThr]}
+        state = openCheckpoint(checkpointPath, key)
+        fscFn = os.path.join(checkpointPath, 'fsc.npz')
+
+    with tempfile.TemporaryDirectory(dir=resultsDir) as tmpDir:
+        workDir = tmpDir if isOutOfCore(boxSize, memory, ftType) else None
+        phases = PhaseLogger(log)
+        if ftType == np.complex64:
+            phases.start(0, "Checking single precision on a binned copy")
+            check = checkPrecision(half1, half2, maskData, apix, dTheta,
+                                   fscCutoff, thrSph, hpFilter)
+            _print("Precision check: global FSC difference %.2e, resolution "
+                   "%0.2f / %0.2f A, sphericity %0.4f / %0.4f (single / "
+                   "double)" % (check['fsc'], *check['resolution'],
+                                *check['sphericity']))
+            resolution = check['resolution']
+            sphericity = check['sphericity']
+            if (abs(resolution[0] - resolution[1]) >
+                    precisionTolerance * resolution[1] or
+                    abs(sphericity[0] - sphericity[1]) > precisionTolerance):
+                _print("%s by more than %s, consider double precision"
+                       % (PRECISION_WARNING, precisionTolerance))
+
+        directions = getDirections(dTheta)
+        if state is not None and os.path.exists(fscFn):
+            _print("Resuming from checkpoint %s: FSC already computed"
+                   % checkpoint)
+            with np.load(fscFn) as saved:
+                globalFSC, conicalFSC = saved['globalFSC'], saved['conicalFSC']
+        else:
+            phases.start(1, "Calculating Fourier transforms of %d-voxel box%s"
+                         % (boxSize, ' (out of core)' if workDir else ''))
+            fts = []
+            for name, data in [('ft1', half1), ('ft2', half2)]:
+                if state is not None and name in state['transforms']:
+                    _print("Resuming from checkpoint %s: reading %s"
+                           % (checkpoint, name))
+                    fts.append(np.load(os.path.join(checkpointPath,
+                                                    name + '.npy'),
+                                       mmap_mode='r+'))
+                    continue
+                ft = rfftnSlabs(data, newArray(ftShape, ftType,
+                                               checkpointPath or workDir,
+                                               name), slabSize, maskData)
+                if state is not None:
+                    ft.flush()
+                    state['transforms'].append(name)
+                    saveCheckpointState(checkpointPath, state)
+                fts.append(ft)
+            ft1, ft2 = fts
+
+            workers = int(workers)
+            interval = float(checkpointInterval)
+            phases.start(2, "Calculating FSC for %d directions with %d "
+                         "worker(s)" % (len(directions), workers))
+            if adaptive:
+                # the binarized volume and the sphericity sweep may use
+                # thresholds below the FSC cutoff
+                cutoff = min(fscCutoff, thrSph, 1. / (numThr + 1) if numThr
+                             else fscCutoff)
+                globalFSC, conicalFSC, computed = calcFSCAdaptive(
+                    ft1, ft2, directions, dTheta, cutoff, workers, tmpDir,
+                    slabSize, geometryPath, int(adaptiveMargin),
+                    float(adaptiveTolerance), boxSize * apix / hpFilter,
+                    checkpointPath, interval)
+                _print("Adaptive sampling computed %d of %d directions"
+                       % (computed, len(directions)))
+            else:
+                globalFSC, conicalFSC = calcFSCParallel(
+                    ft1, ft2, directions, dTheta, workers, tmpDir, slabSize,
+                    geometryPath, checkpoint=checkpointPath,
+                    interval=interval)
+            del ft1, ft2, fts
+            if state is not None:
+                saveArrays(fscFn, globalFSC=globalFSC, conicalFSC=conicalFSC)
+        # small low-resolution shells may have no voxels inside narrow cones
+        conicalFSC = np.where(np.isnan(conicalFSC), globalFSC, conicalFSC)
+
+        phases.start(3, "Writing 3D FSC volume")
+        volMrc = newMap(_result('.mrc'), (boxSize,) * 3, apix)
+        vol = buildVolume(conicalFSC, directions, volMrc.data, slabSize,
+                          geometry=readGeometry(geometryPath)
+                          if geometryPath else None)
+
+        with open(os.path.join(resultsDir, 'ResEM%sOutglobalFSC.csv'
+                               % ThreeDFSC), 'w') as f:
+            f.write('SpatialFrequency,FSC\n')
+            for freq, value in zip(freqs, globalFSC):
+                f.write('%f,%f\n' % (freq, value))
+        writeDirectionalFSC(os.path.join(resultsDir, 'ResEM%sOutDirectional'
+                                         'FSC.npz' % ThreeDFSC),
+                            directions, freqs, conicalFSC)
+
+        phases.start(4, "Thresholding and binarizing 3D FSC volume")
+        mins = newArray((boxSize,) * 3, np.float32, workDir, 'mins')
+        thMrc = newMap(_result('_Thresholded.mrc'), (boxSize,) * 3, apix)
+        binMrc = newMap(_result('_ThresholdedBinarized.mrc'),
+                        (boxSize,) * 3, apix)
+        thresholdVolume(vol, apix, fscCutoff, thrSph, hpFilter,
+                        thMrc.data, binMrc.data, mins, slabSize)
+        closeMap(thMrc)
+
+        hpShell = boxSize * apix / hpFilter
+        globalRes = boxSize * apix / getCrossingShells(globalFSC, fscCutoff,
+                                                       hpShell)[0]
+        resolutions = boxSize * apix / getCrossingShells(conicalFSC,
+                                                         fscCutoff, hpShell)
+        sphericity = calcSphericity(binMrc.data, slabSize=slabSize)
+        closeMap(binMrc)
+        _print("Global resolution at FSC of %s is %0.2f Angstrom"
+               % (fscCutoff, globalRes))
+        _print("Minimum directional resolution is %0.2f Angstrom"
+               % resolutions.max())
+        _print("Maximum directional resolution is %0.2f Angstrom"
+               % resolutions.min())
+        _print("Sphericity is %0.4f out of 1. 1 represents a perfect sphere."
+               % sphericity)
+
+        if numThr > 0:
+            thresholds = np.linspace(0, 1, numThr + 2)[1:-1]
+            sphericities, _ = sweepThresholds(vol, apix, [], thresholds,
+                                              [hpFilter], mins, slabSize)
+            for thr, sph in zip(thresholds, sphericities[0]):
+                _print("Sphericity at threshold %0.3f is %0.4f" % (thr, sph))
+        closeMap(volMrc)
+        del vol, mins
+
+        if histogram:
+            phases.start(5, "Plotting")
+            radialPower = None
+            if fullmap:
+                radialPower = calcMapPower(_path(fullmap), slabSize, workDir,
+                                           ftType)
+            _plotResults(resultsDir, ThreeDFSC, freqs, globalFSC, conicalFSC,
+                         resolutions, radialPower)
+
+    phases.stop()
+    if checkpointPath:
+        shutil.rmtree(checkpointPath, ignore_errors=True)
+    _print("3D FSC done.", flush=True)
+
+    return sphericity
+
+
+def runFromArgs(args, cwd=None, **kwargs):
+    """ Run the engine with the arguments dictionary used to launch
+    ThreeDFSC_Start.py, e.g. {'--halfmap1': 'h1.mrc', ...}. The full map
+    is optional. Extra keyword arguments are passed to run3DFSC.
+    """
+    kwargs.setdefault('fullmap', None)
+    kwargs.update({k.lstrip('-'): v for k, v in args.items()})
+
+    return run3DFSC(cwd=cwd, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    for arg in ['halfmap1', 'halfmap2', 'apix']:
+        parser.add_argument('--' + arg, required=True)
+    for arg in ['fullmap', 'mask', 'histogram', 'geometry', 'checkpoint']:
+        parser.add_argument('--' + arg)
+    parser.add_argument('--ThreeDFSC', default='vol')
+    parser.add_argument('--dthetaInDegrees', type=float, default=20.)
+    parser.add_argument('--FSCCutoff', type=float, default=0.143)
+    parser.add_argument('--ThresholdForSphericity', type=float, default=0.5)
+    parser.add_argument('--HighPassFilter', type=float, default=200.)
+    parser.add_argument('--numThresholdsForSphericityCalcs', type=int,
+                        default=0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Compute only part of the cone directions and '
+                             'shells (see calcFSCAdaptive).')
+    parser.add_argument('--precision', choices=sorted(PRECISIONS),
+                        default='double')
+    parser.add_argument('--precisionTolerance', type=float,
+                        default=PRECISION_TOLERANCE)
+    parser.add_argument('--adaptiveMargin', type=int, default=ADAPTIVE_MARGIN)
+    parser.add_argument('--adaptiveTolerance', type=float,
+                        default=ADAPTIVE_TOLERANCE)
+    parser.add_argument('--memory', type=float, default=0,
+                        help='Memory budget in GB (0 for no limit).')
+    parser.add_argument('--checkpointInterval', type=float,
+                        default=CHECKPOINT_INTERVAL,
+                        help='Seconds between saves of the FSC sums to the '
+                             'checkpoint folder.')
+    run3DFSC(**vars(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
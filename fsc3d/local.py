@@ -0,0 +1,248 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Local directional resolution: 3D FSC of sub-volumes.
+
+The half maps are either tiled into overlapping cubic windows, or split
+into domains given by masks. Each region is extracted from the memory
+mapped half maps, multiplied by a soft window and analyzed as in the
+global 3D FSC. The regions are distributed over a process pool. Each
+worker keeps the window function and the geometry of the window box
+(cone membership and nearest directions), so they are computed once per
+worker instead of once per window.
+"""
+
+import os
+
+import numpy as np
+
+from .engine import (openMap, getDirections, getGeometry, calcFSC,
+                     buildVolume, thresholdVolume, calcSphericity,
+                     getCrossingShells, writeMap, getProcessPool)
+
+TABLE_HEADER = ('id,z,y,x,size,sphericity,globalResolution,'
+                'worstResolution,bestResolution,anisotropy')
+
+_worker = {}  # state of the pool worker process
+
+
+def getWindowFunction(size, edge=None):
+    """ Return a sphere of diameter size with a raised cosine edge. """
+    edge = max(size // 8, 1) if edge is None else edge
+    c = np.arange(size, dtype=np.float32) - (size - 1) / 2.
+    z, y, x = np.meshgrid(c, c, c, indexing='ij', sparse=True)
+    radius = np.sqrt(z ** 2 + y ** 2 + x ** 2)
+    outer = size / 2.
+    t = np.clip((outer - radius) / edge, 0, 1)
+
+    return (0.5 - 0.5 * np.cos(np.pi * t)).astype(np.float32)
+
+
+def getWindowCenters(boxSize, windowSize, step, mask=None):
+    """ Return the centers (z, y, x) of a grid of windows fully inside
+    the box, keeping only those whose center is inside the mask.
+    """
+    half = windowSize // 2
+    coords = np.arange(half, boxSize - windowSize + half + 1, step)
+    centers = np.stack(np.meshgrid(coords, coords, coords, indexing='ij'),
+                       axis=-1).reshape(-1, 3)
+    if mask is not None:
+        centers = centers[mask[tuple(centers.T)] > 0.5]
+
+    return centers
+
+
+def getMaskRegion(mask, boxSize, margin=4):
+    """ Return the center and the (even) window size that contain the
+    mask plus a margin, limited to the box.
+    """
+    points = np.argwhere(mask > 0.5)
+    lo, hi = points.min(axis=0), points.max(axis=0) + 1
+    size = int(np.max(hi - lo)) + 2 * margin
+    size = min(size + size % 2, boxSize)
+    center = np.clip((lo + hi) // 2, size // 2, boxSize - size + size // 2)
+
+    return center, size
+
+
+def _extract(data, center, size):
+    start = np.asarray(center) - size // 2
+    z, y, x = start
+
+    return np.asarray(data[z:z + size, y:y + size, x:x + size],
+                      dtype=np.float32)
+
+
+def analyzeWindow(half1, half2, window, apix, directions, dTheta,
+                  fscCutoff, thrSph, hpFilter, geometry=None):
+    """ Return sphericity and global, worst and best directional
+    resolution of two (windowed) sub-volumes. The geometry of the box
+    (see getGeometry) can be given to reuse it.
+    """
+    size = half1.shape[0]
+    ft1 = np.fft.rfftn(half1 * window)
+    ft2 = np.fft.rfftn(half2 * window)
+    globalFSC, conicalFSC = calcFSC(ft1, ft2, directions, dTheta,
+                                    slabSize=size, geometry=geometry)
+    conicalFSC = np.where(np.isnan(conicalFSC), globalFSC, conicalFSC)
+
+    vol = buildVolume(conicalFSC, directions,
+                      np.empty((size,) * 3, dtype=np.float32), slabSize=size,
+                      geometry=geometry)
+    _, binarized = thresholdVolume(vol, apix, fscCutoff, thrSph, hpFilter,
+                                   slabSize=size)
+    hpShell = size * apix / hpFilter
+    globalRes = size * apix / getCrossingShells(globalFSC, fscCutoff,
+                                                hpShell)[0]
+    resolutions = size * apix / getCrossingShells(conicalFSC, fscCutoff,
+                                                  hpShell)
+
+    return (calcSphericity(binarized, slabSize=size), globalRes,
+            resolutions.max(), resolutions.min())
+
+
+def _initWorker(half1Fn, half2Fn, windowSize, dTheta):
+    _worker.update(half1=openMap(half1Fn), half2=openMap(half2Fn),
+                   directions=getDirections(dTheta), windows={})
+    if windowSize:
+        _getWindowData(windowSize, dTheta)
+
+
+def _getWindowData(size, dTheta):
+    """ Window function and geometry of a box size, computed once per
+    worker.
+    """
+    if size not in _worker['windows']:
+        _worker['windows'][size] = (
+            getWindowFunction(size),
+            getGeometry(size, _worker['directions'], dTheta, slabSize=size))
+
+    return _worker['windows'][size]
+
+
+def _analyzeRegions(regions, apix, dTheta, fscCutoff, thrSph, hpFilter,
+                    maskFns=None):
+    """ Analyze a list of (id, center, size) regions in a worker. """
+    results = []
+    for regionId, center, size in regions:
+        window, geometry = _getWindowData(size, dTheta)
+        if maskFns:
+            # the (soft) domain mask is the window
+            window = _extract(openMap(maskFns[regionId]), center, size)
+        half1 = _extract(_worker['half1'], center, size)
+        half2 = _extract(_worker['half2'], center, size)
+        results.append((regionId, center, size) + analyzeWindow(
+            half1, half2, window, apix, _worker['directions'], dTheta,
+            fscCutoff, thrSph, hpFilter, geometry))
+
+    return results
+
+
+def runLocal3DFSC(half1Fn, half2Fn, apix, outputDir, windowSize=48,
+                  step=24, maskFn=None, domainMaskFns=None, dTheta=20.,
+                  fscCutoff=0.143, thrSph=0.5, hpFilter=200., workers=1):
+    """ Compute the 3D FSC of every window (or domain mask) and write the
+    table of results (windows.csv) and the sphericity and anisotropy
+    (worst / best directional resolution) maps to outputDir. Window results
+    are blended with the window function where they overlap. Return the
+    list of results (id, center, size, sphericity, global, worst and best
+    resolution).
+    """
+    os.makedirs(outputDir, exist_ok=True)
+    boxSize = openMap(half1Fn).shape[0]
+
+    if domainMaskFns:
+        regions = []
+        for i, fn in enumerate(domainMaskFns):
+            center, size = getMaskRegion(openMap(fn), boxSize)
+            regions.append((i, center, size))
+        windowSize = 0
+    else:
+        mask = openMap(maskFn) if maskFn else None
+        centers = getWindowCenters(boxSize, windowSize, step, mask)
+        regions = [(i, c, windowSize) for i, c in enumerate(centers)]
+    if not regions:
+        raise ValueError("No windows inside the mask.")
+
+    workers = max(min(int(workers), len(regions)), 1)
+    # several chunks per worker to balance the load
+    chunks = [list(c) for c in np.array_split(
+        np.arange(len(regions)), min(len(regions), workers * 4)) if len(c)]
+    args = (apix, dTheta, fscCutoff, thrSph, hpFilter, domainMaskFns)
+    with getProcessPool(workers, initializer=_initWorker,
+                        initargs=(half1Fn, half2Fn, windowSize,
+                                  dTheta)) as pool:
+        futures = [pool.submit(_analyzeRegions, [regions[i] for i in chunk],
+                               *args) for chunk in chunks]
+        results = sorted(r for f in futures for r in f.result())
+
+    writeLocalResults(results, outputDir, boxSize, apix, domainMaskFns)
+
+    return results
+
+
+def writeLocalTable(results, fn, scale=1., origin=(0, 0, 0)):
+    """ Write the table of results. Centers and sizes are in voxels of
+    the analyzed maps, or scaled and shifted by origin to the voxels of
+    the maps they were cropped from.
+    """
+    with open(fn, 'w') as f:
+        f.write(TABLE_HEADER + '\n')
+        for regionId, center, size, sph, res, worst, best in results:
+            center = np.rint(np.asarray(center) * scale + origin)
+            f.write('%d,%d,%d,%d,%d,%0.4f,%0.2f,%0.2f,%0.2f,%0.3f\n'
+                    % ((regionId,) + tuple(center.astype(int)) +
+                       (round(size * scale), sph, res, worst, best,
+                        worst / best)))
+
+
+def writeLocalResults(results, outputDir, boxSize, apix, domainMaskFns=None):
+    """ Write the table and the sphericity and anisotropy maps. """
+    writeLocalTable(results, os.path.join(outputDir, 'windows.csv'))
+
+    weights = np.zeros((boxSize,) * 3, dtype=np.float32)
+    sphericity = np.zeros_like(weights)
+    anisotropy = np.zeros_like(weights)
+    windows = {}
+    for regionId, center, size, sph, _, worst, best in results:
+        if domainMaskFns:
+            window = openMap(domainMaskFns[regionId])
+            region = (slice(None),) * 3
+        else:
+            if size not in windows:
+                windows[size] = getWindowFunction(size)
+            window = windows[size]
+            start = np.asarray(center) - size // 2
+            region = tuple(slice(s, s + size) for s in start)
+        weights[region] += window
+        sphericity[region] += window * sph
+        anisotropy[region] += window * worst / best
+
+    np.divide(sphericity, weights, out=sphericity, where=weights > 0)
+    np.divide(anisotropy, weights, out=anisotropy, where=weights > 0)
+    writeMap(os.path.join(outputDir, 'sphericity.mrc'), sphericity, apix)
+    writeMap(os.path.join(outputDir, 'anisotropy.mrc'), anisotropy, apix)
@@ -0,0 +1,192 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Metrics of 3D FSC volumes.
+
+Sphericity, principal-axis anisotropy and directional resolutions are
+computed from the 3D FSC volume itself, so they can be evaluated for
+other thresholds in a fraction of a second, without running 3D FSC
+again. They are used by the viewer, and by the protocols for the
+anisotropy, the other results being read from the 3D FSC output.
+
+Every function takes a stack of volumes with the same box
+(N x n x n x n), or a single volume. The principal axes, the directional
+resolutions and their histograms are computed for the whole stack at
+once. The path minimum and the sphericity are the ones of the engine,
+computed volume by volume.
+"""
+
+import numpy as np
+
+from .engine import (openMap, binMap, getDirections, getPathMinimum,
+                     calcSphericity)
+
+MAX_BOX = 256  # larger volumes are binned by loadVolumes
+HISTOGRAM_BINS = 30
+
+
+def _asStack(vols):
+    vols = np.asarray(vols, dtype=np.float32)
+
+    return vols[None] if vols.ndim == 3 else vols
+
+
+def _getCenteredCoords(boxSize):
+    c = np.arange(boxSize) - boxSize // 2
+
+    return np.meshgrid(c, c, c, indexing='ij')
+
+
+def loadVolumes(fns, apix, maxBox=MAX_BOX):
+    """ Read volumes of the same box into a stack. Boxes larger than
+    maxBox are binned by the smallest integer factor that fits. Return
+    the stack and its pixel size.
+    """
+    boxSize = openMap(fns[0]).shape[0]
+    factor = -(-boxSize // maxBox)
+    if factor == 1:
+        return _asStack([openMap(fn) for fn in fns]), apix
+
+    return (_asStack([binMap(openMap(fn), factor) for fn in fns]),
+            apix * factor)
+
+
+def getBinarized(vols, apix, thrSph=0.5, hpFilter=200.):
+    """ Return the binarized 3D FSC volumes, as written by 3D FSC. """
+    vols = _asStack(vols)
+    hpRadius = vols.shape[1] * apix / hpFilter
+
+    return np.stack([getPathMinimum(vol, hpRadius=hpRadius)
+                     for vol in vols]) >= thrSph
+
+
+def getPrincipalAxes(binarized):
+    """ Return the semi-axes (in voxels, ascending) of the ellipsoid with
+    the same second moments as every binary volume.
+    """
+    binarized = np.asarray(binarized, dtype=np.float32)
+    if binarized.ndim == 3:
+        binarized = binarized[None]
+    z, y, x = [c.ravel().astype(np.float64)
+               for c in _getCenteredCoords(binarized.shape[1])]
+    weights = binarized.reshape(len(binarized), -1)
+    count = np.maximum(weights.sum(axis=1), 1)
+    products = np.stack([z * z, y * y, x * x, z * y, z * x, y * x], axis=1)
+    m = weights @ products / count[:, None]
+    tensors = np.stack([m[:, [0, 3, 4]], m[:, [3, 1, 5]], m[:, [4, 5, 2]]],
+                       axis=1)
+
+    # a solid ellipsoid of semi-axis a has a second moment of a^2 / 5
+    return np.sqrt(5 * np.maximum(np.linalg.eigvalsh(tensors), 0))
+
+
+def getAnisotropy(axes):
+    """ Return the longest / shortest principal semi-axis of every row of
+    axes (see getPrincipalAxes).
+    """
+    return axes[:, 2] / np.maximum(axes[:, 0], 1e-6)
+
+
+def sampleDirections(vols, directions):
+    """ Return the FSC of every volume along the direction axes (nearest
+    voxel at every shell), as an N x nDirections x nShells array. Only
+    the sampled voxels are read, so vols can be a memory map.
+    """
+    if vols.ndim == 3:
+        vols = vols[None]
+    boxSize = vols.shape[1]
+    shells = np.arange(boxSize // 2 + 1)
+    points = (boxSize // 2 +
+              np.rint(np.asarray(directions)[:, None, :] *
+                      shells[None, :, None]))
+    points = np.clip(points, 0, boxSize - 1).astype(int)
+
+    return np.asarray(vols[:, points[..., 0], points[..., 1],
+                           points[..., 2]], dtype=np.float32)
+
+
+def getResolutions(freqs, fsc, cutoff, hpFilter=0):
+    """ Return the resolution (A) where each FSC curve (last axis) first
+    drops below cutoff, beyond the high-pass filter (A).
+    """
+    fsc = np.asarray(fsc)
+    below = fsc < cutoff
+    below[..., 0] = False
+    if hpFilter:
+        below[..., freqs < 1. / hpFilter] = False
+    index = np.where(below.any(axis=-1), np.argmax(below, axis=-1),
+                     fsc.shape[-1] - 1)
+
+    return 1. / freqs[np.maximum(index, 1)]
+
+
+def getHistograms(resolutions, bins=HISTOGRAM_BINS, edges=None):
+    """ Return the histogram of the last axis of resolutions for every
+    volume, with the same bin edges for all (from the overall range if
+    not given), and the edges.
+    """
+    resolutions = np.atleast_2d(resolutions)
+    if edges is None:
+        edges = np.histogram_bin_edges(resolutions, bins)
+    nBins = len(edges) - 1
+    index = np.clip(np.searchsorted(edges, resolutions, side='right') - 1,
+                    0, nBins - 1)
+    offsets = np.arange(len(resolutions))[:, None] * nBins
+    counts = np.bincount((index + offsets).ravel(),
+                         minlength=len(resolutions) * nBins)
+
+    return counts.reshape(len(resolutions), nBins), edges
+
+
+def getMetrics(vols, apix, fscCutoff=0.143, thrSph=0.5, hpFilter=200.,
+               dTheta=20., bins=HISTOGRAM_BINS):
+    """ Return a dictionary of metrics with one value (or row) per
+    volume: sphericity of the binarized volume, its principal semi-axes
+    and anisotropy (longest / shortest), the resolution of every
+    direction, the worst and best directional resolution and their
+    histogram.
+    """
+    vols = _asStack(vols)
+    n = vols.shape[1]
+    binarized = getBinarized(vols, apix, thrSph, hpFilter)
+    axes = getPrincipalAxes(binarized)
+    freqs = np.arange(n // 2 + 1) / (n * apix)
+    resolutions = getResolutions(freqs,
+                                 sampleDirections(vols, getDirections(dTheta)),
+                                 fscCutoff, hpFilter)
+    histograms, edges = getHistograms(resolutions, bins)
+
+    return {'sphericity': np.array([calcSphericity(b, slabSize=n)
+                                    for b in binarized]),
+            'principalAxes': axes,
+            'anisotropy': getAnisotropy(axes),
+            'resolutions': resolutions,
+            'worstResolution': resolutions.max(axis=1),
+            'bestResolution': resolutions.min(axis=1),
+            'histogram': histograms,
+            'histogramEdges': edges}
@@ -1 +1,3 @@
 from .protocol_3dfsc import Prot3DFSC
+from .protocol_batch_3dfsc import ProtBatch3DFSC
+from .protocol_stream_3dfsc import ProtStream3DFSC
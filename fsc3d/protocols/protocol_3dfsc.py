@@ -25,23 +25,41 @@
 # **************************************************************************
 
 import os
+import sys
+import threading
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
 import pyworkflow.protocol.params as params
 from pyworkflow.constants import PROD
+from pyworkflow.object import String, Boolean, Integer, Float
 from pyworkflow.utils import cleanPath
-from pwem.protocols import ProtAnalysis3D
-from pwem.emlib.image import ImageHandler
 from pwem.objects import Volume
 
-from .. import Plugin
+from .. import Plugin, __version__
+from ..cache import ResultCache
+from ..timing import Timings, parsePhases
+from ..convert import (stageInput, readGlobalFSC, getResolution,
+                       getCropBoxSize, fourierCrop, padVolume, getMaskBox,
+                       cropVolume, uncropVolume, resampleVolume, upsampleMap,
+                       readResults, createPreviews, sampleDirectionalFSC)
+from ..local import runLocal3DFSC, writeLocalTable
+from ..engine import (runFromArgs, readMap, sweepThresholds, getDirections,
+                      writeDirectionalFSC, calcMapPower, writeMapPowerPlot,
+                      getSlabSize, isOutOfCore, PRECISIONS, PRECISION_WARNING,
+                      ENGINE_VERSION)
+from ..constants import ENGINE_3DFSC, ENGINE_BUILTIN
+from .protocol_base import Prot3DFSCBase
 
 
 class outputs(Enum):
     outputVolume = Volume
+    outputLocalSphericity = Volume
 
 
-class Prot3DFSC(ProtAnalysis3D):
+class Prot3DFSC(Prot3DFSCBase):
     """ Protocol to calculate 3D FSC.
 
     3D FSC is software tool for quantifying directional
@@ -60,7 +78,16 @@ class Prot3DFSC(ProtAnalysis3D):
     """
     
     def __init__(self, **kwargs):
-        ProtAnalysis3D.__init__(self, **kwargs)
+        Prot3DFSCBase.__init__(self, **kwargs)
+        self.stepsExecutionMode = params.STEPS_PARALLEL
+        self._storeLock = threading.Lock()
+        self.stagedInputs = String()
+        self.resultFromCache = Boolean(False)
+        self.cropBoxSize = Integer()
+        self.cropSamplingRate = Float()
+        self.maskCropOrigin = String()
+        self.maskCropSize = Integer()
+        self.precisionWarning = Boolean(False)
 
     def _initialize(self):
         """ This function is mean to be called after the
@@ -75,6 +102,7 @@ class Prot3DFSC(ProtAnalysis3D):
                   'input_half1Fn': self._getTmpPath('volume_half1.mrc'),
                   'input_half2Fn': self._getTmpPath('volume_half2.mrc'),
                   'input_maskFn': self._getTmpPath('mask.mrc'),
+                  'out_results': self._getExtraPath('Results_vol'),
                   'out_histogram': self._getExtraPath('Results_vol/histogram.png'),
                   'out_plot3DFSC': self._getExtraPath('Results_vol/Plotsvol.jpg'),
                   'out_plotFT': self._getExtraPath('Results_vol/FTPlotvol.jpg'),
@@ -82,7 +110,17 @@ class Prot3DFSC(ProtAnalysis3D):
                   'out_vol3DFSC-th': self._getExtraPath('Results_vol/vol_Thresholded.mrc'),
                   'out_vol3DFSC-thbin': self._getExtraPath('Results_vol/vol_ThresholdedBinarized.mrc'),
                   'out_cmdChimera': self._getExtraPath('Results_vol/Chimera/3DFSCPlot_Chimera.cmd'),
-                  'out_globalFSC': self._getExtraPath('Results_vol/ResEMvolOutglobalFSC.csv')
+                  'out_globalFSC': self._getExtraPath('Results_vol/ResEMvolOutglobalFSC.csv'),
+                  'out_directionalFSC': self._getExtraPath('Results_vol/ResEMvolOutDirectionalFSC.npz'),
+                  'out_log': self._getExtraPath('run3DFSC.log'),
+                  'out_sweep': self._getExtraPath('sweep.csv'),
+                  'out_timings': self._getExtraPath('timings.json'),
+                  'out_previews': self._getExtraPath('previews'),
+                  'out_local': self._getExtraPath('local'),
+                  'out_localTable': self._getExtraPath('local/windows.csv'),
+                  'out_localSphericity': self._getExtraPath('local/sphericity.mrc'),
+                  'out_localAnisotropy': self._getExtraPath('local/anisotropy.mrc'),
+                  'input_localMaskFn': self._getTmpPath('local_mask_%(id)d.mrc')
                   }
 
         self._updateFilenamesDict(myDict)
@@ -90,14 +128,7 @@ class Prot3DFSC(ProtAnalysis3D):
     # --------------------------- DEFINE param functions ----------------------
 
     def _defineParams(self, form):
-        form.addHidden(params.USE_GPU, params.BooleanParam,
-                       default=True,
-                       label="Use GPU?")
-        form.addHidden(params.GPU_LIST, params.StringParam,
-                       default='0',
-                       label="Choose GPU ID",
-                       help="Each GPU has a unique ID. If you have only "
-                            "one GPU, set ID to 0. 3DFSC can use only one GPU.")
+        self._defineGpuParams(form)
 
         form.addSection(label='Input')
         form.addParam('inputVolume', params.PointerParam,
@@ -125,108 +156,630 @@ class Prot3DFSC(ProtAnalysis3D):
         form.addParam('maskVolume', params.PointerParam, label="Mask volume",
                       pointerClass='VolumeMask', condition="applyMask",
                       help='Select a volume to apply as a mask.')
-
-        form.addSection(label='Extra params')
-        form.addParam('dTheta', params.FloatParam, default=20,
-                      label='Angle of cone (deg)',
-                      help='Angle of cone to be used for 3D FSC sampling in '
-                           'degrees. Default is 20 degrees.')
-        form.addParam('fscCutoff', params.FloatParam, default=0.143,
-                      label='FSC cutoff',
-                      help='FSC cutoff criterion. 0.143 is default.')
-        form.addParam('thrSph', params.FloatParam, default=0.5,
-                      label='Sphericity threshold',
-                      help='Threshold value for 3DFSC volume for calculating '
-                           'sphericity. 0.5 is default.')
-        form.addParam('hpFilter', params.FloatParam, default=200,
-                      label='High-pass filter (A)',
-                      help='High-pass filter for thresholding in Angstrom. '
-                           'Prevents small dips in directional FSCs at low '
-                           'spatial frequency due to noise from messing up '
-                           'the thresholding step. Decrease if you see a '
-                           'huge wedge missing from your thresholded 3DFSC '
-                           'volume. 200 Angstroms is default.')
-        form.addParam('numThr', params.IntParam, default=0,
-                      label='Number of threshold for sphericity',
-                      help='Calculate sphericities at different threshold '
-                           'cutoffs to determine sphericity deviation across '
-                           'spatial frequencies. This can be useful to '
-                           'evaluate possible effects of overfitting or '
-                           'improperly assigned orientations. 0 is default.')
+        form.addParam('doMaskCrop', params.BooleanParam, default=False,
+                      condition="applyMask",
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Crop to the mask?',
+                      help='Crop the half maps, the full map and the mask '
+                           'in real space to the bounding box of the mask '
+                           'plus a margin, rounded up to an FFT-friendly '
+                           'size, so the cost depends on the cropped box. '
+                           'The masked maps are 0 outside that box, so the '
+                           'FSC is the same, sampled in coarser shells. The '
+                           '3D FSC volumes are resampled back to the '
+                           'original box. Resolutions do not change, but '
+                           'the sphericity is measured on the coarser '
+                           'shells and can differ by a few hundredths.')
+        form.addParam('maskCropMargin', params.IntParam, default=8,
+                      condition="applyMask and doMaskCrop",
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Mask crop margin (px)',
+                      help='Voxels kept around the non-zero voxels of the '
+                           'mask (soft edge included).')
+
+        self._defineExtraParams(form)
+        form.addParam('useCache', params.BooleanParam, default=False,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Reuse cached results?',
+                      help='Results are stored in a cache (see FSC3D_CACHE '
+                           'and FSC3D_CACHE_SIZE variables) indexed by the '
+                           'content of the input files, the parameters and '
+                           'the version of the engine. If an identical run '
+                           'is found, its results are copied instead of '
+                           'running 3D FSC again. Hashing the inputs takes '
+                           'some time for large maps.')
+        form.addParam('useWorker', params.BooleanParam, default=False,
+                      condition='engine==%d' % ENGINE_3DFSC,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Run on persistent worker?',
+                      help='Send the job to a 3DFSC worker process that '
+                           'keeps the conda environment imported and numba '
+                           'functions compiled, which removes most of the '
+                           'startup time of small maps. The worker is '
+                           'started on first use and exits after being idle '
+                           'for FSC3D_WORKER_IDLE seconds. If it is not '
+                           'available, 3DFSC runs as a new process.')
+        form.addParam('precision', params.EnumParam,
+                      choices=['double', 'single'], default=0,
+                      condition='engine==%d' % ENGINE_BUILTIN,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Precision',
+                      help='*single*: compute Fourier transforms and '
+                           'correlations in float32/complex64, which halves '
+                           'the memory of the transforms. Staged inputs and '
+                           'output volumes are always float32. A copy of '
+                           'the half maps binned to 64 px is first computed '
+                           'in both precisions, and a warning is given if '
+                           'the global resolution or the sphericity differ '
+                           'by more than the tolerance.')
+        form.addParam('precisionTolerance', params.FloatParam, default=0.01,
+                      condition='engine==%d and precision==1' % ENGINE_BUILTIN,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Precision tolerance',
+                      help='Largest accepted change of sphericity, and of '
+                           'global resolution (as a fraction), between '
+                           'single and double precision.')
+        form.addParam('minimalOutputs', params.BooleanParam, default=False,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Minimal outputs (headless)?',
+                      help='Only compute the 3D FSC volumes and the numeric '
+                           'results. The built-in engine skips the plots, '
+                           'and viewer previews are not written. The viewer '
+                           'creates what it needs the first time it is '
+                           'opened. The 3DFSC program always writes its '
+                           'plots.')
+
+        group = form.addGroup('Fourier crop')
+        group.addParam('doCrop', params.BooleanParam, default=False,
+                       label='Crop in Fourier space?',
+                       help='Over-sampled maps can be cropped in Fourier '
+                            'space before 3D FSC, so the cost depends on '
+                            'the cropped box. The 3D FSC volumes are padded '
+                            'back to the original box and sampling; '
+                            'frequencies beyond the cropped Nyquist are 0.')
+        group.addParam('cropResolution', params.FloatParam, default=3.0,
+                       condition='doCrop',
+                       label='Target resolution (A)',
+                       help='The box is cropped so that the new Nyquist '
+                            'frequency reaches this resolution. Use a value '
+                            'below the expected global resolution.')
+        group.addParam('cropBox', params.IntParam, default=0,
+                       condition='doCrop',
+                       label='Cropped box size (px)',
+                       help='If not 0, crop to this box size instead of '
+                            'using the target resolution.')
+
+        group = form.addGroup('Adaptive sampling',
+                              condition='engine==%d' % ENGINE_BUILTIN)
+        group.addParam('doAdaptive', params.BooleanParam, default=False,
+                       label='Sample cones adaptively?',
+                       help='Compute first a coarse set of directions (twice '
+                            'the spacing) up to Nyquist. The remaining '
+                            'directions are computed only where neighbouring '
+                            'coarse directions disagree, and only up to a few '
+                            'shells beyond the last crossing of the FSC '
+                            'cutoff (or sphericity threshold, if lower). '
+                            'The other directions take the FSC of the '
+                            'nearest coarse one. The thresholded volumes '
+                            'differ slightly from a full run; values of the '
+                            '3D FSC volume beyond the crossings are '
+                            'approximate.')
+        group.addParam('adaptiveMargin', params.IntParam, default=4,
+                       condition='doAdaptive',
+                       label='Safety margin (shells)',
+                       help='Number of Fourier shells computed beyond the '
+                            'last crossing of the coarse directions.')
+        group.addParam('adaptiveTolerance', params.FloatParam, default=0.1,
+                       condition='doAdaptive',
+                       label='Tolerance',
+                       help='Directions are refined near coarse directions '
+                            'whose crossing of the cutoff differs from a '
+                            'neighbour by more than this fraction. Use 0 to '
+                            'refine all directions (only the shells are '
+                            'limited).')
+
+        group = form.addGroup('Local directional resolution')
+        group.addParam('doLocal', params.BooleanParam, default=False,
+                       label='Compute local 3D FSC?',
+                       help='Compute the 3D FSC and sphericity of sub-volumes '
+                            'and write per-voxel sphericity and anisotropy '
+                            '(worst / best directional resolution) maps and '
+                            'a table of the regions. The regions are '
+                            'overlapping windows tiling the mask (or the box '
+                            'if no mask is applied), or the domains given by '
+                            'a set of masks. Regions are processed in '
+                            'parallel using the protocol threads.')
+        group.addParam('localMasks', params.MultiPointerParam,
+                       pointerClass='VolumeMask', allowsNull=True,
+                       condition='doLocal',
+                       label='Domain masks',
+                       help='Optional. Compute one 3D FSC per mask, in a box '
+                            'around it. If empty, the map is tiled into '
+                            'windows.')
+        group.addParam('windowSize', params.IntParam, default=48,
+                       condition='doLocal',
+                       label='Window size (px)',
+                       help='Box size of the windows. Larger windows give '
+                            'less noisy FSC curves but lower locality.')
+        group.addParam('windowStep', params.IntParam, default=24,
+                       condition='doLocal',
+                       label='Window step (px)',
+                       help='Distance between window centers.')
+
+        group = form.addGroup('Parameter sweep')
+        group.addParam('doSweep', params.BooleanParam, default=False,
+                       label='Evaluate several thresholds?',
+                       help='Compute the 3D FSC volume once and then '
+                            'evaluate sphericity and resolution for all '
+                            'combinations of the values below. The results '
+                            'table is saved as sweep.csv in the extra folder.')
+        group.addParam('sweepThrSph', params.StringParam, default='0.3 0.5 0.7',
+                       condition='doSweep',
+                       label='Sphericity thresholds',
+                       help='List of thresholds for the sphericity, '
+                            'separated by spaces.')
+        group.addParam('sweepFscCutoff', params.StringParam,
+                       default='0.143 0.5', condition='doSweep',
+                       label='FSC cutoffs',
+                       help='List of FSC cutoffs for the resolution, '
+                            'separated by spaces.')
+        group.addParam('sweepHpFilter', params.StringParam, default='200',
+                       condition='doSweep',
+                       label='High-pass filters (A)',
+                       help='List of high-pass filters, separated by spaces.')
+
+        # two step threads, so the full map is staged during the 3D FSC
+        form.addParallelSection(threads=3, mpi=0)
 
     # --------------------------- INSERT steps functions ----------------------
     
     def _insertAllSteps(self):
         # Insert processing steps
         self._initialize()
-        self._insertFunctionStep('convertInputStep')
-        self._insertFunctionStep('run3DFSCStep')
-        self._insertFunctionStep('createOutputStep')
+        convertId = self._insertFunctionStep('convertInputStep',
+                                             prerequisites=[])
+        # the built-in engine only needs the full map for its plots, so
+        # the full map is staged while the 3D FSC is running, after the
+        # other inputs if it is cropped to the box of the mask
+        fullMapId = self._insertFunctionStep(
+            'convertFullMapStep',
+            prerequisites=[convertId] if self._doMaskCrop() else [])
+        builtin = self.engine == ENGINE_BUILTIN
+        stepId = self._insertFunctionStep(
+            'run3DFSCStep',
+            prerequisites=[convertId] if builtin else [convertId, fullMapId])
+        if self.doCrop or self._doMaskCrop():
+            stepId = self._insertFunctionStep('padOutputStep')
+        if self.doLocal:
+            stepId = self._insertFunctionStep('localStep')
+        if self.doSweep:
+            stepId = self._insertFunctionStep('sweepStep')
+        if not self.minimalOutputs:
+            stepId = self._insertFunctionStep('createPreviewsStep')
+            if builtin:
+                stepId = self._insertFunctionStep(
+                    'plotMapPowerStep', prerequisites=[stepId, fullMapId])
+        if self.compressOutputs:
+            stepId = self._insertFunctionStep('compressOutputStep',
+                                              prerequisites=[stepId, fullMapId])
+        self._insertFunctionStep('createOutputStep',
+                                 prerequisites=[stepId, fullMapId])
 
     # --------------------------- STEPS functions -----------------------------
     
     def convertInputStep(self):
-        """ Convert input volumes to .mrc as expected by 3DFSC."""
-        ih = ImageHandler()
-        if self.provideHalfMaps:
-            fnHalf1 = self.volumeHalf1.get().getLocation()
-            fnHalf2 = self.volumeHalf2.get().getLocation()
-        else:
-            fnHalf1, fnHalf2 = self.inputVolume.get().getHalfMaps().split(',')
-
-        ih.convert(fnHalf1,
-                   self._getFileName('input_half1Fn'))
-        ih.convert(fnHalf2,
-                   self._getFileName('input_half2Fn'))
-        ih.convert(self.inputVolume.get().getLocation(),
-                   self._getFileName('input_volFn'))
-        if self.maskVolume.hasValue():
-            ih.convert(self.maskVolume.get().getLocation(),
-                       self._getFileName('input_maskFn'))
+        """ Stage the half maps and the mask as .mrc as expected by 3DFSC,
+        all at the same time in a pool of threads. Files that are already
+        float32 MRC are linked, not converted. Then crop them to the box
+        of the mask and in Fourier space, if requested.
+        """
+        with self._getTimings().record('convertInputStep'):
+            if self.provideHalfMaps:
+                fnHalf1 = self.volumeHalf1.get().getLocation()
+                fnHalf2 = self.volumeHalf2.get().getLocation()
+            else:
+                fnHalf1, fnHalf2 = self.inputVolume.get().getHalfMaps().split(',')
+
+            inputs = [('input_half1Fn', fnHalf1),
+                      ('input_half2Fn', fnHalf2)]
+            if self.maskVolume.hasValue():
+                inputs.append(('input_maskFn',
+                               self.maskVolume.get().getLocation()))
+
+            with ThreadPoolExecutor(max_workers=len(inputs)) as pool:
+                methods = list(pool.map(lambda i: self._stageInput(*i),
+                                        inputs))
+
+            self.stagedInputs.set(', '.join(
+                '%s=%s' % (key, method)
+                for (key, _), method in zip(inputs, methods)))
+            self._storeAttributes(self.stagedInputs)
+
+            maskBox = None
+            if self._doMaskCrop():
+                maskBox = getMaskBox(self._getFileName('input_maskFn'),
+                                     self.maskCropMargin.get())
+            if maskBox is not None:
+                origin, size = maskBox
+                self.info("Inputs cropped to the mask: box %d at %s"
+                          % (size, origin))
+                self.maskCropOrigin.set(' '.join(map(str, origin)))
+                self.maskCropSize.set(size)
+                self._storeAttributes(self.maskCropOrigin, self.maskCropSize)
+            elif self._doMaskCrop():
+                self.info("Mask crop skipped: the box of the mask is not "
+                          "smaller than the input box.")
+
+            cropBoxSize = self._getCropBoxSize()
+            if cropBoxSize:
+                self.info("Inputs cropped in Fourier space to box %d "
+                          "(%0.3f A/px)" % (cropBoxSize,
+                                            self._getCropSamplingRate()))
+                self.cropBoxSize.set(cropBoxSize)
+                self.cropSamplingRate.set(self._getCropSamplingRate())
+                self._storeAttributes(self.cropBoxSize,
+                                      self.cropSamplingRate)
+            elif self.doCrop:
+                self.info("Fourier crop skipped: box %d is not larger than "
+                          "the cropped one" % self._getStagedBoxSize())
+
+            with ThreadPoolExecutor(max_workers=len(inputs)) as pool:
+                list(pool.map(lambda i: self._cropInput(i[0]), inputs))
+
+    def convertFullMapStep(self):
+        """ Stage the full map, which runs along with the 3D FSC of the
+        built-in engine.
+        """
+        with self._getTimings().record('convertFullMapStep') as record:
+            record['staging'] = self._stageInput(
+                'input_volFn', self.inputVolume.get().getLocation())
+            self._cropInput('input_volFn')
+
+    def _stageInput(self, key, location):
+        """ Stage an input volume and return the staging method. """
+        fn = self._getFileName(key)
+        method = stageInput(location, fn,
+                            self.inputVolume.get().getSamplingRate())
+        self.info("Staged %s: %s" % (fn, method))
+
+        return method
+
+    def _cropInput(self, key, fn=None):
+        """ Crop a staged input volume to the box of the mask and in
+        Fourier space, if needed.
+        """
+        fn = fn or self._getFileName(key)
+        if self.maskCropSize.hasValue():
+            cropVolume(fn, self._getMaskCropOrigin(), self.maskCropSize.get())
+        cropBoxSize = self._getCropBoxSize()
+        if cropBoxSize:
+            clip = (0., 1.) if key == 'input_maskFn' else None
+            fourierCrop(fn, cropBoxSize, clip)
 
     def run3DFSCStep(self):
-        args = self._getArgs()
-        params = ' '.join(['%s=%s' % (k, str(v)) for k, v in args.items()])
-
-        if self.useGpu:
-            params += ' --gpu --gpu_id=%s' % self.gpuList.get()
+        with self._getTimings().record('run3DFSCStep') as record:
+            args = self._getArgs()
+            cache = self._getResultCache() if self.useCache else None
+            if cache is not None:
+                key = self._getCacheKey(cache, args)
+                log = cache.get(key, self._getFileName('out_results'))
+                if log is not None:
+                    self.info("3D FSC results restored from cache %s" % key)
+                    self._writeLog(log)
+                    self.resultFromCache.set(True)
+                    self._storeAttributes(self.resultFromCache)
+                    self._checkPrecision(log)
+                    record['cached'] = True
+                    return
 
-        Plugin.runProgram(self, params, cwd=self._getExtraPath())
-        if not os.path.exists(self._getFileName('out_vol3DFSC')):
-            raise RuntimeError('3D FSC run failed!')
+            logFn = self.getLogPaths()[0]
+            logStart = os.path.getsize(logFn)
+
+            if self.engine == ENGINE_BUILTIN:
+                boxSize = self.cropBoxSize.get() or self._getStagedBoxSize()
+                with self._useGeometry(boxSize) as geometry:
+                    runFromArgs(args, cwd=self._getExtraPath(),
+                                workers=self._getNumberOfWorkers(),
+                                memory=self.memoryBudget.get(),
+                                geometry=geometry,
+                                **self._getCheckpointArgs())
+            else:
+                params = self._getParamsStr(args)
+
+                if self.useGpu:
+                    params += ' --gpu --gpu_id=%s' % self._getGpuIds()[0]
+
+                Plugin.runProgram(self, params, cwd=self._getExtraPath(),
+                                  useWorker=self.useWorker.get())
+
+            if not os.path.exists(self._getFileName('out_vol3DFSC')):
+                raise RuntimeError('3D FSC run failed!')
+
+            sys.stdout.flush()
+            with open(logFn) as f:
+                f.seek(logStart)
+                log = f.read()
+            self._writeLog(log)
+            record['phases'] = parsePhases(log)
+            self._checkPrecision(log)
+
+            if cache is not None:
+                cleanPath(self._getExtraPath('Results_vol/ResEMvolOut.mrc'))
+                cache.put(key, self._getFileName('out_results'), log)
+
+    def _writeLog(self, log):
+        """ Keep the log of the 3D FSC run in its own file, so the
+        results are parsed from it and not from the protocol log.
+        """
+        with open(self._getFileName('out_log'), 'w') as f:
+            f.write(log)
 
-    def createOutputStep(self):
-        if os.path.exists(self._getFileName('out_vol3DFSC')):
+    def padOutputStep(self):
+        """ Pad the 3D FSC volumes of a Fourier-cropped run back to the
+        box cropped to the mask, and resample them from the frequencies
+        of that box to those of the original box.
+        """
+        with self._getTimings().record('padOutputStep'):
+            inputVol = self.inputVolume.get()
+            for key in ['out_vol3DFSC', 'out_vol3DFSC-th',
+                        'out_vol3DFSC-thbin']:
+                fn = self._getFileName(key)
+                if self.cropBoxSize.hasValue():
+                    padVolume(fn, self._getStagedBoxSize(),
+                              inputVol.getSamplingRate())
+                if self.maskCropSize.hasValue():
+                    resampleVolume(fn, inputVol.getXDim(),
+                                   inputVol.getSamplingRate(),
+                                   nearest=key == 'out_vol3DFSC-thbin')
+
+    def localStep(self):
+        """ Compute the 3D FSC of sub-volumes of the staged half maps. """
+        with self._getTimings().record('localStep') as record:
+            outputDir = self._getFileName('out_local')
+            os.makedirs(outputDir, exist_ok=True)
+
+            maskFn, domainMaskFns = None, []
+            for i, pointer in enumerate(self.localMasks):
+                fn = self._getFileName('input_localMaskFn', id=i)
+                stageInput(pointer.get().getLocation(), fn,
+                           self.inputVolume.get().getSamplingRate())
+                self._cropInput('input_maskFn', fn)
+                domainMaskFns.append(fn)
+            if not domainMaskFns and self.applyMask and self.maskVolume:
+                maskFn = self._getFileName('input_maskFn')
+
+            # the box of the mask may be unknown when validating
+            boxSize = self.cropBoxSize.get() or self._getStagedBoxSize()
+            windowSize = self.windowSize.get()
+            if windowSize > boxSize:
+                self.info("Window size reduced to the cropped box (%d px)"
+                          % boxSize)
+                windowSize = boxSize
+
+            results = runLocal3DFSC(self._getFileName('input_half1Fn'),
+                                    self._getFileName('input_half2Fn'),
+                                    self._getSamplingRate(), outputDir,
+                                    windowSize=windowSize,
+                                    step=self.windowStep.get(),
+                                    maskFn=maskFn,
+                                    domainMaskFns=domainMaskFns,
+                                    dTheta=self.dTheta.get(),
+                                    fscCutoff=self.fscCutoff.get(),
+                                    thrSph=self.thrSph.get(),
+                                    hpFilter=self.hpFilter.get(),
+                                    workers=self._getNumberOfWorkers())
+            record['windows'] = len(results)
+            self.info("Local 3D FSC computed for %d regions" % len(results))
+
+            # maps and table on the grid of the input map
             inputVol = self.inputVolume.get()
-            vol = Volume()
-            vol.setObjLabel('3D FSC')
-            vol.setFileName(self._getFileName('out_vol3DFSC'))
-            vol.setSamplingRate(inputVol.getSamplingRate())
+            for key in ['out_localSphericity', 'out_localAnisotropy']:
+                fn = self._getFileName(key)
+                if self.cropBoxSize.hasValue():
+                    upsampleMap(fn, self._getStagedBoxSize(),
+                                inputVol.getSamplingRate())
+                if self.maskCropSize.hasValue():
+                    uncropVolume(fn, inputVol.getXDim(),
+                                 self._getMaskCropOrigin())
+            if self.cropBoxSize.hasValue() or self.maskCropSize.hasValue():
+                origin = (self._getMaskCropOrigin()
+                          if self.maskCropSize.hasValue() else (0, 0, 0))
+                writeLocalTable(results, self._getFileName('out_localTable'),
+                                self._getStagedBoxSize() / boxSize, origin)
+
+    def sweepStep(self):
+        """ Evaluate all threshold combinations on the 3D FSC volume. """
+        with self._getTimings().record('sweepStep'):
+            samplingRate = self.inputVolume.get().getSamplingRate()
+            hpFilters = self._getFloatList(self.sweepHpFilter)
+            cutoffs = self._getFloatList(self.sweepFscCutoff)
+            thresholds = self._getFloatList(self.sweepThrSph)
+
+            vol = readMap(self._getFileName('out_vol3DFSC'))
+            sphericity, resolution = sweepThresholds(vol, samplingRate,
+                                                     cutoffs, thresholds,
+                                                     hpFilters)
+            freqs, fsc = readGlobalFSC(self._getFileName('out_globalFSC'),
+                                       self._getSamplingRate())
+
+            with open(self._getFileName('out_sweep'), 'w') as f:
+                f.write('hpFilter,fscCutoff,thrSph,sphericity,'
+                        'globalResolution,worstResolution,bestResolution\n')
+                for i, hp in enumerate(hpFilters):
+                    for j, cutoff in enumerate(cutoffs):
+                        globalRes = getResolution(freqs, fsc, cutoff)
+                        for k, thr in enumerate(thresholds):
+                            f.write('%s,%s,%s,%0.4f,%0.2f,%0.2f,%0.2f\n'
+                                    % (hp, cutoff, thr, sphericity[i, k],
+                                       globalRes, *resolution[i, j]))
+
+    def plotMapPowerStep(self):
+        """ Plot the Fourier power of the full map, which the built-in
+        engine is run without.
+        """
+        with self._getTimings().record('plotMapPowerStep'):
+            fn = self._getFileName('input_volFn')
+            boxSize = self.cropBoxSize.get() or self._getStagedBoxSize()
+            memory = self.memoryBudget.get()
+            ftType = PRECISIONS[self.getEnumText('precision')]
+            workDir = (self._getTmpPath() if isOutOfCore(boxSize, memory,
+                                                           ftType) else None)
+            power = calcMapPower(fn, getSlabSize(boxSize, memory), workDir,
+                                 ftType)
+            freqs = np.arange(len(power)) / (boxSize * self._getSamplingRate())
+            writeMapPowerPlot(self._getFileName('out_plotFT'), freqs, power)
+
+    def createPreviewsStep(self):
+        """ Write the data used by the viewer: binned copies and central
+        slices of the 3D FSC volumes and the table of directional FSCs.
+        """
+        with self._getTimings().record('createPreviewsStep'):
+            self.createDirectionalFSC()
+            for key in ['out_vol3DFSC', 'out_vol3DFSC-th',
+                        'out_vol3DFSC-thbin']:
+                if os.path.exists(self._getFileName(key)):
+                    createPreviews(self._getFileName(key),
+                                   self._getFileName('out_previews'))
+
+    def compressOutputStep(self):
+        """ Store the thresholded 3D FSC volumes compressed, once the
+        previews are written.
+        """
+        with self._getTimings().record('compressOutputStep'):
+            self._compressResults(self._getFileName('out_results'))
 
-            # remove useless output
-            cleanPath(self._getExtraPath('Results_vol/ResEMvolOut.mrc'))
+    def createDirectionalFSC(self):
+        """ Write the FSC of every direction if the program did not,
+        sampling the 3D FSC volume along the cone axes.
+        """
+        fn = self._getFileName('out_directionalFSC')
+        volFn = self._getFileName('out_vol3DFSC')
+        if os.path.exists(fn) or not os.path.exists(volFn):
+            return
+
+        directions = getDirections(self.dTheta.get())
+        freqs, fsc = sampleDirectionalFSC(
+            volFn, directions, self.inputVolume.get().getSamplingRate())
+        writeDirectionalFSC(fn, directions, freqs, fsc)
 
-            self._defineOutputs(**{outputs.outputVolume.name: vol})
-            self._defineSourceRelation(self.inputVolume, vol)
+    def createOutputStep(self):
+        with self._getTimings().record('createOutputStep'):
+            if os.path.exists(self._getFileName('out_vol3DFSC')):
+                inputVol = self.inputVolume.get()
+                vol = Volume()
+                vol.setObjLabel('3D FSC')
+                vol.setFileName(self._getFileName('out_vol3DFSC'))
+                vol.setSamplingRate(inputVol.getSamplingRate())
+
+                # remove useless output
+                cleanPath(self._getExtraPath('Results_vol/ResEMvolOut.mrc'))
+
+                results = readResults(self._getFileName('out_log'),
+                                      self._getFileName('out_globalFSC'),
+                                      self._getSamplingRate(),
+                                      self.fscCutoff.get())
+                results.update(self._calcAnisotropy(
+                    [self._getFileName('out_vol3DFSC')],
+                    inputVol.getSamplingRate())[0])
+                self._setResultAttributes(vol, results)
+
+                self._defineOutputs(**{outputs.outputVolume.name: vol})
+                self._defineSourceRelation(self.inputVolume, vol)
+
+            if os.path.exists(self._getFileName('out_localSphericity')):
+                vol = Volume()
+                vol.setObjLabel('local sphericity')
+                vol.setFileName(self._getFileName('out_localSphericity'))
+                vol.setSamplingRate(self.inputVolume.get().getSamplingRate())
+                self._defineOutputs(**{outputs.outputLocalSphericity.name: vol})
+                self._defineSourceRelation(self.inputVolume, vol)
 
     # --------------------------- INFO functions ------------------------------
     
     def _summary(self):
         summary = []
         if self.getOutputsSize() > 0:
-            logFn = self.getLogPaths()[0]
-            sph = self.findSphericity(logFn)
-            summary.append(f'Sphericity: {sph:0.3f}')
+            output = getattr(self, outputs.outputVolume.name)
+            summary.extend(self._getResultsSummary(output))
+            if self.resultFromCache:
+                summary.append('Results were restored from the cache.')
+            if self.precisionWarning:
+                summary.append('Warning: single precision changed the '
+                               'results of the precision check.')
         else:
             summary.append("Output is not ready yet.")
 
+        if os.path.exists(self._getExtraPath('sweep.csv')):
+            summary.append('Parameter sweep (hpFilter, fscCutoff, thrSph: '
+                           'sphericity, global/worst/best resolution):')
+            with open(self._getExtraPath('sweep.csv')) as f:
+                next(f)
+                for line in f:
+                    v = line.strip().split(',')
+                    summary.append(f'  {v[0]}, {v[1]}, {v[2]}: {v[3]}, '
+                                   f'{v[4]}/{v[5]}/{v[6]} A')
+
+        localTable = self._getExtraPath('local', 'windows.csv')
+        if os.path.exists(localTable):
+            with open(localTable) as f:
+                rows = [line.strip().split(',') for line in f][1:]
+            sph = [float(v[5]) for v in rows]
+            summary.append(f'Local 3D FSC of {len(rows)} regions: '
+                           f'sphericity {min(sph):0.3f} - {max(sph):0.3f}.')
+
+        if self.maskCropSize.hasValue():
+            summary.append(f'Inputs cropped to the mask: box '
+                           f'{self.maskCropSize.get()} at '
+                           f'({self.maskCropOrigin.get()}).')
+
+        if self.cropBoxSize.hasValue():
+            summary.append(f'Inputs cropped in Fourier space to box '
+                           f'{self.cropBoxSize.get()} '
+                           f'({self.cropSamplingRate.get():0.3f} A/px).')
+
+        timings = self._getTimings().getSummary()
+        if timings:
+            summary.append(timings)
+
+        if self.stagedInputs.hasValue():
+            staged = self.stagedInputs.get()
+            fullMap = self._getTimings().stages.get('convertFullMapStep', {})
+            if 'staging' in fullMap:
+                staged += f', input_volFn={fullMap["staging"]}'
+            summary.append(f'Input staging: {staged}')
+
         return summary
     
     def _validate(self):
-        errors = []
+        errors = Prot3DFSCBase._validate(self)
 
         if not self.provideHalfMaps and not self.inputVolume.get().hasHalfMaps():
             errors.append("Input volume has no associated half-maps.")
+
+        if self.doCrop:
+            samplingRate = self.inputVolume.get().getSamplingRate()
+            if not self.cropBox and self.cropResolution <= 2 * samplingRate:
+                errors.append("Target resolution for Fourier crop must be "
+                              "larger than Nyquist (%0.2f A)."
+                              % (2 * samplingRate))
+            if self.cropBox < 0:
+                errors.append("Cropped box size cannot be negative.")
+
+        if self.doAdaptive and self.engine == ENGINE_BUILTIN:
+            if self.adaptiveMargin < 2:
+                errors.append("Adaptive safety margin must be at least "
+                              "2 shells.")
+            if self.adaptiveTolerance < 0:
+                errors.append("Adaptive tolerance cannot be negative.")
+
+        if self.doLocal and not len(self.localMasks):
+            boxSize = self._estimateBoxSize()
+            if not 16 <= self.windowSize <= boxSize:
+                errors.append("Window size must be between 16 and the box "
+                              "size of the cropped maps (%d px)." % boxSize)
+            if self.windowStep < 1:
+                errors.append("Window step must be positive.")
                 
         return errors
     
@@ -240,26 +793,127 @@ class Prot3DFSC(ProtAnalysis3D):
                 '--halfmap2': os.path.relpath(self._getFileName('input_half2Fn'),
                                               self._getExtraPath()),
                 '--fullmap': os.path.relpath(self._getFileName('input_volFn'),
-                                             self._getExtraPath()),
-                '--apix': self.inputVolume.get().getSamplingRate(),
-                '--ThreeDFSC': 'vol',
-                '--dthetaInDegrees': self.dTheta.get(),
-                '--FSCCutoff': self.fscCutoff.get(),
-                '--ThresholdForSphericity': self.thrSph.get(),
-                '--HighPassFilter': self.hpFilter.get(),
-                '--numThresholdsForSphericityCalcs': self.numThr.get(),
-                '--histogram': 'histogram'
+                                             self._getExtraPath())
                 }
+        args.update(self._getExtraArgs(self._getSamplingRate()))
+        if self.engine == ENGINE_BUILTIN:
+            del args['--fullmap']  # plotted in its own step
+        if self.minimalOutputs and self.engine == ENGINE_BUILTIN:
+            del args['--histogram']  # no plots
+        if self.precision.get() == 1 and self.engine == ENGINE_BUILTIN:
+            args.update({'--precision': 'single',
+                         '--precisionTolerance': self.precisionTolerance.get()})
+        if self.doAdaptive and self.engine == ENGINE_BUILTIN:
+            args.update({'--adaptive': True,
+                         '--adaptiveMargin': self.adaptiveMargin.get(),
+                         '--adaptiveTolerance': self.adaptiveTolerance.get()})
         if self.applyMask and self.maskVolume:
             args['--mask'] = os.path.relpath(self._getFileName('input_maskFn'),
                                              self._getExtraPath())
         return args
 
-    def findSphericity(self, fn):
-        with open(fn, 'r') as f:
-            sph = 0.
-            for line in f:
-                if 'Sphericity is ' in line:
-                    sph = float(line.split()[2])
+    def _getCropBoxSize(self):
+        """ Return the box size to crop the inputs to in Fourier space,
+        or 0 if they are not cropped.
+        """
+        if not self.doCrop:
+            return 0
+
+        boxSize = self._getStagedBoxSize()
+        cropBoxSize = getCropBoxSize(boxSize,
+                                     self.inputVolume.get().getSamplingRate(),
+                                     self.cropResolution.get(),
+                                     self.cropBox.get())
+
+        return cropBoxSize if cropBoxSize < boxSize else 0
+
+    def _getCropSamplingRate(self):
+        return (self.inputVolume.get().getSamplingRate() *
+                self._getStagedBoxSize() / self._getCropBoxSize())
+
+    def _doMaskCrop(self):
+        return bool(self.applyMask and self.maskVolume.hasValue() and
+                    self.doMaskCrop)
+
+    def _getMaskCropOrigin(self):
+        return tuple(int(v) for v in self.maskCropOrigin.get().split())
 
-        return sph
+    def _estimateBoxSize(self):
+        """ Return the box size of the maps given to 3D FSC, after the
+        crop to the mask and the Fourier crop, before staging them. The
+        box of the mask is only known if the mask is an MRC file.
+        """
+        inputVol = self.inputVolume.get()
+        boxSize = inputVol.getXDim()
+        if self._doMaskCrop():
+            maskFn = self.maskVolume.get().getFileName()
+            if maskFn.endswith('.mrc') and os.path.exists(maskFn):
+                maskBox = getMaskBox(maskFn, self.maskCropMargin.get())
+                if maskBox is not None:
+                    boxSize = maskBox[1]
+        if self.doCrop and (self.cropBox > 0 or self.cropResolution > 0):
+            boxSize = getCropBoxSize(boxSize, inputVol.getSamplingRate(),
+                                     self.cropResolution.get(),
+                                     self.cropBox.get())
+
+        return boxSize
+
+    def _getStagedBoxSize(self):
+        """ Box size of the staged maps, before the Fourier crop. """
+        return self.maskCropSize.get() or self.inputVolume.get().getXDim()
+
+    def _getSamplingRate(self):
+        """ Sampling rate of the maps given to 3D FSC, that differs from
+        the input one after Fourier cropping.
+        """
+        if self.cropSamplingRate.hasValue():
+            return self.cropSamplingRate.get()
+
+        return self.inputVolume.get().getSamplingRate()
+
+    def _getTimings(self):
+        return Timings(self._getExtraPath('timings.json'))
+
+    def _storeAttributes(self, *attrs):
+        """ Store attributes set by steps that may run at the same time. """
+        with self._storeLock:
+            self._store(*attrs)
+
+    def _checkPrecision(self, log):
+        """ Warn if the log reports that single precision changed the
+        results of the precision check.
+        """
+        if PRECISION_WARNING in log:
+            self.warning("Single precision changed the results of the "
+                         "precision check, see the log.")
+            self.precisionWarning.set(True)
+            self._storeAttributes(self.precisionWarning)
+
+    def _getResultCache(self):
+        """ Return the cache of results, or None if its folder cannot be
+        written.
+        """
+        try:
+            return ResultCache(Plugin.getCachePath(), Plugin.getCacheSize())
+        except OSError as e:
+            self.warning("Results cache is not available: %s" % e)
+            return None
+
+    def _getCacheKey(self, cache, args):
+        """ Hash the input files and the remaining arguments, with the
+        versions of the plugin and of the engine.
+        """
+        fileArgs = ['--halfmap1', '--halfmap2', '--fullmap', '--mask']
+        files = [self._getExtraPath(args[k]) for k in fileArgs if k in args]
+        values = {k: v for k, v in args.items() if k not in fileArgs}
+        values['engine'] = self.getEnumText('engine')
+        values['pluginVersion'] = __version__
+        values['engineVersion'] = (ENGINE_VERSION
+                                   if self.engine == ENGINE_BUILTIN
+                                   else Plugin.getActiveVersion())
+
+        return cache.computeKey(files, values)
+
+    @staticmethod
+    def _getFloatList(param):
+        return [float(v) for v in param.get().replace(',', ' ').split()]
@@ -0,0 +1,299 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+from contextlib import contextmanager
+
+import pyworkflow.protocol.params as params
+import pyworkflow.utils as pwutils
+from pyworkflow.object import Float, CsvList
+from pwem.protocols import ProtAnalysis3D
+
+from .. import Plugin
+from ..cache import GeometryCache
+from ..convert import compressVolume
+from ..metrics import (loadVolumes, getBinarized, getPrincipalAxes,
+                       getAnisotropy)
+from ..engine import getSlabSize, getDirections, MAX_DIRECTIONS
+from ..constants import ENGINE_3DFSC, ENGINE_BUILTIN
+
+RESULT_PREFIX = '_fsc3d_'
+RESULT_KEYS = ['sphericity', 'globalResolution', 'minDirResolution',
+               'maxDirResolution', 'anisotropy']
+ANISOTROPY_BATCH = 16  # volumes binarized at once
+THRESHOLDED_VOLUMES = ['vol_Thresholded.mrc', 'vol_ThresholdedBinarized.mrc']
+
+
+class Prot3DFSCBase(ProtAnalysis3D):
+    """ Base class with the 3D FSC parameters shared by the protocols. """
+
+    # --------------------------- DEFINE param functions ----------------------
+
+    def _defineGpuParams(self, form):
+        form.addHidden(params.USE_GPU, params.BooleanParam,
+                       default=True,
+                       label="Use GPU?")
+        form.addHidden(params.GPU_LIST, params.StringParam,
+                       default='0',
+                       label="Choose GPU ID",
+                       help="Each GPU has a unique ID. If you have only "
+                            "one GPU, set ID to 0. A single 3DFSC program "
+                            "job can use only the first GPU of the list. "
+                            "The built-in engine runs on the CPU and "
+                            "ignores this list.")
+
+    def _defineExtraParams(self, form):
+        form.addSection(label='Extra params')
+        form.addParam('engine', params.EnumParam,
+                      choices=['3DFSC program', 'built-in'],
+                      default=ENGINE_3DFSC,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label='Calculate with',
+                      help='*3DFSC program*: run ThreeDFSC_Start.py in its '
+                           'own conda environment (can use GPU).\n'
+                           '*built-in*: CPU NumPy implementation running '
+                           'inside Scipion. It avoids the environment '
+                           'activation and compilation overhead and writes '
+                           'the same output files.')
+        form.addParam('memoryBudget', params.FloatParam, default=0,
+                      condition='engine==%d' % ENGINE_BUILTIN,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Memory budget (GB)',
+                      help='Maximum memory used by the built-in engine. If '
+                           'the Fourier transforms and work volumes do not '
+                           'fit, they are memory-mapped from disk in the '
+                           'results folder and processed in slabs. '
+                           '0 means no limit.')
+        form.addParam('checkpointInterval', params.FloatParam, default=0,
+                      condition='engine==%d' % ENGINE_BUILTIN,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Checkpoint interval (min)',
+                      help='The built-in engine saves the Fourier '
+                           'transforms and the partial FSC sums in a '
+                           'checkpoint folder of the results, the sums '
+                           'every this number of minutes. If the run is '
+                           'killed, continuing the protocol resumes from '
+                           'the last checkpoint with the same result. The '
+                           'folder is removed at the end of the run. '
+                           'Checkpoints write the transforms to disk, so '
+                           'only enable them for runs that take hours. '
+                           '0 disables checkpoints.')
+        form.addParam('compressOutputs', params.BooleanParam, default=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Compress thresholded volumes?',
+                      help='Store the binarized 3D FSC volume bit-packed '
+                           'and the thresholded one as gzipped float16 MRC '
+                           '(.mrc.gz), which take a small fraction of the '
+                           'space. The viewer decompresses them when '
+                           'needed. The 3D FSC volume, which is the output '
+                           'of the protocol, is kept as a float32 MRC.')
+        form.addParam('dTheta', params.FloatParam, default=20,
+                      label='Angle of cone (deg)',
+                      help='Angle of cone to be used for 3D FSC sampling in '
+                           'degrees. Default is 20 degrees.')
+        form.addParam('fscCutoff', params.FloatParam, default=0.143,
+                      label='FSC cutoff',
+                      help='FSC cutoff criterion. 0.143 is default.')
+        form.addParam('thrSph', params.FloatParam, default=0.5,
+                      label='Sphericity threshold',
+                      help='Threshold value for 3DFSC volume for calculating '
+                           'sphericity. 0.5 is default.')
+        form.addParam('hpFilter', params.FloatParam, default=200,
+                      label='High-pass filter (A)',
+                      help='High-pass filter for thresholding in Angstrom. '
+                           'Prevents small dips in directional FSCs at low '
+                           'spatial frequency due to noise from messing up '
+                           'the thresholding step. Decrease if you see a '
+                           'huge wedge missing from your thresholded 3DFSC '
+                           'volume. 200 Angstroms is default.')
+        form.addParam('numThr', params.IntParam, default=0,
+                      label='Number of threshold for sphericity',
+                      help='Calculate sphericities at different threshold '
+                           'cutoffs to determine sphericity deviation across '
+                           'spatial frequencies. This can be useful to '
+                           'evaluate possible effects of overfitting or '
+                           'improperly assigned orientations. 0 is default.')
+
+    # --------------------------- INFO functions ------------------------------
+
+    def _validate(self):
+        """ Check the parameters shared by the protocols. """
+        errors = []
+
+        if (self.engine == ENGINE_BUILTIN and
+                len(getDirections(self.dTheta.get())) > MAX_DIRECTIONS):
+            errors.append("Angle of cone is too small for the built-in "
+                          "engine (at most %d directions)." % MAX_DIRECTIONS)
+
+        return errors
+
+    # --------------------------- UTILS functions -----------------------------
+
+    def _getExtraArgs(self, samplingRate):
+        """ Prepare the args dictionary without the input files. """
+        return {'--apix': samplingRate,
+                '--ThreeDFSC': 'vol',
+                '--dthetaInDegrees': self.dTheta.get(),
+                '--FSCCutoff': self.fscCutoff.get(),
+                '--ThresholdForSphericity': self.thrSph.get(),
+                '--HighPassFilter': self.hpFilter.get(),
+                '--numThresholdsForSphericityCalcs': self.numThr.get(),
+                '--histogram': 'histogram'
+                }
+
+    def _getCheckpointArgs(self):
+        """ Keyword arguments of the built-in engine for checkpoints. """
+        if not self.checkpointInterval.get():
+            return {}
+
+        return {'checkpoint': 'checkpoint',
+                'checkpointInterval': self.checkpointInterval.get() * 60}
+
+    def _calcAnisotropy(self, fns, samplingRate):
+        """ Return the principal-axis anisotropy of the 3D FSC volumes of
+        the same box, the only result that is not parsed from the 3D FSC
+        output: a list with a dictionary per volume. Volumes are loaded
+        in batches.
+        """
+        results = []
+        for start in range(0, len(fns), ANISOTROPY_BATCH):
+            vols, apix = loadVolumes(fns[start:start + ANISOTROPY_BATCH],
+                                     samplingRate)
+            binarized = getBinarized(vols, apix, self.thrSph.get(),
+                                     self.hpFilter.get())
+            anisotropy = getAnisotropy(getPrincipalAxes(binarized))
+            results.extend({'anisotropy': float(a)} for a in anisotropy)
+
+        return results
+
+    def _compressResults(self, resultsDir):
+        """ Compress the thresholded volumes of a results folder. """
+        for fn in THRESHOLDED_VOLUMES:
+            fn = os.path.join(resultsDir, fn)
+            if os.path.exists(fn):
+                size = os.path.getsize(fn)
+                compressedFn = compressVolume(fn)
+                self.info("Compressed %s: %d -> %d bytes"
+                          % (compressedFn, size,
+                             os.path.getsize(compressedFn)))
+
+    def _getGpuIds(self):
+        return pwutils.getListFromRangeString(self.gpuList.get())
+
+    def _getEngineSteps(self):
+        """ Number of steps running the engine that can run at the same
+        time, when steps run in parallel.
+        """
+        return 1
+
+    def _getEngineThreads(self):
+        """ Threads available to the built-in engine in one step. When
+        steps run in parallel, one thread is kept for the other steps
+        and the rest are shared by the engine steps that run at the same
+        time (at most one per step thread).
+        """
+        threads = self.numberOfThreads.get()
+        if self.stepsExecutionMode == params.STEPS_PARALLEL and threads > 1:
+            threads -= 1
+            return max(1, threads // min(threads, self._getEngineSteps()))
+
+        return threads
+
+    def _getNumberOfWorkers(self):
+        """ Number of processes used by the built-in engine, that splits
+        the cone directions among them.
+        """
+        return self._getEngineThreads()
+
+    @contextmanager
+    def _useGeometry(self, boxSize):
+        """ Yield the folder with the cached geometry of the box used by
+        the built-in engine (shells, cone membership and nearest
+        directions), written on first use and kept while in use. Yield
+        None if it does not fit in the cache or the cache folder cannot
+        be written, the engine then computes the geometry on the fly.
+        """
+        try:
+            cache = GeometryCache(Plugin.getCachePath(),
+                                  Plugin.getCacheSize())
+        except OSError as e:
+            self.warning("Geometry cache is not available: %s" % e)
+            cache = None
+
+        if cache is None:
+            yield None
+        else:
+            with cache.use(boxSize, self.dTheta.get(),
+                           getSlabSize(boxSize,
+                                       self.memoryBudget.get())) as path:
+                yield path
+
+    @staticmethod
+    def _getParamsStr(args):
+        return ' '.join(['%s=%s' % (k, str(v)) for k, v in args.items()])
+
+    def _setResultAttributes(self, vol, results):
+        """ Store the parsed 3D FSC results as attributes of the volume,
+        so they can be read without parsing the logs again.
+        """
+        for key in RESULT_KEYS:
+            setattr(vol, RESULT_PREFIX + key, Float(results.get(key)))
+
+        pairs = results.get('thresholdSphericity', [])
+        thresholds = CsvList(pType=float)
+        thresholds.set([thr for thr, _ in pairs])
+        sphericities = CsvList(pType=float)
+        sphericities.set([sph for _, sph in pairs])
+        setattr(vol, RESULT_PREFIX + 'thresholds', thresholds)
+        setattr(vol, RESULT_PREFIX + 'thresholdSphericities', sphericities)
+
+    @staticmethod
+    def getResult(vol, key):
+        """ Return a stored 3D FSC result of a volume, or None. """
+        attr = getattr(vol, RESULT_PREFIX + key, None)
+
+        return None if attr is None else attr.get()
+
+    def _getResultsSummary(self, vol):
+        """ Summary lines of the results stored in the volume. """
+        summary = []
+        labels = [('sphericity', 'Sphericity: %0.3f'),
+                  ('globalResolution', 'Global resolution: %0.2f A'),
+                  ('minDirResolution', 'Worst directional resolution: %0.2f A'),
+                  ('maxDirResolution', 'Best directional resolution: %0.2f A'),
+                  ('anisotropy', 'Principal-axis anisotropy: %0.2f')]
+        for key, label in labels:
+            value = self.getResult(vol, key)
+            if value is not None:
+                summary.append(label % value)
+
+        thresholds = self.getResult(vol, 'thresholds') or []
+        sphericities = self.getResult(vol, 'thresholdSphericities') or []
+        if len(thresholds):
+            summary.append('Sphericity at thresholds: ' + ', '.join(
+                '%0.2f: %0.3f' % p for p in zip(thresholds, sphericities)))
+
+        return summary
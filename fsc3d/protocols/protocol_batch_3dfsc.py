@@ -0,0 +1,254 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import queue
+from enum import Enum
+
+import pyworkflow.protocol.params as params
+import pyworkflow.utils as pwutils
+from pyworkflow.constants import BETA
+from pwem.objects import Volume, SetOfVolumes
+
+from .. import Plugin
+from ..constants import ENGINE_3DFSC, ENGINE_BUILTIN
+from ..convert import stageInput, readResults
+from ..engine import openMap
+from .protocol_base import Prot3DFSCBase
+
+
+class outputs(Enum):
+    outputVolumes = SetOfVolumes
+
+
+class ProtBatch3DFSC(Prot3DFSCBase):
+    """ Protocol to calculate 3D FSC for a set of volumes.
+
+    Every volume of the set must have associated half maps. All half-map
+    pairs are scheduled on a pool of workers (see the Parallelization
+    section): each worker runs the built-in engine in its own process or
+    the 3DFSC program, using a free GPU from the list if there is one.
+    """
+    _label = 'estimate resolution (batch)'
+    _devStatus = BETA
+    _possibleOutputs = outputs
+
+    def __init__(self, **kwargs):
+        Prot3DFSCBase.__init__(self, **kwargs)
+        self.stepsExecutionMode = params.STEPS_PARALLEL
+        self._gpuSlots = None
+
+    # --------------------------- DEFINE param functions ----------------------
+
+    def _defineParams(self, form):
+        self._defineGpuParams(form)
+
+        form.addSection(label='Input')
+        form.addParam('inputVolumes', params.PointerParam,
+                      pointerClass='SetOfVolumes',
+                      label="Input volumes", important=True,
+                      help='Set of volumes with associated half maps, '
+                           'e.g. several classes or refinement iterations.')
+        form.addParam('applyMask', params.BooleanParam, default=False,
+                      label="Mask input volumes?",
+                      help='If given, it would be used to mask the half maps '
+                           'of all volumes during 3DFSC generation and '
+                           'analysis.')
+        form.addParam('maskVolume', params.PointerParam, label="Mask volume",
+                      pointerClass='VolumeMask', condition="applyMask",
+                      help='Select a volume to apply as a mask.')
+
+        self._defineExtraParams(form)
+
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions ----------------------
+
+    def _insertAllSteps(self):
+        self._initGpuSlots()
+        deps = []
+        if self.applyMask:
+            deps.append(self._insertFunctionStep('convertMaskStep',
+                                                 prerequisites=[]))
+
+        stepIds = []
+        for vol in self.inputVolumes.get():
+            half1, half2 = vol.getHalfMaps().split(',')
+            stepIds.append(self._insertFunctionStep('runItemStep',
+                                                    vol.getObjId(),
+                                                    half1, half2,
+                                                    vol.getFileName(),
+                                                    prerequisites=deps))
+        self._insertFunctionStep('createOutputStep', prerequisites=stepIds)
+
+    # --------------------------- STEPS functions -----------------------------
+
+    def convertMaskStep(self):
+        stageInput(self.maskVolume.get().getLocation(), self._getMaskFn(),
+                   self._getSamplingRate())
+
+    def runItemStep(self, volId, half1, half2, fullMap):
+        """ Stage the inputs of one volume and run 3D FSC on them. """
+        tmpDir = self._getTmpPath(self._getItemDir(volId))
+        outDir = self._getExtraPath(self._getItemDir(volId))
+        pwutils.makePath(tmpDir, outDir)
+
+        samplingRate = self._getSamplingRate()
+        args = {}
+        for key, location in [('--halfmap1', half1), ('--halfmap2', half2),
+                              ('--fullmap', fullMap)]:
+            fn = os.path.join(tmpDir, key.lstrip('-') + '.mrc')
+            method = stageInput(location, fn, samplingRate)
+            self.info("Volume %d: staged %s (%s)" % (volId, fn, method))
+            args[key] = os.path.relpath(fn, outDir)
+        args.update(self._getExtraArgs(samplingRate))
+        if self.applyMask:
+            args['--mask'] = os.path.relpath(self._getMaskFn(), outDir)
+
+        params = self._getParamsStr(args)
+        redirect = ' > %s 2>&1' % os.path.basename(self._getItemLog(volId))
+
+        if self.engine == ENGINE_BUILTIN:
+            params += ' --memory=%s --workers=%d' % (
+                self.memoryBudget.get(), self._getNumberOfWorkers())
+            boxSize = openMap(os.path.join(tmpDir, 'halfmap1.mrc')).shape[0]
+            for key, value in self._getCheckpointArgs().items():
+                params += ' --%s=%s' % (key, value)
+            with self._useGeometry(boxSize) as geometry:
+                if geometry:
+                    params += ' --geometry=%s' % geometry
+                Plugin.runEngine(self, params + redirect, cwd=outDir)
+        else:
+            gpuId = self._acquireGpu()
+            try:
+                if gpuId is not None:
+                    params += ' --gpu --gpu_id=%s' % gpuId
+                Plugin.runProgram(self, params + redirect, cwd=outDir)
+            finally:
+                self._releaseGpu(gpuId)
+
+        if not os.path.exists(self._getItemResult(volId, 'vol.mrc')):
+            raise RuntimeError('3D FSC run failed for volume %d! See %s'
+                               % (volId, self._getItemLog(volId)))
+        if self.compressOutputs:
+            self._compressResults(os.path.dirname(
+                self._getItemResult(volId, 'vol.mrc')))
+
+    def createOutputStep(self):
+        samplingRate = self._getSamplingRate()
+        volSet = self._createSetOfVolumes()
+        volSet.setSamplingRate(samplingRate)
+        inputVols = [vol.clone() for vol in self.inputVolumes.get()]
+        metrics = self._calcAnisotropy(
+            [self._getItemResult(v.getObjId(), 'vol.mrc') for v in inputVols],
+            samplingRate)
+
+        for inputVol, volMetrics in zip(inputVols, metrics):
+            volId = inputVol.getObjId()
+            vol = Volume()
+            vol.setObjId(volId)
+            vol.setObjLabel(inputVol.getObjLabel())
+            vol.setFileName(self._getItemResult(volId, 'vol.mrc'))
+            vol.setSamplingRate(samplingRate)
+            results = readResults(
+                self._getItemLog(volId),
+                self._getItemResult(volId, 'ResEMvolOutglobalFSC.csv'),
+                samplingRate, self.fscCutoff.get())
+            results.update(volMetrics)
+            self._setResultAttributes(vol, results)
+            volSet.append(vol)
+
+        self._defineOutputs(**{outputs.outputVolumes.name: volSet})
+        self._defineSourceRelation(self.inputVolumes, volSet)
+
+    # --------------------------- INFO functions ------------------------------
+
+    def _summary(self):
+        summary = []
+        if self.getOutputsSize() > 0:
+            output = getattr(self, outputs.outputVolumes.name)
+            for vol in output:
+                summary.append('Volume %d:' % vol.getObjId())
+                summary.extend('  ' + line
+                               for line in self._getResultsSummary(vol))
+        else:
+            summary.append("Output is not ready yet.")
+
+        return summary
+
+    def _validate(self):
+        errors = Prot3DFSCBase._validate(self)
+
+        if self.applyMask and not self.maskVolume.hasValue():
+            errors.append("Mask volume is required to mask the half maps.")
+
+        for vol in self.inputVolumes.get():
+            if not vol.hasHalfMaps():
+                errors.append("Volume %d has no associated half-maps."
+                              % vol.getObjId())
+
+        return errors
+
+    # --------------------------- UTILS functions -----------------------------
+
+    def _getSamplingRate(self):
+        return self.inputVolumes.get().getSamplingRate()
+
+    def _getMaskFn(self):
+        return self._getTmpPath('mask.mrc')
+
+    def _getEngineSteps(self):
+        return self.inputVolumes.get().getSize()
+
+    @staticmethod
+    def _getItemDir(volId):
+        return 'vol%06d' % volId
+
+    def _getItemLog(self, volId):
+        return self._getExtraPath(self._getItemDir(volId), 'run.log')
+
+    def _getItemResult(self, volId, fn):
+        return self._getExtraPath(self._getItemDir(volId), 'Results_vol', fn)
+
+    def _initGpuSlots(self):
+        """ Fill the queue shared by the workers with the GPUs to use. """
+        self._gpuSlots = queue.Queue()
+        if self.useGpu and self.engine == ENGINE_3DFSC:
+            for gpuId in self._getGpuIds():
+                self._gpuSlots.put(gpuId)
+
+    def _acquireGpu(self):
+        """ Take a free GPU from the list, or None if all of them are
+        busy (or GPU is not used) so the job runs on CPU.
+        """
+        try:
+            return self._gpuSlots.get_nowait()
+        except queue.Empty:
+            return None
+
+    def _releaseGpu(self, gpuId):
+        if gpuId is not None:
+            self._gpuSlots.put(gpuId)
@@ -0,0 +1,331 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+from enum import Enum
+
+import pyworkflow.protocol.params as params
+import pyworkflow.utils as pwutils
+from pyworkflow.constants import BETA
+from pyworkflow.protocol.constants import STATUS_NEW
+from pwem.objects import Volume, SetOfVolumes
+
+from .. import Plugin
+from ..constants import ENGINE_BUILTIN
+from ..convert import (stageInput, readResults, readMrcHeader,
+                       findHalfMapPairs)
+from ..engine import openMap, runFromArgs
+from .protocol_base import Prot3DFSCBase
+
+
+class outputs(Enum):
+    outputVolumes = SetOfVolumes
+
+
+class ProtStream3DFSC(Prot3DFSCBase):
+    """ Protocol to calculate 3D FSC of the iterations of a running
+    refinement.
+
+    The folder of the refinement protocol is checked periodically for new
+    half maps, e.g. the ones written by Relion after each iteration. Each
+    new pair is analyzed as soon as it is complete, and the 3D FSC volume
+    with its sphericity and directional resolutions is added to the output
+    set. The protocol finishes when the refinement is not running anymore
+    and all its iterations are analyzed.
+    """
+    _label = 'estimate resolution (streaming)'
+    _devStatus = BETA
+    _possibleOutputs = outputs
+
+    def __init__(self, **kwargs):
+        Prot3DFSCBase.__init__(self, **kwargs)
+        self._iterationSteps = {}  # label: step of the inserted iterations
+        self._outputLabels = set()
+        self._maskSteps = []
+        self._closeStepId = None
+
+    # --------------------------- DEFINE param functions ----------------------
+
+    def _defineParams(self, form):
+        self._defineGpuParams(form)
+
+        form.addSection(label='Input')
+        form.addParam('inputProtocol', params.PointerParam,
+                      pointerClass='EMProtocol',
+                      label="Refinement protocol", important=True,
+                      help='Running (or finished) refinement protocol '
+                           'that writes the half maps of each iteration.')
+        form.addParam('halfMapPattern', params.StringParam,
+                      default='extra/*_it[0-9][0-9][0-9]_half1_class001.mrc',
+                      label="First half maps pattern",
+                      help='Pattern of the first half maps, relative to '
+                           'the folder of the refinement protocol. The '
+                           'second half of each iteration has the same '
+                           'name with "half2" instead of "half1". The '
+                           'default matches the iterations of Relion '
+                           'auto-refine.')
+        form.addParam('samplingRate', params.FloatParam, default=0,
+                      label="Pixel size (A)",
+                      help='Pixel size of the half maps. If 0, it is read '
+                           'from the header of the first half map.')
+        form.addParam('applyMask', params.BooleanParam, default=False,
+                      label="Mask input volumes?",
+                      help='If given, it would be used to mask the half maps '
+                           'of all iterations during 3DFSC generation and '
+                           'analysis.')
+        form.addParam('maskVolume', params.PointerParam, label="Mask volume",
+                      pointerClass='VolumeMask', condition="applyMask",
+                      help='Select a volume to apply as a mask.')
+        form.addParam('checkInterval', params.IntParam, default=60,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Check for new iterations every (s)",
+                      help='Half maps modified less than this time ago are '
+                           'not used yet, since they may be still being '
+                           'written.')
+        form.addParam('useWorker', params.BooleanParam, default=True,
+                      condition='engine!=%d' % ENGINE_BUILTIN,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Run on persistent worker?",
+                      help='Send the iterations to a persistent 3DFSC '
+                           'worker process, so the 3DFSC environment is '
+                           'activated and compiled only once.')
+
+        self._defineExtraParams(form)
+
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions ----------------------
+
+    def _insertAllSteps(self):
+        self._stepsCheckSecs = self.checkInterval.get()
+        output = getattr(self, outputs.outputVolumes.name, None)
+        if output is not None:
+            self._outputLabels = {vol.getObjLabel() for vol in output}
+
+        if self.applyMask:
+            self._maskSteps = [self._insertFunctionStep('convertMaskStep',
+                                                        prerequisites=[])]
+        self._insertNewSteps(self.checkInterval.get())
+        self._closeStepId = self._insertFunctionStep(
+            'closeOutputStep', wait=True,
+            prerequisites=list(self._iterationSteps.values()))
+
+    def _insertNewSteps(self, delay):
+        """ Insert a step for each new pair of half maps not modified in
+        the last delay seconds. Return the ids of the new steps.
+        """
+        pattern = os.path.join(self.inputProtocol.get().getWorkingDir(),
+                               self.halfMapPattern.get())
+        stepIds = []
+        for label, half1, half2 in findHalfMapPairs(pattern, delay):
+            if label in self._iterationSteps or label in self._outputLabels:
+                continue
+            stepId = self._insertFunctionStep('runIterationStep', label,
+                                              half1, half2,
+                                              prerequisites=self._maskSteps)
+            self._iterationSteps[label] = stepId
+            stepIds.append(stepId)
+
+        return stepIds
+
+    def _stepsCheck(self):
+        self._checkNewIterations()
+        self._updateOutput()
+
+    def _checkNewIterations(self):
+        closeStep = self._steps[self._closeStepId - 1]
+        # the maps of a finished refinement are complete
+        active = self._isInputActive()
+        stepIds = self._insertNewSteps(self.checkInterval.get()
+                                       if active else 0)
+        if stepIds:
+            closeStep.addPrerequisites(*stepIds)
+            self.updateSteps()
+        elif closeStep.isWaiting() and not active:
+            self.info("Refinement finished, closing the output.")
+            closeStep.setStatus(STATUS_NEW)
+
+    # --------------------------- STEPS functions -----------------------------
+
+    def convertMaskStep(self):
+        mask = self.maskVolume.get()
+        stageInput(mask.getLocation(), self._getMaskFn(),
+                   mask.getSamplingRate())
+
+    def runIterationStep(self, label, half1, half2):
+        """ Stage the half maps of one iteration and run 3D FSC on them.
+        The built-in engine runs in this process, reusing the imported
+        modules and the cached geometry of the box. The 3DFSC program
+        runs on the persistent worker if it is enabled.
+        """
+        tmpDir = self._getTmpPath(label)
+        outDir = self._getExtraPath(label)
+        pwutils.makePath(tmpDir, outDir)
+
+        samplingRate = self._getSamplingRate(half1)
+        args = {}
+        for key, location in [('--halfmap1', half1), ('--halfmap2', half2)]:
+            fn = os.path.join(tmpDir, key.lstrip('-') + '.mrc')
+            method = stageInput(location, fn, samplingRate)
+            self.info("Iteration %s: staged %s (%s)" % (label, fn, method))
+            args[key] = os.path.relpath(fn, outDir)
+        args.update(self._getExtraArgs(samplingRate))
+        if self.applyMask:
+            args['--mask'] = os.path.relpath(self._getMaskFn(), outDir)
+
+        logFn = self._getItemLog(label)
+        # the output of every iteration goes to its own log, where the
+        # results are read from, not to the one of the protocol
+        with open(logFn, 'w') as log:
+            if self.engine == ENGINE_BUILTIN:
+                boxSize = openMap(os.path.join(tmpDir,
+                                               'halfmap1.mrc')).shape[0]
+                with self._useGeometry(boxSize) as geometry:
+                    runFromArgs(args, cwd=outDir,
+                                workers=self._getNumberOfWorkers(),
+                                memory=self.memoryBudget.get(),
+                                geometry=geometry, log=log,
+                                **self._getCheckpointArgs())
+            else:
+                # the program needs a full map for its FT plots
+                args['--fullmap'] = args['--halfmap1']
+                params = self._getParamsStr(args)
+                if self.useGpu:
+                    params += ' --gpu --gpu_id=%s' % self._getGpuIds()[0]
+                Plugin.runProgram(self, params, cwd=outDir,
+                                  useWorker=self.useWorker.get(), log=log)
+
+        if not os.path.exists(self._getItemResult(label, 'vol.mrc')):
+            raise RuntimeError('3D FSC run failed for iteration %s! See %s'
+                               % (label, logFn))
+        if self.compressOutputs:
+            self._compressResults(os.path.dirname(
+                self._getItemResult(label, 'vol.mrc')))
+
+    def closeOutputStep(self):
+        self._updateOutput(closed=True)
+
+    # --------------------------- INFO functions ------------------------------
+
+    def _summary(self):
+        summary = []
+        output = getattr(self, outputs.outputVolumes.name, None)
+        if output is not None:
+            for vol in output:
+                summary.append('%s:' % vol.getObjLabel())
+                summary.extend('  ' + line
+                               for line in self._getResultsSummary(vol))
+        else:
+            summary.append("No iterations analyzed yet.")
+
+        return summary
+
+    def _validate(self):
+        errors = Prot3DFSCBase._validate(self)
+
+        if 'half1' not in self.halfMapPattern.get():
+            errors.append('The half maps pattern must contain "half1".')
+
+        return errors
+
+    # --------------------------- UTILS functions -----------------------------
+
+    def _updateOutput(self, closed=False):
+        """ Add the finished iterations to the output set, and close it
+        if requested.
+        """
+        labels = [label for label, stepId in self._iterationSteps.items()
+                  if label not in self._outputLabels and
+                  self._steps[stepId - 1].isFinished()]
+        outputName = outputs.outputVolumes.name
+        volSet = getattr(self, outputName, None)
+        if not labels and (volSet is None or not closed):
+            return
+
+        if volSet is None:
+            volSet = self._createSetOfVolumes()
+            volSet.setSamplingRate(self._getSamplingRate(
+                self._getItemResult(labels[0], 'vol.mrc')))
+            volSet.setStreamState(volSet.STREAM_OPEN)
+            define = True
+        else:
+            volSet.enableAppend()
+            define = False
+
+        samplingRate = volSet.getSamplingRate()
+        metrics = self._calcAnisotropy(
+            [self._getItemResult(label, 'vol.mrc') for label in labels],
+            samplingRate)
+        for label, volMetrics in zip(labels, metrics):
+            vol = Volume()
+            vol.setObjLabel(label)
+            vol.setFileName(self._getItemResult(label, 'vol.mrc'))
+            vol.setSamplingRate(samplingRate)
+            results = readResults(
+                self._getItemLog(label),
+                self._getItemResult(label, 'ResEMvolOutglobalFSC.csv'),
+                samplingRate, self.fscCutoff.get())
+            results.update(volMetrics)
+            self._setResultAttributes(vol, results)
+            volSet.append(vol)
+            self._outputLabels.add(label)
+            self.info("Iteration %s: sphericity %0.3f"
+                      % (label, results.get('sphericity', 0)))
+
+        if closed:
+            volSet.setStreamState(volSet.STREAM_CLOSED)
+        volSet.write()
+        if define:
+            self._defineOutputs(**{outputName: volSet})
+        else:
+            self._store(volSet)
+        volSet.close()
+
+    def _isInputActive(self):
+        """ Check if the refinement protocol is still running, reading
+        its current status from the project.
+        """
+        prot = self.inputProtocol.get()
+        prot = self.getProject().getProtocol(prot.getObjId()) or prot
+
+        return prot.isActive()
+
+    def _getSamplingRate(self, fn):
+        """ Pixel size given in the form, or read from a map header. """
+        if self.samplingRate.get():
+            return self.samplingRate.get()
+
+        return readMrcHeader(fn)[2]
+
+    def _getMaskFn(self):
+        return self._getTmpPath('mask.mrc')
+
+    def _getItemLog(self, label):
+        return self._getExtraPath(label, 'run.log')
+
+    def _getItemResult(self, label, fn):
+        return self._getExtraPath(label, 'Results_vol', fn)
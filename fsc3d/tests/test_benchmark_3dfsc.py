@@ -0,0 +1,197 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Benchmark of Prot3DFSC with synthetic half maps.
+
+The half maps share a random signal and have independent noise, with a
+spectral SNR that makes the FSC drop to 0.5 on a spheroid. The principal
+axes of the 3D FSC volume must have the ratio of the spheroid axes (the
+anisotropy, z axis to the other ones). The sphericity of 3D FSC is not
+the one of the spheroid (cones smooth the surface), it is only checked
+to be lower for a spheroid than for a sphere of the same box size. The
+timings of every step and engine phase are saved to a JSON file, that
+can be compared with a baseline from a previous run.
+
+Environment variables:
+    FSC3D_BENCHMARK_SIZES: box sizes, default '64 128' (up to '... 512')
+    FSC3D_BENCHMARK_OUTPUT: JSON file to write the results to
+    FSC3D_BENCHMARK_BASELINE: JSON file of a previous run to compare with
+    FSC3D_BENCHMARK_TOLERANCE: allowed slowdown vs baseline, default 0.5
+"""
+
+import os
+import sys
+import json
+import platform
+
+import numpy as np
+import mrcfile
+from pyworkflow.utils import magentaStr
+from pyworkflow.tests import setupTestProject
+
+from ..protocols import Prot3DFSC
+from ..constants import ENGINE_BUILTIN
+from .test_protocols_3dfsc import Test3DFSCBase
+
+SAMPLING_RATE = 1.0
+ANISOTROPIES = [1.0, 0.8]
+FSC_RADIUS = 0.35  # radius of the FSC=0.5 sphere, fraction of the box
+FSC_FALLOFF = 32  # steepness of the FSC drop
+ANISOTROPY_TOLERANCE = 0.05  # below the difference between anisotropies
+MIN_TIME = 0.5  # seconds, shorter stages are not compared to the baseline
+
+
+def makeHalfMaps(boxSize, anisotropy, seed=0):
+    """ Return two half maps with FSC = 1 / (1 + r^FSC_FALLOFF), where r
+    is the radius scaled so the FSC=0.5 surface is a spheroid.
+    """
+    rng = np.random.default_rng(seed)
+    k = np.fft.fftfreq(boxSize)
+    kz, ky, kx = np.meshgrid(k, k, np.fft.rfftfreq(boxSize), indexing='ij',
+                             sparse=True)
+    r = np.sqrt((kz / anisotropy) ** 2 + ky ** 2 + kx ** 2) / FSC_RADIUS
+    noise = r ** (FSC_FALLOFF / 2.)
+    shape = (boxSize,) * 3
+    signal = np.fft.rfftn(rng.standard_normal(shape))
+
+    return [np.fft.irfftn(signal + noise *
+                          np.fft.rfftn(rng.standard_normal(shape)),
+                          s=shape).astype(np.float32) for _ in range(2)]
+
+
+def writeMap(fn, data):
+    with mrcfile.new(fn, overwrite=True) as mrc:
+        mrc.set_data(data)
+        mrc.voxel_size = SAMPLING_RATE
+
+
+class TestBenchmark3DFSC(Test3DFSCBase):
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        sizes = os.environ.get('FSC3D_BENCHMARK_SIZES', '64 128')
+        cls.cases = []
+        for boxSize in [int(s) for s in sizes.split()]:
+            for anisotropy in ANISOTROPIES:
+                print(magentaStr("\n==> Importing data - %d px, "
+                                 "anisotropy %s:" % (boxSize, anisotropy)))
+                fns = [cls.getOutputPath('bench_%d_%s_%s.mrc'
+                                         % (boxSize, anisotropy, suffix))
+                       for suffix in ['half1', 'half2', 'full']]
+                half1, half2 = makeHalfMaps(boxSize, anisotropy)
+                for fn, data in zip(fns, [half1, half2, (half1 + half2) / 2]):
+                    writeMap(fn, data)
+                protImport = cls.runImportVolumes(SAMPLING_RATE, fns[2],
+                                                  fns[0], fns[1])
+                cls.cases.append((boxSize, anisotropy, protImport))
+
+    def test_benchmark(self):
+        results = []
+        for boxSize, anisotropy, protImport in self.cases:
+            print(magentaStr("\n==> Benchmark fsc3d - %d px, anisotropy %s:"
+                             % (boxSize, anisotropy)))
+            protFsc = self.newProtocol(Prot3DFSC,
+                                       objLabel='benchmark %d %s'
+                                                % (boxSize, anisotropy),
+                                       inputVolume=protImport.outputVolume,
+                                       engine=ENGINE_BUILTIN,
+                                       useCache=False)
+            self.launchProtocol(protFsc)
+            results.append(self._getResult(protFsc, boxSize, anisotropy))
+
+        benchmark = {'environment': {'python': sys.version.split()[0],
+                                     'numpy': np.__version__,
+                                     'platform': platform.platform(),
+                                     'cpus': os.cpu_count()},
+                     'results': results}
+        outputFn = os.environ.get('FSC3D_BENCHMARK_OUTPUT',
+                                  self.getOutputPath('benchmark.json'))
+        with open(outputFn, 'w') as f:
+            json.dump(benchmark, f, indent=2)
+        print("Benchmark results written to %s" % outputFn)
+
+        sphericity = {(r['boxSize'], r['anisotropy']): r['sphericity']
+                      for r in results}
+        for r in results:
+            # a sphere has the highest sphericity of all shapes
+            sphere = sphericity.get((r['boxSize'], 1.0))
+            if r['anisotropy'] < 1.0 and sphere is not None:
+                self.assertLess(r['sphericity'], sphere,
+                                "Sphericity of %d px, anisotropy %s"
+                                % (r['boxSize'], r['anisotropy']))
+            # ratio of the longest to the shortest axis of the spheroid
+            self.assertAlmostEqual(r['principalAnisotropy'],
+                                   1. / r['anisotropy'],
+                                   delta=ANISOTROPY_TOLERANCE,
+                                   msg="Principal-axis anisotropy of %d px, "
+                                       "anisotropy %s"
+                                       % (r['boxSize'], r['anisotropy']))
+
+        baselineFn = os.environ.get('FSC3D_BENCHMARK_BASELINE')
+        if baselineFn:
+            self._compareBaseline(results, baselineFn)
+
+    def _getResult(self, protFsc, boxSize, anisotropy):
+        """ Collect sphericity and timings of a finished protocol. """
+        stages = protFsc._getTimings().stages
+        phases = {}
+        for phase in stages['run3DFSCStep'].get('phases', []):
+            phases[phase['title'].split(' of ')[0]] = phase['wall']
+
+        return {'boxSize': boxSize,
+                'anisotropy': anisotropy,
+                'sphericity': protFsc.getResult(protFsc.outputVolume,
+                                                'sphericity'),
+                'principalAnisotropy': protFsc.getResult(
+                    protFsc.outputVolume, 'anisotropy'),
+                'stages': {name: s['wall'] for name, s in stages.items()},
+                'phases': phases,
+                'peakRss': max(s['peakRss'] for s in stages.values())}
+
+    def _compareBaseline(self, results, baselineFn):
+        """ Check that no stage is slower than the baseline by more
+        than the tolerance.
+        """
+        tolerance = float(os.environ.get('FSC3D_BENCHMARK_TOLERANCE', 0.5))
+        with open(baselineFn) as f:
+            baseline = {(r['boxSize'], r['anisotropy']): r
+                        for r in json.load(f)['results']}
+
+        for r in results:
+            ref = baseline.get((r['boxSize'], r['anisotropy']))
+            if ref is None:
+                continue
+            for name, wall in ref['stages'].items():
+                if wall < MIN_TIME or name not in r['stages']:
+                    continue
+                print("%d px, %s: %s %0.2f s (baseline %0.2f s)"
+                      % (r['boxSize'], r['anisotropy'], name,
+                         r['stages'][name], wall))
+                self.assertLessEqual(r['stages'][name],
+                                     wall * (1 + tolerance),
+                                     "%s is slower than the baseline for "
+                                     "%d px" % (name, r['boxSize']))
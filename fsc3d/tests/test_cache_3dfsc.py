@@ -0,0 +1,141 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Unit tests of the cache of results. They do not need a Scipion project.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..cache import ResultCache, GeometryCache, getTreeSize
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp(prefix='fsc3d_test_')
+        self.cachePath = os.path.join(self.workDir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir, ignore_errors=True)
+
+    def _makeResults(self, name, size):
+        """ Write a results folder with a file of the given size. """
+        resultsDir = os.path.join(self.workDir, name)
+        os.makedirs(resultsDir)
+        with open(os.path.join(resultsDir, 'vol.mrc'), 'wb') as f:
+            f.write(os.urandom(size))
+
+        return resultsDir
+
+    def _makeInput(self, name, content):
+        fn = os.path.join(self.workDir, name)
+        with open(fn, 'wb') as f:
+            f.write(content)
+
+        return fn
+
+    def test_key(self):
+        """ Keys depend on the content of the files and the arguments,
+        not on the file names.
+        """
+        fn1 = self._makeInput('a.mrc', b'half map')
+        fn2 = self._makeInput('b.mrc', b'half map')
+        fn3 = self._makeInput('c.mrc', b'other map')
+        key = ResultCache.computeKey([fn1], {'--apix': 1.0})
+        self.assertEqual(ResultCache.computeKey([fn2], {'--apix': 1.0}), key)
+        self.assertNotEqual(ResultCache.computeKey([fn3], {'--apix': 1.0}),
+                            key)
+        self.assertNotEqual(ResultCache.computeKey([fn1], {'--apix': 2.0}),
+                            key)
+
+    def test_hit_miss(self):
+        cache = ResultCache(self.cachePath, 10 ** 6)
+        outputDir = os.path.join(self.workDir, 'output')
+        self.assertIsNone(cache.get('key', outputDir))
+        self.assertFalse(os.path.exists(outputDir))
+
+        resultsDir = self._makeResults('results', 100)
+        cache.put('key', resultsDir, 'log')
+        self.assertEqual(cache.get('key', outputDir), 'log')
+        with open(os.path.join(resultsDir, 'vol.mrc'), 'rb') as f1, \
+                open(os.path.join(outputDir, 'vol.mrc'), 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+        self.assertIsNone(cache.get('other', outputDir))
+
+    def test_eviction(self):
+        """ Least recently used entries are removed first, and results
+        larger than the cache are not stored.
+        """
+        cache = ResultCache(self.cachePath, 2500)
+        outputDir = os.path.join(self.workDir, 'output')
+        for i, key in enumerate(['a', 'b']):
+            cache.put(key, self._makeResults('results%d' % i, 1000))
+            os.utime(cache._getEntry(key), (i, i))
+        cache.get('a', outputDir)  # now more recent than 'b'
+        cache.put('c', self._makeResults('results2', 1000))
+        self.assertIsNotNone(cache.get('a', outputDir))
+        self.assertIsNone(cache.get('b', outputDir))
+        self.assertIsNotNone(cache.get('c', outputDir))
+
+        cache.put('d', self._makeResults('results3', 3000))
+        self.assertIsNone(cache.get('d', outputDir))
+
+    def test_read_only(self):
+        """ A folder that cannot be written is reported on creation. """
+        os.makedirs(self.cachePath)
+        os.chmod(self.cachePath, 0o500)
+        try:
+            if os.access(self.cachePath, os.W_OK):
+                self.skipTest("Permissions are not enforced for this user.")
+            with self.assertRaises(PermissionError):
+                ResultCache(self.cachePath, 10 ** 6)
+        finally:
+            os.chmod(self.cachePath, 0o700)
+
+    def test_shared_size(self):
+        """ Results and geometry entries share the size limit, and pinned
+        entries are not evicted.
+        """
+        with GeometryCache(self.cachePath, 10 ** 6).use(8, 20., 8) as path:
+            maxSize = getTreeSize(path) + 2500
+        results = ResultCache(self.cachePath, maxSize)
+        geometry = GeometryCache(self.cachePath, maxSize)
+        results.put('a', self._makeResults('results0', 1000))
+        os.utime(results._getEntry('a'), (2, 2))
+        with geometry.use(8, 20., 8) as path:
+            os.utime(path, (1, 1))
+            results.put('b', self._makeResults('results1', 1000))
+            results.put('c', self._makeResults('results2', 1000))
+            self.assertTrue(os.path.isdir(path))  # pinned
+            self.assertFalse(os.path.isdir(results._getEntry('a')))
+
+        results.put('d', self._makeResults('results3', 1000))
+        self.assertFalse(os.path.isdir(path))
+        self.assertTrue(os.path.isdir(results._getEntry('d')))
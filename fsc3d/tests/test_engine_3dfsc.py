@@ -0,0 +1,372 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+"""
+Unit tests of the built-in engine and of the files derived from its
+results, on small synthetic maps. They compare the output arrays
+directly and do not need a Scipion project.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ..cache import GeometryCache
+from ..engine import (getDirections, calcFSC, calcFSCParallel, readMap,
+                      writeMap, run3DFSC, readGeometry, buildVolume,
+                      getGeometry)
+from ..convert import (createPreviews, getPreviewFn, readDirectionalFSC,
+                       sampleDirectionalFSC, fourierCrop, upsampleMap,
+                       padVolume, getMaskBox, cropVolume, uncropVolume,
+                       resampleVolume, compressVolume, readVolume,
+                       getCompressedFn, BITS_SUFFIX, GZIP_SUFFIX)
+
+BOX_SIZE = 32
+D_THETA = 20.
+
+
+def makeHalfMaps(boxSize=BOX_SIZE, seed=0):
+    """ Two half maps with a shared signal and independent noise. """
+    rng = np.random.default_rng(seed)
+    signal = rng.standard_normal((boxSize,) * 3)
+
+    return [(signal + rng.standard_normal((boxSize,) * 3)).astype(np.float32)
+            for _ in range(2)]
+
+
+class TestEngineBase(unittest.TestCase):
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp(prefix='fsc3d_test_')
+        half1, half2 = makeHalfMaps()
+        self.ft1 = np.fft.rfftn(half1)
+        self.ft2 = np.fft.rfftn(half2)
+        self.directions = getDirections(D_THETA)
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir, ignore_errors=True)
+
+    def runEngine(self, name, **kwargs):
+        """ Run the engine on the half maps in the work folder and return
+        its results folder.
+        """
+        for i, data in enumerate(makeHalfMaps()):
+            fn = os.path.join(self.workDir, 'half%d.mrc' % (i + 1))
+            if not os.path.exists(fn):
+                writeMap(fn, data, 1.0)
+        with open(os.path.join(self.workDir, name + '.log'), 'w') as log:
+            run3DFSC('half1.mrc', 'half2.mrc', None, 1.0, ThreeDFSC=name,
+                     dthetaInDegrees=D_THETA, cwd=self.workDir, log=log,
+                     **kwargs)
+
+        return os.path.join(self.workDir, 'Results_' + name)
+
+
+class TestEngineWorkers(TestEngineBase):
+    def test_workers(self):
+        """ Directions split across workers give the same FSC. """
+        single = calcFSC(self.ft1, self.ft2, self.directions, D_THETA)
+        for workers in [1, 3]:
+            parallel = calcFSCParallel(self.ft1, self.ft2, self.directions,
+                                       D_THETA, workers, self.workDir)
+            for expected, result in zip(single, parallel):
+                np.testing.assert_array_equal(result, expected)
+
+
+class TestPreviews(TestEngineBase):
+    def test_previews(self):
+        """ Binned previews average blocks of voxels, and previews newer
+        than the volume are reused.
+        """
+        fn = os.path.join(self.workDir, 'vol.mrc')
+        data = makeHalfMaps()[0]
+        writeMap(fn, data, 1.0)
+        previewDir = os.path.join(self.workDir, 'previews')
+        files = createPreviews(fn, previewDir)
+        for fn2, factor in zip(files, [2, 4]):
+            n = BOX_SIZE // factor
+            expected = data.reshape(n, factor, n, factor, n,
+                                    factor).mean(axis=(1, 3, 5))
+            np.testing.assert_allclose(readMap(fn2), expected, rtol=1e-5,
+                                       atol=1e-6)
+        self.assertTrue(os.path.exists(getPreviewFn(fn, previewDir)))
+
+        mtimes = {f: os.stat(f).st_mtime_ns for f in files}
+        os.remove(files[0])
+        self.assertEqual(createPreviews(fn, previewDir), files)
+        for f in files[1:]:
+            self.assertEqual(os.stat(f).st_mtime_ns, mtimes[f],
+                             "Preview %s was written again" % f)
+        self.assertTrue(os.path.exists(files[0]))
+
+
+class TestDirectionalFSC(TestEngineBase):
+    def test_sampled(self):
+        """ The directional FSCs sampled from the 3D FSC volume along the
+        box axes, used when the table was not written, are the ones of
+        the table for the directions nearest to the axes.
+        """
+        resultsDir = self.runEngine('vol')
+        directions, freqs, fsc = readDirectionalFSC(os.path.join(
+            resultsDir, 'ResEMvolOutDirectionalFSC.npz'))
+        axes = np.eye(3)
+        sampledFreqs, sampled = sampleDirectionalFSC(
+            os.path.join(resultsDir, 'vol.mrc'), axes, 1.0)
+        np.testing.assert_allclose(sampledFreqs, freqs)
+        nearest = np.argmax(np.abs(axes @ directions.T), axis=1)
+        # the origin is set to 1 and the last shell is outside the volume
+        np.testing.assert_allclose(sampled[:, 1:-1], fsc[nearest, 1:-1],
+                                   atol=1e-6)
+
+
+class TestMinimalOutputs(TestEngineBase):
+    def test_minimal(self):
+        """ Without plots, the engine writes the same volumes and tables
+        and no images.
+        """
+        full = self.runEngine('vol', histogram='histogram')
+        minimal = self.runEngine('min')
+        for suffix in ['.mrc', '_Thresholded.mrc', '_ThresholdedBinarized.mrc']:
+            np.testing.assert_array_equal(
+                readMap(os.path.join(minimal, 'min' + suffix)),
+                readMap(os.path.join(full, 'vol' + suffix)))
+        tables = zip(readDirectionalFSC(os.path.join(
+                         minimal, 'ResEMminOutDirectionalFSC.npz')),
+                     readDirectionalFSC(os.path.join(
+                         full, 'ResEMvolOutDirectionalFSC.npz')))
+        for minimalValue, fullValue in tables:
+            np.testing.assert_array_equal(minimalValue, fullValue)
+        with open(os.path.join(minimal, 'ResEMminOutglobalFSC.csv')) as f1, \
+                open(os.path.join(full, 'ResEMvolOutglobalFSC.csv')) as f2:
+            self.assertEqual(f1.read(), f2.read())
+        self.assertTrue(os.path.exists(os.path.join(full, 'histogram.png')))
+        with open(os.path.join(self.workDir, 'min.log')) as f:
+            log = f.read()
+        self.assertIn("3D FSC done.", log)
+        self.assertRegex(log, r'Step \d+ took')
+        self.assertFalse([fn for fn in os.listdir(minimal)
+                          if fn.endswith(('.png', '.jpg'))])
+
+
+class TestGeometryCache(TestEngineBase):
+    def test_geometry(self):
+        """ The cached geometry gives the same FSC and 3D FSC volume as
+        computing it on the fly, also when the box is read in slabs.
+        """
+        cache = GeometryCache(os.path.join(self.workDir, 'cache'), 10 ** 9)
+        globalFSC, conicalFSC = calcFSC(self.ft1, self.ft2, self.directions,
+                                        D_THETA)
+        volume = buildVolume(conicalFSC, self.directions,
+                             np.zeros((BOX_SIZE,) * 3, dtype=np.float32))
+        for slabSize in [BOX_SIZE, 5]:
+            with cache.use(BOX_SIZE, D_THETA, slabSize) as path:
+                geometry = readGeometry(path)
+                cachedGlobal, cachedConical = calcFSC(
+                    self.ft1, self.ft2, self.directions, D_THETA,
+                    slabSize=slabSize, geometry=geometry)
+                cachedVolume = buildVolume(
+                    cachedConical, self.directions,
+                    np.zeros((BOX_SIZE,) * 3, dtype=np.float32),
+                    slabSize=slabSize, geometry=geometry)
+            np.testing.assert_array_equal(cachedGlobal, globalFSC)
+            np.testing.assert_array_equal(cachedConical, conicalFSC)
+            np.testing.assert_array_equal(cachedVolume, volume)
+
+    def test_max_directions(self):
+        """ Cone ids that do not fit in the geometry are rejected. """
+        with self.assertRaises(ValueError):
+            getGeometry(8, getDirections(1.), 1.)
+        with self.assertRaises(ValueError):
+            buildVolume(np.zeros((len(getDirections(1.)), 5)),
+                        getDirections(1.), np.zeros((8,) * 3))
+
+
+class InterruptedArray:
+    """ Fourier transform that fails when a slab starting at stop is
+    read, as if the run was killed there.
+    """
+    def __init__(self, data, stop):
+        self.data = data
+        self.shape = data.shape
+        self.stop = stop
+
+    def __getitem__(self, key):
+        if key.start == self.stop:
+            raise KeyboardInterrupt
+        return self.data[key]
+
+
+class TestCheckpoint(TestEngineBase):
+    def test_resume(self):
+        """ A run resumed from the checkpoint of a killed run gives the
+        same FSC as a run that was not interrupted.
+        """
+        checkpoint = os.path.join(self.workDir, 'sums.npz')
+        kwargs = {'slabSize': 4, 'checkpoint': checkpoint, 'interval': 0}
+        with self.assertRaises(KeyboardInterrupt):
+            calcFSC(InterruptedArray(self.ft1, 20), self.ft2,
+                    self.directions, D_THETA, **kwargs)
+        with np.load(checkpoint) as saved:
+            self.assertEqual(int(saved['next']), 20)
+
+        resumed = calcFSC(self.ft1, self.ft2, self.directions, D_THETA,
+                          **kwargs)
+        expected = calcFSC(self.ft1, self.ft2, self.directions, D_THETA,
+                           slabSize=4)
+        for resumedFSC, expectedFSC in zip(resumed, expected):
+            np.testing.assert_array_equal(resumedFSC, expectedFSC)
+
+
+class TestUpsampleMap(TestEngineBase):
+    def test_upsample(self):
+        """ A map computed on Fourier-cropped maps is put back on the grid
+        of the original box at the same place.
+        """
+        size = 48
+        z, y, x = np.indices((size,) * 3)
+        blob = np.exp(-((z - 30) ** 2 + (y - 14) ** 2 + (x - 20) ** 2) / 18.)
+        fn = os.path.join(self.workDir, 'blob.mrc')
+        writeMap(fn, blob.astype(np.float32), 1.0)
+        self.assertAlmostEqual(fourierCrop(fn, 24), 2.0)
+        upsampleMap(fn, size, 1.0)
+
+        upsampled = readMap(fn)
+        self.assertEqual(upsampled.shape, blob.shape)
+        self.assertEqual(np.unravel_index(np.argmax(upsampled), blob.shape),
+                         (30, 14, 20))
+        self.assertGreater(np.corrcoef(upsampled.ravel(), blob.ravel())[0, 1],
+                           0.99)
+
+
+class TestConvert(TestEngineBase):
+    def _writeMap(self, name, data, voxelSize=1.0):
+        fn = os.path.join(self.workDir, name)
+        writeMap(fn, data.astype(np.float32), voxelSize)
+
+        return fn
+
+    def test_compress(self):
+        """ Binary volumes are restored exactly, the rest to float16
+        precision, both with their voxel size.
+        """
+        half1 = makeHalfMaps()[0]
+        for name, data, suffix, tolerance in [
+                ('binary.mrc', half1 > 0, BITS_SUFFIX, 0),
+                ('map.mrc', half1, GZIP_SUFFIX, 1e-2)]:
+            fn = self._writeMap(name, data, 1.5)
+            compressedFn = compressVolume(fn, slabSize=12)
+            self.assertTrue(compressedFn.endswith(suffix))
+            self.assertFalse(os.path.exists(fn))
+            self.assertEqual(getCompressedFn(fn), compressedFn)
+
+            restored, voxelSize = readVolume(fn)
+            self.assertEqual(restored.dtype, np.float32)
+            self.assertAlmostEqual(voxelSize, 1.5)
+            np.testing.assert_allclose(restored, data, atol=tolerance,
+                                       rtol=tolerance)
+
+    def test_fourier_crop_pad(self):
+        """ A Fourier crop keeps the low frequencies of the map, and
+        padding its centered spectrum puts them back at the frequencies
+        of the original box.
+        """
+        size, cropSize = BOX_SIZE, 20
+        data = makeHalfMaps()[0]
+        fn = self._writeMap('map.mrc', data)
+        self.assertAlmostEqual(fourierCrop(fn, cropSize),
+                               size / float(cropSize), places=5)
+
+        # the Nyquist planes of the crop are not kept
+        low = slice(size // 2 - cropSize // 2 + 1, size // 2 + cropSize // 2)
+        scale = (size / float(cropSize)) ** 3
+        amplitude = np.abs(np.fft.fftshift(np.fft.fftn(data)))
+        cropped = readMap(fn)
+        self.assertEqual(cropped.shape, (cropSize,) * 3)
+        fn = self._writeMap('amplitude.mrc', scale * np.abs(
+            np.fft.fftshift(np.fft.fftn(cropped))), 2.0)
+        padVolume(fn, size, 1.0)
+
+        padded = readMap(fn)
+        self.assertEqual(padded.shape, (size,) * 3)
+        np.testing.assert_allclose(padded[low, low, low],
+                                   amplitude[low, low, low], rtol=1e-3,
+                                   atol=1e-3 * amplitude.max())
+        self.assertEqual(padded[:low.start - 1].max(), 0)
+
+    def test_crop_uncrop(self):
+        """ The box of a mask contains it, and cropping a map to it then
+        padding it back gives the map inside the box and zeros outside.
+        """
+        z, y, x = np.indices((BOX_SIZE * 2,) * 3)
+        mask = ((z - 20) ** 2 + (y - 40) ** 2 + (x - 30) ** 2) < 36
+        maskFn = self._writeMap('mask.mrc', mask)
+        origin, size = getMaskBox(maskFn, margin=2)
+        self.assertEqual(size, 16)
+        self.assertEqual(origin, (12, 32, 22))
+
+        data = np.random.default_rng(0).standard_normal(mask.shape)
+        fn = self._writeMap('map.mrc', data)
+        for cropFn in [maskFn, fn]:
+            cropVolume(cropFn, origin, size)
+            uncropVolume(cropFn, mask.shape[0], origin)
+        np.testing.assert_array_equal(readMap(maskFn), mask)
+
+        inside = np.zeros(mask.shape, dtype=bool)
+        inside[12:28, 32:48, 22:38] = True
+        restored = readMap(fn)
+        np.testing.assert_allclose(restored[inside], data[inside], rtol=1e-6)
+        self.assertEqual(np.abs(restored[~inside]).max(), 0)
+
+        # a mask that fills the map needs no crop
+        self.assertIsNone(getMaskBox(self._writeMap('full.mrc', ~mask)))
+
+    def test_resample(self):
+        """ Resampling a centered spectrum to a larger box interpolates
+        it at the frequencies of that box.
+        """
+        size, boxSize = 16, 40
+        k = np.arange(size) - size // 2
+        fn = self._writeMap('linear.mrc', np.broadcast_to(
+            k[:, None, None] / float(size), (size,) * 3))
+        resampleVolume(fn, boxSize, 1.0)
+
+        # linear in the frequency, except past the last voxel of the box
+        k = np.arange(boxSize) - boxSize // 2
+        inside = slice(0, boxSize - 2)
+        resampled = readMap(fn)
+        self.assertEqual(resampled.shape, (boxSize,) * 3)
+        np.testing.assert_allclose(resampled[inside, 0, 0],
+                                   k[inside] / float(boxSize), atol=1e-6)
+        np.testing.assert_allclose(
+            resampled, np.broadcast_to(resampled[:, :1, :1], resampled.shape),
+            atol=1e-6)
+
+        fn = self._writeMap('binary.mrc', np.indices((size,) * 3)[0] % 2)
+        resampleVolume(fn, boxSize, 1.0, nearest=True)
+        self.assertEqual(set(np.unique(readMap(fn))), {0, 1})
@@ -26,11 +26,15 @@
 
 import os
 
+import numpy as np
+
 from pyworkflow.utils import magentaStr
 from pyworkflow.tests import BaseTest, DataSet, setupTestProject
 from pwem.protocols import ProtImportVolumes, ProtImportMask
 
-from ..protocols import Prot3DFSC
+from ..protocols import Prot3DFSC, ProtStream3DFSC
+from ..constants import ENGINE_BUILTIN
+from ..convert import volumeExists, getCompressedFn, readVolume, BITS_SUFFIX
 
 
 class Test3DFSCBase(BaseTest):
@@ -93,3 +97,177 @@ class Test3DFSC(Test3DFSCBase):
         protFsc._initialize()
         self.assertTrue(os.path.exists(protFsc._getFileName('out_vol3DFSC')),
                         "3D FSC (with mask) has failed")
+
+    def test_3DFSC3(self):
+        print(magentaStr("\n==> Testing fsc3d - built-in engine:"))
+        protFsc = self.newProtocol(Prot3DFSC,
+                                   inputVolume=self.protImportVol.outputVolume,
+                                   engine=ENGINE_BUILTIN,
+                                   numberOfThreads=2,
+                                   doSweep=True)
+        self.launchProtocol(protFsc)
+        protFsc._initialize()
+        for fn in ['out_vol3DFSC', 'out_vol3DFSC-th', 'out_vol3DFSC-thbin',
+                   'out_globalFSC', 'out_sweep']:
+            self.assertTrue(volumeExists(protFsc._getFileName(fn)),
+                            "3D FSC (built-in) has failed: missing %s" % fn)
+        # thresholded volumes are compressed by default
+        binFn = protFsc._getFileName('out_vol3DFSC-thbin')
+        self.assertTrue(getCompressedFn(binFn).endswith(BITS_SUFFIX))
+        data, _ = readVolume(binFn)
+        self.assertTrue(set(np.unique(data)) <= {0., 1.},
+                        "Bit-packed binarized volume is not binary")
+        for key in ['sphericity', 'globalResolution', 'minDirResolution',
+                    'maxDirResolution']:
+            self.assertIsNotNone(protFsc.getResult(protFsc.outputVolume, key),
+                                 "3D FSC (built-in) result %s missing" % key)
+
+    def test_3DFSC4(self):
+        print(magentaStr("\n==> Testing fsc3d - Fourier crop:"))
+        protFsc = self.newProtocol(Prot3DFSC,
+                                   inputVolume=self.protImportVol.outputVolume,
+                                   engine=ENGINE_BUILTIN,
+                                   doCrop=True,
+                                   cropResolution=10.)
+        self.launchProtocol(protFsc)
+        protFsc._initialize()
+        inputDims = self.protImportVol.outputVolume.getDimensions()
+        outputVol = protFsc.outputVolume
+        self.assertEqual(outputVol.getDimensions(), inputDims,
+                         "3D FSC (cropped) was not padded back")
+        self.assertAlmostEqual(outputVol.getSamplingRate(), 3.54)
+
+    def test_3DFSC5(self):
+        print(magentaStr("\n==> Testing fsc3d - local windows:"))
+        protFsc = self.newProtocol(Prot3DFSC,
+                                   inputVolume=self.protImportVol.outputVolume,
+                                   maskVolume=self.protImportMask.outputMask,
+                                   applyMask=True,
+                                   engine=ENGINE_BUILTIN,
+                                   numberOfThreads=2,
+                                   doLocal=True)
+        self.launchProtocol(protFsc)
+        protFsc._initialize()
+        for fn in ['out_localTable', 'out_localSphericity',
+                   'out_localAnisotropy']:
+            self.assertTrue(os.path.exists(protFsc._getFileName(fn)),
+                            "Local 3D FSC has failed: missing %s" % fn)
+        self.assertTrue(hasattr(protFsc, 'outputLocalSphericity'),
+                        "Local 3D FSC output is missing")
+
+    def test_3DFSC6(self):
+        print(magentaStr("\n==> Testing fsc3d - adaptive sampling:"))
+        results = []
+        for adaptive in [False, True]:
+            protFsc = self.newProtocol(Prot3DFSC,
+                                       inputVolume=self.protImportVol.outputVolume,
+                                       engine=ENGINE_BUILTIN,
+                                       doAdaptive=adaptive)
+            self.launchProtocol(protFsc)
+            results.append(protFsc)
+        full, adaptive = [protFsc.getResult(protFsc.outputVolume, 'sphericity')
+                          for protFsc in results]
+        self.assertAlmostEqual(adaptive, full, delta=0.05,
+                               msg="Adaptive sphericity differs from full run")
+
+    def test_3DFSC7(self):
+        print(magentaStr("\n==> Testing fsc3d - single precision:"))
+        results = []
+        for precision in [0, 1]:
+            protFsc = self.newProtocol(Prot3DFSC,
+                                       inputVolume=self.protImportVol.outputVolume,
+                                       engine=ENGINE_BUILTIN,
+                                       precision=precision,
+                                       useCache=False)
+            self.launchProtocol(protFsc)
+            results.append(protFsc)
+        self.assertFalse(results[1].precisionWarning,
+                         "Single precision check failed")
+        double, single = [protFsc.getResult(protFsc.outputVolume, 'sphericity')
+                          for protFsc in results]
+        self.assertAlmostEqual(single, double, places=3,
+                               msg="Single precision sphericity differs")
+
+    def test_3DFSC8(self):
+        print(magentaStr("\n==> Testing fsc3d - streaming:"))
+        # the import protocol stands for a finished refinement
+        protFsc = self.newProtocol(ProtStream3DFSC,
+                                   inputProtocol=self.protImportVol,
+                                   halfMapPattern='extra/*half1*',
+                                   engine=ENGINE_BUILTIN,
+                                   checkInterval=5)
+        self.launchProtocol(protFsc)
+        output = getattr(protFsc, 'outputVolumes', None)
+        self.assertIsNotNone(output, "Streaming 3D FSC output is missing")
+        self.assertEqual(output.getSize(), 1,
+                         "Streaming 3D FSC did not analyze the iteration")
+        self.assertIsNotNone(protFsc.getResult(output.getFirstItem(),
+                                               'sphericity'))
+
+    def test_3DFSC9(self):
+        print(magentaStr("\n==> Testing fsc3d - crop to the mask:"))
+        results = []
+        for doMaskCrop in [False, True]:
+            protFsc = self.newProtocol(Prot3DFSC,
+                                       inputVolume=self.protImportVol.outputVolume,
+                                       maskVolume=self.protImportMask.outputMask,
+                                       applyMask=True,
+                                       doMaskCrop=doMaskCrop,
+                                       engine=ENGINE_BUILTIN,
+                                       useCache=False)
+            self.launchProtocol(protFsc)
+            results.append(protFsc)
+        self.assertTrue(results[1].maskCropSize.hasValue(),
+                        "Inputs were not cropped to the mask")
+        self.assertEqual(results[1].outputVolume.getDimensions(),
+                         self.protImportVol.outputVolume.getDimensions(),
+                         "3D FSC (cropped to the mask) was not resampled back")
+        full, cropped = [protFsc.getResult(protFsc.outputVolume,
+                                           'globalResolution')
+                         for protFsc in results]
+        self.assertAlmostEqual(cropped, full, delta=0.05 * full,
+                               msg="Global resolution differs after the "
+                                   "crop to the mask")
+        full, cropped = [protFsc.getResult(protFsc.outputVolume, 'sphericity')
+                         for protFsc in results]
+        # measured on the coarser shells of the cropped box
+        self.assertAlmostEqual(cropped, full, delta=0.1,
+                               msg="Sphericity differs after the crop to "
+                                   "the mask")
+
+    def test_3DFSC10(self):
+        print(magentaStr("\n==> Testing fsc3d - local windows, Fourier crop:"))
+        results = []
+        for doCrop in [False, True]:
+            protFsc = self.newProtocol(Prot3DFSC,
+                                       inputVolume=self.protImportVol.outputVolume,
+                                       maskVolume=self.protImportMask.outputMask,
+                                       applyMask=True,
+                                       engine=ENGINE_BUILTIN,
+                                       doCrop=doCrop,
+                                       cropResolution=10.,
+                                       doLocal=True,
+                                       windowSize=24,
+                                       windowStep=12)
+            self.launchProtocol(protFsc)
+            protFsc._initialize()
+            results.append(protFsc)
+
+        inputVol = self.protImportVol.outputVolume
+        full, cropped = [readVolume(p._getFileName('out_localSphericity'))[0]
+                         for p in results]
+        self.assertEqual(cropped.shape, full.shape,
+                         "Local sphericity (cropped) was not resampled back")
+        self.assertAlmostEqual(
+            results[1].outputLocalSphericity.getSamplingRate(),
+            inputVol.getSamplingRate())
+        # both maps cover the windows inside the mask, at the same place
+        overlap = np.sum((full > 0) & (cropped > 0))
+        self.assertGreater(overlap / np.sum((full > 0) | (cropped > 0)), 0.7,
+                           "Local sphericity (cropped) is not aligned with "
+                           "the input map")
+        scale = inputVol.getXDim() / results[1].cropBoxSize.get()
+        table = np.genfromtxt(results[1]._getFileName('out_localTable'),
+                              delimiter=',', names=True)
+        self.assertTrue(np.all(np.abs(table['size'] - 24 * scale) <= 1),
+                        "Window sizes are not in voxels of the input map")
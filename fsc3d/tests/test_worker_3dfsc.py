@@ -0,0 +1,116 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Unit tests of the persistent 3DFSC worker, with a small script in place
+of ThreeDFSC_Start.py. They do not need a Scipion project.
+"""
+
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from .. import worker
+
+# prints its arguments and the working folder, exits with --code
+SCRIPT = """
+import os
+import sys
+import argparse
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--message')
+parser.add_argument('--code', type=int, default=0)
+args = parser.parse_args()
+print(args.message)
+print(os.getcwd(), flush=True)
+print('error output', file=sys.stderr)
+sys.exit(args.code)
+"""
+START_TIMEOUT = 30  # seconds
+
+
+class TestWorker(unittest.TestCase):
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp(prefix='fsc3d_test_')
+        self.socketFn = os.path.join(self.workDir, 'worker.sock')
+        script = os.path.join(self.workDir, 'script.py')
+        with open(script, 'w') as f:
+            f.write(SCRIPT)
+        self.process = subprocess.Popen(
+            [sys.executable, worker.__file__, '--socket', self.socketFn,
+             '--script', script, '--idle', '60', '--no-warmup'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        start = time.time()
+        while not worker.isRunning(self.socketFn):
+            if (self.process.poll() is not None
+                    or time.time() - start > START_TIMEOUT):
+                self.fail("The worker did not start")
+            time.sleep(0.1)
+
+    def tearDown(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        shutil.rmtree(self.workDir, ignore_errors=True)
+
+    def _submit(self, args):
+        logFn = os.path.join(self.workDir, 'job.log')
+        output = io.StringIO()
+        code = worker.submitJob(self.socketFn, args, self.workDir, logFn,
+                                output=output)
+
+        return code, output.getvalue()
+
+    def test_jobs(self):
+        """ Jobs run in the given folder, their output is copied while
+        they run and their exit code is returned.
+        """
+        code, output = self._submit('--message="first job"')
+        self.assertEqual(code, 0)
+        self.assertEqual(output.splitlines(),
+                         ['first job', os.path.realpath(self.workDir),
+                          'error output'])
+
+        # the log of each job replaces the one of the previous job
+        code, output = self._submit('--message=second --code=3')
+        self.assertEqual(code, 3)
+        self.assertEqual(output.splitlines()[0], 'second')
+
+        self.assertTrue(worker.isRunning(self.socketFn))
+
+    def test_stop(self):
+        """ A stopped worker exits and removes its socket. """
+        worker.stopWorker(self.socketFn)
+        self.process.wait(timeout=START_TIMEOUT)
+        self.assertFalse(os.path.exists(self.socketFn))
+        self.assertFalse(worker.isRunning(self.socketFn))
+        self.assertIsNone(self._submit('--message=late')[0])
@@ -0,0 +1,235 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Wall time, CPU time and peak memory of the protocol steps and of the
+phases reported by the 3D FSC programs.
+"""
+
+import os
+import re
+import sys
+import glob
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+# Phase lines printed by the engine, e.g.
+# Step 01: Calculating Fourier transforms
+# Step 01 took 1.23 s wall, 2.34 s CPU
+PHASE_PATTERN = re.compile(r'^(Step \d+): (.*)$')
+PHASE_TIME_PATTERN = re.compile(
+    r'^(Step \d+) took ([\d.]+) s wall, ([\d.]+) s CPU')
+SAMPLE_INTERVAL = 0.05  # seconds between memory samples
+
+
+def getCpuTime():
+    """ Return the CPU time (s) used by the calling thread and by the
+    finished child processes. Children are counted for the whole process,
+    whichever thread started them.
+    """
+    t = os.times()
+
+    return time.thread_time() + t.children_user + t.children_system
+
+
+def getPeakRss():
+    """ Return the peak resident memory (bytes) of this process or any
+    of its finished child processes, since the process started.
+    """
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    scale = 1 if sys.platform == 'darwin' else 1024
+
+    return scale * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def getTreeRss(pid=None):
+    """ Return the current resident memory (bytes) of a process (this
+    one by default) and all its descendants, read from /proc. Return None
+    if /proc is not available.
+    """
+    pending = [pid or os.getpid()]
+    total = 0
+    while pending:
+        pid = pending.pop()
+        try:
+            with open('/proc/%d/statm' % pid) as f:
+                total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            for fn in glob.glob('/proc/%d/task/*/children' % pid):
+                with open(fn) as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            if not total:  # no /proc for this process
+                return None
+
+    return total
+
+
+class MemorySampler(threading.Thread):
+    """ Sample the resident memory of the process tree in the background
+    and keep the largest value. Without /proc, the peak is the one of
+    the whole process life (see getPeakRss).
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self.peak = getTreeRss()
+        self.cumulative = self.peak is None
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self.cumulative and not self._stopped.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        rss = getTreeRss()
+        if rss is not None:
+            self.peak = max(self.peak, rss)
+
+    def stop(self):
+        """ Stop sampling and return the peak (bytes). """
+        self._stopped.set()
+        self.join()
+        if self.cumulative:
+            return getPeakRss()
+        self._sample()
+
+        return self.peak
+
+
+class PhaseLogger:
+    """ Print the start and the duration of consecutive phases to the
+    log file object (the standard output by default).
+    """
+    def __init__(self, log=None):
+        self._log = log or sys.stdout
+        self._current = None
+
+    def start(self, number, title):
+        """ Finish the current phase and start a new one. """
+        self.stop()
+        name = 'Step %02d' % number
+        print('%s: %s' % (name, title), file=self._log, flush=True)
+        self._current = name, time.perf_counter(), getCpuTime()
+
+    def stop(self):
+        if self._current is not None:
+            name, wall, cpu = self._current
+            print('%s took %0.2f s wall, %0.2f s CPU'
+                  % (name, time.perf_counter() - wall, getCpuTime() - cpu),
+                  file=self._log, flush=True)
+            self._current = None
+
+
+def parsePhases(text):
+    """ Return the phases found in a 3D FSC output as a list of
+    dictionaries with name, title, wall and cpu (None if not reported).
+    """
+    phases = {}
+    for line in text.splitlines():
+        match = PHASE_PATTERN.match(line.strip())
+        if match:
+            phases[match.group(1)] = {'name': match.group(1),
+                                      'title': match.group(2),
+                                      'wall': None, 'cpu': None}
+            continue
+        match = PHASE_TIME_PATTERN.match(line.strip())
+        if match and match.group(1) in phases:
+            phases[match.group(1)].update(wall=float(match.group(2)),
+                                          cpu=float(match.group(3)))
+
+    return list(phases.values())
+
+
+class Timings:
+    """ Timing records of the protocol steps, stored as a JSON file.
+    Records of a step run again (e.g. after continuing the protocol)
+    replace the previous ones. Steps running in parallel threads can
+    record at the same time. CPU time is the one of the thread running
+    the step, plus the child processes that finished meanwhile. Peak
+    memory is sampled while the step runs and includes the whole
+    process tree, so it also counts steps running at the same time.
+    Without /proc it is the peak since the process started, and the
+    record is marked as cumulative.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, fn):
+        self._fn = fn
+        self._load()
+
+    def _load(self):
+        self.stages = {}
+        if os.path.exists(self._fn):
+            with open(self._fn) as f:
+                self.stages = {s['name']: s for s in json.load(f)['stages']}
+
+    @contextmanager
+    def record(self, name):
+        """ Measure the enclosed code and save the record when done.
+        The record dictionary is yielded so more entries can be added.
+        The record is also saved, marked as failed, if the code raises.
+        """
+        record = {'name': name}
+        wall, cpu = time.perf_counter(), getCpuTime()
+        sampler = MemorySampler()
+        sampler.start()
+        try:
+            yield record
+        except BaseException:
+            record['failed'] = True
+            raise
+        finally:
+            record.update(wall=time.perf_counter() - wall,
+                          cpu=getCpuTime() - cpu,
+                          peakRss=sampler.stop())
+            if sampler.cumulative:
+                record['cumulativePeakRss'] = True
+            with self._lock:
+                self._load()  # other steps may have saved meanwhile
+                self.stages.pop(name, None)
+                self.stages[name] = record
+                self.save()
+
+    def save(self):
+        with open(self._fn, 'w') as f:
+            json.dump({'stages': list(self.stages.values())}, f, indent=2)
+
+    def getSummary(self):
+        """ Return a single line with the time breakdown. """
+        if not self.stages:
+            return None
+        parts = ['%s %0.1f/%0.1f s%s' % (s['name'], s['wall'], s['cpu'],
+                                          ' (failed)' if s.get('failed')
+                                          else '')
+                 for s in self.stages.values()]
+        peak = max(s['peakRss'] for s in self.stages.values())
+
+        return 'Timing (wall/CPU): %s; peak memory %0.2f GB' % (
+            ', '.join(parts), peak / 1024 ** 3)
@@ -25,16 +25,23 @@
 # **************************************************************************
 
 import os
+import numpy as np
 import matplotlib.image as mpimg
 import matplotlib.pyplot as plt
 
-from pyworkflow.protocol.params import LabelParam, EnumParam
+from pyworkflow.protocol.params import LabelParam, EnumParam, FloatParam
 from pyworkflow.viewer import DESKTOP_TKINTER
 from pwem.viewers import ChimeraView, ObjectView, EmProtocolViewer
 
 from .protocols import Prot3DFSC
+from .engine import calcMapPower, readMap, getDirections
+from .convert import (getPreviewFn, createPreviews, isNewer, readGlobalFSC,
+                      readDirectionalFSC, sampleDirectionalFSC, volumeExists,
+                      getCompressedFn, restoreVolume, stageInput)
+from .metrics import getResolutions, getMetrics
 from .constants import (VOLUME_SLICES, VOLUME_CHIMERA,
-                        VOL_ORIG, VOL_TH, VOL_THBIN)
+                        VOL_ORIG, VOL_TH, VOL_THBIN,
+                        PREVIEW_BIN4, PREVIEW_FACTORS)
 
 
 class ThreedFscViewer(EmProtocolViewer):
@@ -46,6 +53,7 @@ class ThreedFscViewer(EmProtocolViewer):
 
     def __init__(self, **kwargs):
         EmProtocolViewer.__init__(self, **kwargs)
+        self._plotData = {}  # data of the plots, by file modification time
 
     def _defineParams(self, form):
         form.addSection(label='Visualization')
@@ -60,6 +68,14 @@ class ThreedFscViewer(EmProtocolViewer):
                                 'thresholded and binarized', 'all'],
                        display=EnumParam.DISPLAY_COMBO,
                        label='3D FSC volume to display')
+        group.addParam('previewLevel', EnumParam, default=PREVIEW_BIN4,
+                       choices=['4x binned', '2x binned', 'full size'],
+                       display=EnumParam.DISPLAY_HLIST,
+                       label='Volume size',
+                       help='Binned previews open much faster for large '
+                            'boxes. Select full size to inspect details.')
+        group.addParam('doShowSlices', LabelParam,
+                       label='Show central slices')
 
         form.addParam('doShowHistogram', LabelParam,
                       label="Show histogram and directional FSC plot")
@@ -71,14 +87,32 @@ class ThreedFscViewer(EmProtocolViewer):
                       label="Show Chimera animation", default=True,
                       help="Display 3D FSC and coloring original map by "
                            "angular resolution.")
+
+        group = form.addGroup('Metrics')
+        group.addParam('metricsFscCutoff', FloatParam, default=0,
+                       label='FSC cutoff',
+                       help='0 uses the FSC cutoff of the protocol.')
+        group.addParam('metricsThrSph', FloatParam, default=0,
+                       label='Sphericity threshold',
+                       help='0 uses the sphericity threshold of the '
+                            'protocol.')
+        group.addParam('doShowMetrics', LabelParam,
+                       label='Recompute metrics',
+                       help='Compute sphericity, principal-axis '
+                            'anisotropy and directional resolutions from '
+                            'the 3D FSC volume with these thresholds, at '
+                            'the selected volume size, without running '
+                            '3D FSC again.')
         
     def _getVisualizeDict(self):
         self.protocol._initialize()  # Load filename templates
         return {'doShowOutVol': self._showVolumes,
+                'doShowSlices': self._showSlices,
                 'doShowHistogram': self._showHistogram,
                 'doShowPlotFT': self._showPlotFT,
                 'doShowPlot3DFSC': self._showPlot3DFSC,
-                'doShowChimera': self._showChimera
+                'doShowChimera': self._showChimera,
+                'doShowMetrics': self._showMetrics
                 }
 
 # =============================================================================
@@ -92,7 +126,7 @@ class ThreedFscViewer(EmProtocolViewer):
 
     def _showVolumesChimera(self):
         """ Create a chimera script to visualize selected volumes. """
-        volumes = self._getVolumeNames()
+        volumes = self._getVolumeFiles()
         cmdFile = self.protocol._getExtraPath('chimera_volumes.cxc')
         with open(cmdFile, 'w+') as f:
             for vol in volumes:
@@ -107,34 +141,142 @@ class ThreedFscViewer(EmProtocolViewer):
         return [view]
 
     def _createVolumesSqlite(self):
-        """ Write an sqlite with all volumes selected for visualization. """
-        path = self.protocol._getExtraPath('3DFSC_viewer_volumes.sqlite')
+        """ Write an sqlite with all volumes selected for visualization.
+        An existing sqlite newer than the volumes is reused.
+        """
+        factor = self._getPreviewFactor()
+        path = self.protocol._getExtraPath(
+            '3DFSC_viewer_volumes_%d_bin%d.sqlite'
+            % (self.doShowOutVol.get(), factor))
         samplingRate = self.protocol.inputVolume.get().getSamplingRate()
 
-        vols = self._getVolumeNames()
-        files = []
-        for vol in vols:
-            if os.path.exists(vol):
-                files.append(vol)
-        self.createVolumesSqlite(files, path, samplingRate)
+        files = [f for f in self._getVolumeFiles() if os.path.exists(f)]
+        if not isNewer(path, *files):
+            self.createVolumesSqlite(files, path, samplingRate * factor)
         return [ObjectView(self._project, self.protocol.strId(), path)]
 
+    def _showSlices(self, param=None):
+        previewDir = self.protocol._getFileName('out_previews')
+        for vol in self._getVolumeNames():
+            if volumeExists(vol):
+                self._preparePreviews(vol)
+                self._showImage(getPreviewFn(vol, previewDir))
+
 # =============================================================================
     def _showPlot(self, fn):
-        img = mpimg.imread(self.protocol._getFileName(fn))
+        return self._showImage(self.protocol._getFileName(fn))
+
+    def _showImage(self, fn):
+        img = mpimg.imread(fn)
+        plt.figure()
         imgplot = plt.imshow(img)
         plt.axis('off')
         plt.show()
         return [imgplot]
 
     def _showHistogram(self, param=None):
-        self._showPlot('out_histogram')
+        """ Plot the histogram of directional resolutions. """
+        data = self._getPlotData()
+        if data is None:
+            return [self.errorMessage('3D FSC results not found.')]
+
+        fig, ax = plt.subplots(figsize=(8, 6))
+        ax.hist(data['resolutions'], bins=30, color='#1f77b4')
+        ax.axvline(data['globalResolution'], color='k', linestyle='--',
+                   label='Global resolution (%0.2f A)'
+                         % data['globalResolution'])
+        ax.set_xlabel('Directional resolution (A)')
+        ax.set_ylabel('Number of directions')
+        ax.set_title('Histogram of directional resolution at FSC %s'
+                     % self.protocol.fscCutoff.get())
+        ax.legend()
+        plt.show()
 
     def _showPlotFT(self, param=None):
-        self._showPlot('out_plotFT')
+        if os.path.exists(self.protocol._getFileName('out_plotFT')):
+            return self._showPlot('out_plotFT')
+
+        # not written by minimal runs, compute it from the staged full map
+        # or from an MRC copy of the input one
+        fn = self.protocol._getFileName('input_volFn')
+        samplingRate = self.protocol._getSamplingRate()
+        if not os.path.exists(fn):
+            inputVol = self.protocol.inputVolume.get()
+            fn = self.protocol._getTmpPath('viewer_volume_full.mrc')
+            samplingRate = inputVol.getSamplingRate()
+            if not isNewer(fn, inputVol.getFileName()):
+                os.makedirs(os.path.dirname(fn), exist_ok=True)
+                stageInput(inputVol.getLocation(), fn, samplingRate)
+
+        key = (fn, os.path.getmtime(fn))
+        if key not in self._plotData:
+            self._plotData[key] = calcMapPower(fn)
+        power = self._plotData[key]
+        freqs = np.arange(len(power)) / (2 * (len(power) - 1) * samplingRate)
+
+        fig, ax = plt.subplots(figsize=(10, 6))
+        ax.semilogy(freqs[1:], np.maximum(power[1:], 1e-12))
+        ax.set_xlabel('Spatial frequency (1/A)')
+        ax.set_ylabel('Power')
+        ax.set_title('Rotationally averaged Fourier power of the full map')
+        plt.show()
 
     def _showPlot3DFSC(self, param=None):
-        self._showPlot('out_plot3DFSC')
+        """ Plot the global FSC and the spread of directional FSCs. """
+        data = self._getPlotData()
+        if data is None:
+            return [self.errorMessage('3D FSC results not found.')]
+
+        fig, ax = plt.subplots(figsize=(10, 6))
+        freqs, fsc = data['freqs'], data['fsc']
+        ax.fill_between(freqs, fsc.min(axis=0), fsc.max(axis=0),
+                        color='#deebf7', label='Directional FSC (range)')
+        mean, std = fsc.mean(axis=0), fsc.std(axis=0)
+        ax.fill_between(freqs, mean - std, mean + std, color='#9ecae1',
+                        label='Directional FSC (mean +/- sd)')
+        ax.plot(data['globalFreqs'], data['globalFSC'], 'k',
+                label='Global FSC')
+        ax.axhline(self.protocol.fscCutoff.get(), color='gray',
+                   linestyle='--')
+        ax.set_xlabel('Spatial frequency (1/A)')
+        ax.set_ylabel('FSC')
+        ax.set_ylim(-0.1, 1.05)
+        ax.legend()
+        plt.show()
+
+    def _showMetrics(self, param=None):
+        """ Recompute the metrics of the 3D FSC volume with the
+        thresholds of the viewer.
+        """
+        volFn = self.protocol._getFileName('out_vol3DFSC')
+        if not os.path.exists(volFn):
+            return [self.errorMessage('3D FSC volume not found.')]
+
+        factor = self._getPreviewFactor()
+        if factor > 1:
+            self._preparePreviews(volFn)
+            volFn = getPreviewFn(volFn, self.protocol._getFileName(
+                'out_previews'), factor)
+        cutoff = self.metricsFscCutoff.get() or self.protocol.fscCutoff.get()
+        thrSph = self.metricsThrSph.get() or self.protocol.thrSph.get()
+        # the 3D FSC volume is back at the input sampling after any crop
+        samplingRate = self.protocol.inputVolume.get().getSamplingRate()
+        metrics = getMetrics(readMap(volFn), samplingRate * factor,
+                             cutoff, thrSph, self.protocol.hpFilter.get(),
+                             self.protocol.dTheta.get())
+
+        lines = ['FSC cutoff %s, sphericity threshold %s, %dx binned'
+                 % (cutoff, thrSph, factor),
+                 'Sphericity: %0.3f' % metrics['sphericity'][0],
+                 'Principal-axis anisotropy: %0.2f (semi-axes %s px)'
+                 % (metrics['anisotropy'][0], ', '.join(
+                     '%0.1f' % a for a in metrics['principalAxes'][0])),
+                 'Worst directional resolution: %0.2f A'
+                 % metrics['worstResolution'][0],
+                 'Best directional resolution: %0.2f A'
+                 % metrics['bestResolution'][0]]
+
+        return [self.infoMessage('\n'.join(lines), title='3D FSC metrics')]
 
     def _showChimera(self, param=None):
         return [self.errorMessage('ChimeraX is not supported for this animation yet.',
@@ -156,3 +298,84 @@ class ThreedFscViewer(EmProtocolViewer):
             vols = [self.protocol._getFileName(f) for f in volsFn]
 
         return vols
+
+    def _getPlotData(self):
+        """ Load the global and directional FSC curves, derive the
+        directional resolutions and keep them for the next plots. If the
+        table of directional FSCs was not written, they are sampled from
+        the 3D FSC volume, without writing the table.
+        """
+        globalFn = self.protocol._getFileName('out_globalFSC')
+        dirFn = self.protocol._getFileName('out_directionalFSC')
+        if not os.path.exists(dirFn):
+            dirFn = self.protocol._getFileName('out_vol3DFSC')
+        if not (os.path.exists(globalFn) and os.path.exists(dirFn)):
+            return None
+
+        key = ('fsc', os.path.getmtime(globalFn), dirFn,
+               os.path.getmtime(dirFn))
+        if key not in self._plotData:
+            samplingRate = self.protocol._getSamplingRate()
+            cutoff = self.protocol.fscCutoff.get()
+            hpFilter = self.protocol.hpFilter.get()
+            globalFreqs, globalFSC = readGlobalFSC(globalFn, samplingRate)
+            if dirFn.endswith('.npz'):
+                _, freqs, fsc = readDirectionalFSC(dirFn)
+            else:
+                freqs, fsc = sampleDirectionalFSC(
+                    dirFn, getDirections(self.protocol.dTheta.get()),
+                    self.protocol.inputVolume.get().getSamplingRate())
+            self._plotData[key] = {
+                'globalFreqs': globalFreqs,
+                'globalFSC': globalFSC,
+                'globalResolution': float(getResolutions(
+                    globalFreqs, globalFSC, cutoff, hpFilter)),
+                'freqs': freqs,
+                'fsc': fsc,
+                'resolutions': getResolutions(freqs, fsc, cutoff, hpFilter)
+            }
+
+        return self._plotData[key]
+
+    def _getPreviewFactor(self):
+        return PREVIEW_FACTORS[self.previewLevel.get()]
+
+    def _preparePreviews(self, vol):
+        """ Create the missing or outdated previews, e.g. of runs that
+        did not write them.
+        """
+        previewDir = self.protocol._getFileName('out_previews')
+        factors = [f for f in PREVIEW_FACTORS if f > 1]
+        source = vol if os.path.exists(vol) else getCompressedFn(vol)
+        if not all(isNewer(getPreviewFn(vol, previewDir, f), source)
+                   for f in factors + [None]):
+            createPreviews(self._getOrdinaryFile(vol), previewDir, factors)
+
+    def _getOrdinaryFile(self, vol):
+        """ Return the file of a volume as a float32 MRC, decompressed
+        into the tmp folder if it is stored compressed.
+        """
+        if os.path.exists(vol):
+            return vol
+
+        outputFn = self.protocol._getTmpPath(os.path.basename(vol))
+        os.makedirs(os.path.dirname(outputFn), exist_ok=True)
+        if not isNewer(outputFn, getCompressedFn(vol)):
+            restoreVolume(vol, outputFn)
+
+        return outputFn
+
+    def _getVolumeFiles(self):
+        """ Return the selected volumes at the selected preview level. """
+        factor = self._getPreviewFactor()
+        vols = [vol for vol in self._getVolumeNames() if volumeExists(vol)]
+        if factor == 1:
+            return [self._getOrdinaryFile(vol) for vol in vols]
+
+        files = []
+        previewDir = self.protocol._getFileName('out_previews')
+        for vol in vols:
+            self._preparePreviews(vol)
+            files.append(getPreviewFn(vol, previewDir, factor))
+
+        return files
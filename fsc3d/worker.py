@@ -0,0 +1,342 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Persistent worker that keeps the 3DFSC environment imported and the
+numba functions compiled, so runs skip the startup cost.
+
+The worker is started by Plugin.startWorker inside the 3DFSC conda
+environment, so this module must only use the standard library (and
+the packages of that environment). It listens on a unix socket for
+jobs, sent as JSON lines:
+
+    {"command": "run", "args": "--halfmap1=...", "cwd": ..., "log": ...}
+    {"command": "ping"}
+    {"command": "stop"}
+
+Each job runs ThreeDFSC_Start.py in a forked child, which inherits the
+warm interpreter, with its output written to the job log. The reply
+is {"returncode": N} when the job finishes. Closing the connection
+cancels the job. The worker exits after being idle for a while.
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import runpy
+import select
+import signal
+import socket
+import argparse
+import tempfile
+import importlib
+import traceback
+import contextlib
+
+WARM_MODULES = ['numpy', 'scipy', 'numba', 'h5py', 'skimage', 'matplotlib',
+                'mrcfile']
+WARMUP_BOX = 32
+POLL_INTERVAL = 1.  # seconds
+REQUEST_TIMEOUT = 10.  # seconds
+
+
+# --------------------------- Client functions --------------------------------
+
+def _connect(socketFn, message, timeout=REQUEST_TIMEOUT):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socketFn)
+        sock.sendall((json.dumps(message) + '\n').encode())
+    except OSError:
+        sock.close()
+        raise
+
+    return sock
+
+
+def _readReply(sock):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = sock.recv(4096)
+        if not chunk:
+            return None
+        data += chunk
+
+    return json.loads(data)
+
+
+def isRunning(socketFn):
+    """ Check if a worker answers on the socket. """
+    try:
+        with _connect(socketFn, {'command': 'ping'}) as sock:
+            reply = _readReply(sock)
+    except (OSError, ValueError):
+        return False
+
+    return reply is not None and reply.get('status') == 'ready'
+
+
+def stopWorker(socketFn):
+    """ Ask the worker to exit once the running jobs are done. """
+    try:
+        with _connect(socketFn, {'command': 'stop'}) as sock:
+            _readReply(sock)
+    except OSError:
+        pass
+
+
+def submitJob(socketFn, args, cwd, logFn, output=None):
+    """ Run a job on the worker and copy its log to output (stdout by
+    default) while it runs. Return the exit code of the job, or None if
+    the worker could not run it.
+    """
+    output = output or sys.stdout
+    message = {'command': 'run', 'args': args, 'cwd': cwd, 'log': logFn}
+    try:
+        sock = _connect(socketFn, message)
+    except OSError:
+        return None
+
+    position = 0
+
+    def _copyLog():
+        nonlocal position
+        if os.path.exists(logFn):
+            with open(logFn, errors='replace') as f:
+                f.seek(position)
+                text = f.read()
+                position = f.tell()
+            if text:
+                output.write(text)
+                output.flush()
+
+    with sock:
+        sock.settimeout(POLL_INTERVAL)
+        data = b''
+        while not data.endswith(b'\n'):
+            try:
+                chunk = sock.recv(4096)
+            except socket.timeout:
+                _copyLog()
+                continue
+            except OSError:
+                return None
+            if not chunk:
+                return None
+            data += chunk
+    _copyLog()
+
+    return json.loads(data).get('returncode')
+
+
+# --------------------------- Worker functions --------------------------------
+
+def _runScript(script, args):
+    """ Run the script as __main__ in this process. Return the exit code. """
+    sys.argv = [script] + shlex.split(args)
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    except BaseException:
+        traceback.print_exc()
+        return 1
+
+    return 0
+
+
+def _runJob(script, request):
+    """ Run a job in the forked child and exit with its code. """
+    code = 1
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.chdir(request['cwd'])
+        fd = os.open(request['log'], os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o644)
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        code = _runScript(script, request['args'])
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def _exitCode(status):
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+
+    return -os.WTERMSIG(status)
+
+
+def warmUp(script):
+    """ Import the heavy modules and run a tiny job, so numba compiles
+    its functions in this process before any fork.
+    """
+    for module in WARM_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+    try:
+        import numpy as np
+        import mrcfile
+    except ImportError:
+        return
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpDir:
+        os.chdir(tmpDir)
+        try:
+            rng = np.random.default_rng(0)
+            common = rng.standard_normal((WARMUP_BOX,) * 3)
+            for name in ['half1', 'half2', 'full']:
+                noise = rng.standard_normal((WARMUP_BOX,) * 3)
+                with mrcfile.new(name + '.mrc') as mrc:
+                    mrc.set_data((common + noise).astype(np.float32))
+                    mrc.voxel_size = 1.
+            args = ('--halfmap1=half1.mrc --halfmap2=half2.mrc '
+                    '--fullmap=full.mrc --apix=1 --ThreeDFSC=warmup '
+                    '--dthetaInDegrees=20 --histogram=histogram '
+                    '--FSCCutoff=0.143 --ThresholdForSphericity=0.5 '
+                    '--HighPassFilter=200 '
+                    '--numThresholdsForSphericityCalcs=0')
+            with open(os.devnull, 'w') as devnull, \
+                    contextlib.redirect_stdout(devnull), \
+                    contextlib.redirect_stderr(devnull):
+                code = _runScript(script, args)
+            print("Warm-up job finished with code %d" % code, flush=True)
+        finally:
+            os.chdir(cwd)
+
+
+def serve(socketFn, script, idle):
+    """ Accept jobs until stopped or idle for longer than idle seconds. """
+    if isRunning(socketFn):
+        print("Another worker is running on %s" % socketFn, flush=True)
+        return
+    if os.path.exists(socketFn):
+        os.remove(socketFn)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socketFn)
+    os.chmod(socketFn, 0o600)
+    server.listen()
+    print("3DFSC worker %d ready on %s" % (os.getpid(), socketFn), flush=True)
+
+    jobs = {}  # pid: connection of the client waiting for it
+    lastActive = time.time()
+    stopping = False
+    try:
+        while not (stopping and not jobs):
+            ready, _, _ = select.select([server] + list(jobs.values()),
+                                        [], [], POLL_INTERVAL)
+            for conn in ready:
+                if conn is server:
+                    stopping |= _accept(server, script, jobs)
+                    lastActive = time.time()
+                else:
+                    # a client waiting for a job only writes to cancel it,
+                    # or closes the connection when it is killed
+                    pid = next(p for p, c in jobs.items() if c is conn)
+                    os.kill(pid, signal.SIGTERM)
+
+            for pid in list(jobs):
+                done, status = os.waitpid(pid, os.WNOHANG)
+                if done:
+                    conn = jobs.pop(pid)
+                    try:
+                        conn.sendall((json.dumps(
+                            {'returncode': _exitCode(status)}) + '\n').encode())
+                    except OSError:
+                        pass
+                    conn.close()
+                    lastActive = time.time()
+
+            if not jobs and time.time() - lastActive > idle:
+                print("3DFSC worker idle, exiting", flush=True)
+                break
+    finally:
+        server.close()
+        if os.path.exists(socketFn):
+            os.remove(socketFn)
+
+
+def _accept(server, script, jobs):
+    """ Handle a new connection. Return True if the worker must stop. """
+    conn, _ = server.accept()
+    conn.settimeout(REQUEST_TIMEOUT)
+    try:
+        request = json.loads(conn.makefile('rb').readline())
+    except (OSError, ValueError):
+        conn.close()
+        return False
+
+    command = request.get('command')
+    if command == 'run':
+        pid = os.fork()
+        if pid == 0:
+            for c in [server] + list(jobs.values()):
+                c.close()
+            _runJob(script, request)
+        conn.settimeout(None)
+        jobs[pid] = conn
+        return False
+
+    reply = {'status': 'stopping' if command == 'stop' else 'ready'}
+    try:
+        conn.sendall((json.dumps(reply) + '\n').encode())
+    except OSError:
+        pass
+    conn.close()
+
+    return command == 'stop'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Persistent 3DFSC worker.')
+    parser.add_argument('--socket', required=True)
+    parser.add_argument('--script', required=True,
+                        help='Path to ThreeDFSC_Start.py')
+    parser.add_argument('--idle', type=float, default=3600.,
+                        help='Exit after this many seconds without jobs.')
+    parser.add_argument('--no-warmup', dest='warmup', action='store_false')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(args.script)))
+    if args.warmup:
+        warmUp(args.script)
+    serve(args.socket, args.script, args.idle)
+
+
+if __name__ == '__main__':
+    main()